@@ -0,0 +1,63 @@
+"""
+    Measures the memory taken by a Holding & checks it against `Holding.MEMORY_BUDGET_BYTES`.
+
+    Run: python -m benchmarks.holding_memory [number_of_holdings]
+"""
+import sys
+import tracemalloc
+
+from src.instruments import Holding
+from src.disk import get_paths
+from src.settings import FILES_DIR
+
+COUNTRIES = ['United States', 'Japan', 'United Kingdom', 'China', 'France', 'Canada', 'Germany', 'Switzerland']
+SECTORS = ['Technology', 'Financials', 'Health Care', 'Industrials', 'Consumer Goods', 'Basic Materials']
+CURRENCIES = ['USD', 'JPY', 'GBP', 'HKD', 'EUR', 'CAD', 'CHF']
+
+
+def get_names() -> list:
+    names = []
+    for file_name in get_paths()['funds']['vanguard'].values():
+        with open(f'{FILES_DIR}/{file_name}', 'r', encoding='utf-8-sig') as f:
+            for line in f.readlines():
+                name = line.split(',')[0].strip()
+                if name:
+                    names.append(name)
+
+    return names
+
+
+def measure(number_of_holdings: int) -> float:
+    names = get_names()
+    names = [names[i % len(names)] for i in range(number_of_holdings)]
+
+    tracemalloc.start()
+    start_size, _ = tracemalloc.get_traced_memory()
+    holdings = [
+        Holding(
+            name=name,
+            ticker=f'T{i}',
+            country=COUNTRIES[i % len(COUNTRIES)],
+            sector=SECTORS[i % len(SECTORS)],
+            currency=CURRENCIES[i % len(CURRENCIES)],
+            exchange='NYSE'
+        )
+        for i, name in enumerate(names)
+    ]
+    end_size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert len(holdings) == number_of_holdings
+
+    return (end_size - start_size) / number_of_holdings
+
+
+if __name__ == '__main__':
+    number_of_holdings = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    bytes_per_holding = measure(number_of_holdings)
+    print(f'Holdings: {number_of_holdings}')
+    print(f'Memory per holding: {bytes_per_holding:.0f} bytes ( budget: {Holding.MEMORY_BUDGET_BYTES} bytes)')
+
+    if bytes_per_holding > Holding.MEMORY_BUDGET_BYTES:
+        sys.exit(1)
@@ -0,0 +1,61 @@
+"""
+    Measures the cold start time of the modules used by a local aggregation & checks it against
+    `IMPORT_TIME_BUDGET_SECONDS`. It also checks that the heavy clients ( Google, Yahoo etc.) are not imported.
+    Every measurement runs in a new interpreter, so nothing is already imported.
+
+    Run: python -m benchmarks.import_time [number_of_runs]
+"""
+import json
+import statistics
+import subprocess
+import sys
+
+IMPORT_TIME_BUDGET_SECONDS = 0.75
+MODULES = ['src.instruments', 'src.factories', 'src.disk', 'src.network']
+HEAVY_MODULES = [
+    'googleapiclient',
+    'google_auth_oauthlib',
+    'yfinance',
+    'pandas_datareader',
+    'requests',
+    'marshmallow',
+    'dotenv'
+]
+
+MEASURE_CODE = f'''
+import json, sys, time
+start_time = time.perf_counter()
+for module in {MODULES!r}:
+    __import__(module)
+import_time = time.perf_counter() - start_time
+print(json.dumps({{
+    'import_time': import_time,
+    'heavy_modules': [module for module in {HEAVY_MODULES!r} if module in sys.modules]
+}}))
+'''
+
+
+def measure() -> dict:
+    output = subprocess.run(
+        [sys.executable, '-c', MEASURE_CODE],
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True
+    ).stdout
+
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    number_of_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    measurements = [measure() for _ in range(number_of_runs)]
+    import_time = statistics.median([measurement['import_time'] for measurement in measurements])
+    heavy_modules = sorted({module for measurement in measurements for module in measurement['heavy_modules']})
+
+    print(f'Modules: {", ".join(MODULES)}')
+    print(f'Import time: {import_time:.3f} s ( budget: {IMPORT_TIME_BUDGET_SECONDS} s, median of {number_of_runs} runs)')
+    print(f'Heavy modules imported: {", ".join(heavy_modules) or None}')
+
+    if import_time > IMPORT_TIME_BUDGET_SECONDS or len(heavy_modules) > 0:
+        sys.exit(1)
@@ -0,0 +1,206 @@
+"""
+    Local fake quote server, with the API of `QuoteServerManager`, so the market refresh runs offline:
+        QUOTE_SERVER_URL=http://127.0.0.1:8765 python create_portfolio.py
+
+    Every ticker is answered with a generated company, except for:
+        - `missing_rate` of the tickers, which are unknown: 404
+        - `bad_request_rate` of the tickers, which are rejected: 400
+        - `throttle_rate` of the tickers, whose first request is throttled: 429
+        - `error_rate` of the tickers, whose first request fails: 503
+    The tickers are picked by their hash, so the answers are deterministic.
+
+    With `--check`, it fetches `--tickers` tickers through the `FetchPipeline`, like a market refresh, & checks that
+    the throttled & failed requests are retried, the unknown tickers have no data & the rejected tickers fail without
+    being retried. It exits with 1 if they don't.
+
+    Run: python -m benchmarks.quote_server [--port 8765] [--throttle-rate 0.1] [--error-rate 0.05] [--check]
+"""
+import argparse
+import contextlib
+import io
+import json
+import sys
+import threading
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple
+
+from benchmarks.synthetic import COUNTRIES, FIRST_WORDS, SECOND_WORDS, SUFFIXES
+from src.network.fetchers import FetchPipeline
+from src.network.quotes import QuoteServerManager
+
+CURRENCIES = ['USD', 'JPY', 'GBP', 'CNY', 'EUR', 'CAD', 'EUR', 'CHF']
+
+
+class FakeQuoteServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+            self,
+            port: int = 0,
+            missing_rate: float = 0.05,
+            bad_request_rate: float = 0.02,
+            throttle_rate: float = 0.1,
+            error_rate: float = 0.05
+    ):
+        """
+            port: 0 picks a free port.
+        """
+        super().__init__(('127.0.0.1', port), FakeQuoteHandler)
+
+        self.missing_rate = missing_rate
+        self.bad_request_rate = bad_request_rate
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+
+        self.requests = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def answer(self, ticker: str) -> Tuple[int, Optional[dict]]:
+        """
+            Returns the status & the quote of a request.
+        """
+        with self.lock:
+            self.requests[ticker] += 1
+            num_requests = self.requests[ticker]
+
+        status = self.get_status(ticker)
+        if status in (429, 503) and num_requests > 1:
+            status = 200
+        if status != 200:
+            return status, None
+
+        return status, self.get_quote(ticker)
+
+    def get_status(self, ticker: str) -> int:
+        value = self.get_hash(ticker)
+        for status, rate in (
+                (404, self.missing_rate),
+                (400, self.bad_request_rate),
+                (429, self.throttle_rate),
+                (503, self.error_rate)
+        ):
+            if value < rate:
+                return status
+            value -= rate
+
+        return 200
+
+    @classmethod
+    def get_quote(cls, ticker: str) -> dict:
+        seed = zlib.crc32(f'{ticker}:quote'.encode('utf-8'))
+        country_id = seed % len(COUNTRIES)
+        name = ' '.join([
+            FIRST_WORDS[seed % len(FIRST_WORDS)],
+            SECOND_WORDS[seed // len(FIRST_WORDS) % len(SECOND_WORDS)],
+            SUFFIXES[seed // 7 % len(SUFFIXES)]
+        ])
+
+        return {
+            'shortName': f'{name} {ticker}',
+            'region': COUNTRIES[country_id],
+            'financialCurrency': CURRENCIES[country_id],
+            'fullExchangeName': 'NasdaqGS'
+        }
+
+    @classmethod
+    def get_hash(cls, ticker: str) -> float:
+        return zlib.crc32(ticker.encode('utf-8')) / 2 ** 32
+
+
+class FakeQuoteHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        prefix = '/quote/'
+        if not self.path.startswith(prefix):
+            self.send_error(404)
+            return
+
+        status, quote = self.server.answer(self.path[len(prefix):])
+        if quote is None:
+            self.send_error(status)
+            return
+
+        body = json.dumps(quote).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def check(server: FakeQuoteServer, num_tickers: int) -> bool:
+    tickers = [f'T{i}' for i in range(num_tickers)]
+    manager = QuoteServerManager(server.url)
+    pipeline = FetchPipeline(manager.get_info, max_workers=8, requests_per_second=1000., backoff_base=0.01)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        quotes = pipeline.run(tickers)
+
+    statuses = {ticker: server.get_status(ticker) for ticker in tickers}
+    errors = []
+    for ticker, status in statuses.items():
+        num_requests = server.requests[ticker]
+        if status == 400:
+            if ticker not in pipeline.failed_keys or num_requests != 1:
+                errors.append(f'{ticker}: the rejected ticker was requested {num_requests} times')
+        elif status == 404:
+            if quotes.get(ticker) != dict():
+                errors.append(f'{ticker}: the unknown ticker has data')
+        elif quotes.get(ticker) != server.get_quote(ticker):
+            errors.append(f'{ticker}: the quote was not fetched after {num_requests} requests ( status {status})')
+
+    print(f'Tickers: {num_tickers}, requests: {sum(server.requests.values())}')
+    print(f'Statuses: {dict(sorted(Counter(statuses.values()).items()))}')
+    print(f'Fetched: {len(quotes)}, failed: {len(pipeline.failed_keys)}')
+    for error in errors[:10]:
+        print(error)
+
+    return len(errors) == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local fake quote server.')
+    parser.add_argument('--port', type=int, default=8765, help='With --check, a free port is used.')
+    parser.add_argument('--missing-rate', type=float, default=0.05)
+    parser.add_argument('--bad-request-rate', type=float, default=0.02)
+    parser.add_argument('--throttle-rate', type=float, default=0.1)
+    parser.add_argument('--error-rate', type=float, default=0.05)
+    parser.add_argument('--check', action='store_true', help='Check the fetch pipeline against the server & exit.')
+    parser.add_argument('--tickers', type=int, default=500, help='The number of tickers fetched by --check.')
+    args = parser.parse_args()
+
+    server = FakeQuoteServer(
+        port=0 if args.check else args.port,
+        missing_rate=args.missing_rate,
+        bad_request_rate=args.bad_request_rate,
+        throttle_rate=args.throttle_rate,
+        error_rate=args.error_rate
+    )
+
+    if not args.check:
+        print(f'Serving quotes on {server.url}')
+        server.serve_forever()
+        return
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        passed = check(server, args.tickers)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    if not passed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
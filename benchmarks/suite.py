@@ -0,0 +1,271 @@
+"""
+    Offline benchmark suite. It uses the bundled Vanguard files, synthetic funds & a stub market, so it doesn't need
+    the network. Every stage is timed separately:
+        - ingestion: parsing the funds
+        - to_leaves: reducing a portfolio of all the funds to leaves
+        - recombine: reducing the portfolio again, from the cached leaves, after its weights changed
+        - aggregate: aggregating all the funds
+        - look_through: combining the funds with other weights, from their exposure matrix
+        - statistics: the country & sector statistics & the country x sector pivot of the leaves
+        - export: exporting the leaves to CSV
+    & a few micro benchmarks: `Holding.__eq__`, `add_holding_weight` & `MarketHub.query`.
+
+    The results are written as JSON. Pass the results of a previous run with `--compare` to print the ratios between
+    the runs: it exits with 1 if a stage is slower than `--threshold` times the previous one.
+
+    With `--trace`, one more run is traced ( see `src.tracing`) & exported as a Chrome trace. It is not timed, because
+    the tracing of the memory slows it down.
+
+    Run: python -m benchmarks.suite [--funds 20] [--holdings 2000] [--collision-rate 0.5] [--repeat 3]
+        [--output results.json] [--compare previous_results.json] [--trace trace.json]
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from benchmarks.synthetic import SyntheticUniverse
+from src import settings, tracing
+from src.disk import get_paths
+from src.disk.caches import LeavesCache
+from src.exposures import ExposureMatrix
+from src.factories import create_etf_from_custom_csv, create_etf_from_vanguard
+from src.instruments import Holding, LeavesResolver, MultipleItemsFinancialInstrument
+from src.markets import MarketHub
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+DEFAULT_THRESHOLD = 1.2
+# Differences under this are noise, even if the ratio is over the threshold.
+MIN_SIGNIFICANT_SECONDS = 0.01
+
+
+class Timer:
+    def __init__(self):
+        self.timings: Dict[str, float] = dict()
+
+    @contextlib.contextmanager
+    def time(self, name: str):
+        """
+            The output of the timed code is discarded, so the prints & progress bars are not measured.
+        """
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            start_time = time.perf_counter()
+            yield
+            self.timings[name] = time.perf_counter() - start_time
+
+
+def run_once(config: dict) -> Dict[str, float]:
+    universe = SyntheticUniverse(
+        num_funds=config['funds'],
+        num_holdings=config['holdings'],
+        collision_rate=config['collision_rate'],
+        seed=config['seed']
+    )
+    MarketHub.market_hub = MarketHub(markets=[universe.get_market()])
+    timer = Timer()
+
+    fund_files = {ticker: universe.get_fund_csv(ticker) for ticker in universe.funds}
+    with timer.time('ingestion'):
+        etfs = {ticker: create_etf_from_custom_csv(ticker, fund_file) for ticker, fund_file in fund_files.items()}
+        if config['vanguard']:
+            for ticker, file_name in get_paths()['funds']['vanguard'].items():
+                etfs[ticker] = create_etf_from_vanguard(ticker, os.path.join(settings.FILES_DIR, file_name))
+
+    weight = 1 / len(etfs)
+    portfolio = MultipleItemsFinancialInstrument.from_holdings_weights(
+        'Portfolio',
+        [Holding(name=f'Fund {ticker}', ticker=ticker, holding_type='ETF') for ticker in etfs.keys()],
+        [weight] * len(etfs)
+    )
+
+    with timer.time('to_leaves'):
+        # The funds are already parsed, so the resolver gets them instead of looking them up in their sources.
+        resolver = LeavesResolver()
+        resolver.instruments.update(etfs)
+        leaves = resolver.resolve(portfolio)
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = LeavesCache(path=directory)
+        resolver = LeavesResolver(cache=cache)
+        resolver.instruments.update(etfs)
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            resolver.resolve(portfolio)
+
+        # Only the weights of the portfolio change, so it is recombined from the cached leaves.
+        reweighted_portfolio = MultipleItemsFinancialInstrument.from_holdings_weights(
+            'Portfolio',
+            portfolio.get_holdings(),
+            np.roll(portfolio.get_weights(), 1)
+        )
+        with timer.time('recombine'):
+            resolver = LeavesResolver(cache=cache)
+            resolver.instruments.update(etfs)
+            resolver.resolve(reweighted_portfolio)
+
+    with timer.time('aggregate'):
+        MultipleItemsFinancialInstrument.aggregate([(weight, etf) for etf in etfs.values()])
+
+    # The funds are matched once, in the matrix. Then any weights of the funds are one matrix-vector product.
+    exposure_matrix = ExposureMatrix.from_instruments(etfs.items())
+    with timer.time('look_through'):
+        exposure_matrix.to_instrument('Portfolio', np.roll(portfolio.get_weights(), 1))
+
+    with timer.time('statistics'):
+        exposure_cube = leaves.get_exposure_cube()
+        leaves.statistics('country', exposure_cube=exposure_cube)
+        leaves.statistics('sector', exposure_cube=exposure_cube)
+        exposure_cube.pivot('country', 'sector')
+
+    with tempfile.TemporaryDirectory() as directory:
+        with timer.time('export'):
+            leaves.export_to_csv(os.path.join(directory, 'portfolio.csv'))
+
+    holdings = list(leaves.get_holdings())
+    with timer.time('holding_eq'):
+        for holding_1, holding_2 in zip(holdings, holdings[1:] + holdings[:1]):
+            holding_1 == holding_2
+
+    with timer.time('add_holding_weight'):
+        instrument = MultipleItemsFinancialInstrument('Instrument')
+        for holding in holdings:
+            instrument.add_holding_weight(holding, 0.)
+
+    MarketHub.get().clear_cache()
+    with timer.time('market_hub_query'):
+        for holding in holdings:
+            MarketHub.get().query(holding)
+
+    MarketHub.market_hub = None
+
+    return timer.timings
+
+
+def run(config: dict) -> dict:
+    runs: List[Dict[str, float]] = [run_once(config) for _ in range(config['repeat'])]
+
+    return {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'config': config,
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'commit': get_commit()
+        },
+        'stages': {
+            stage: {
+                'median': statistics.median([timings[stage] for timings in runs]),
+                'min': min([timings[stage] for timings in runs]),
+                'runs': [timings[stage] for timings in runs]
+            }
+            for stage in runs[0].keys()
+        }
+    }
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, previous_results: dict, threshold: float) -> bool:
+    """
+        Prints the ratios between the fastest runs of the stages, which are the least noisy.
+        Returns False if a stage regressed over the threshold.
+    """
+    if results['config'] != previous_results['config']:
+        print('Warning: the runs have different configurations.')
+
+    has_regressions = False
+    print(f'{"Stage":<20}{"Previous (s)":>14}{"Current (s)":>14}{"Ratio":>8}')
+    for stage, timings in results['stages'].items():
+        previous_timings = previous_results['stages'].get(stage)
+        if previous_timings is None:
+            continue
+
+        ratio = timings['min'] / max(previous_timings['min'], 1e-9)
+        is_regression = ratio > threshold and timings['min'] - previous_timings['min'] > MIN_SIGNIFICANT_SECONDS
+        has_regressions = has_regressions or is_regression
+        print(
+            f'{stage:<20}{previous_timings["min"]:>14.4f}{timings["min"]:>14.4f}{ratio:>8.2f}'
+            f'{"  <-- regression" if is_regression else ""}'
+        )
+
+    return not has_regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the offline benchmark suite.')
+    parser.add_argument('--funds', type=int, default=20, help='The number of synthetic funds.')
+    parser.add_argument('--holdings', type=int, default=2000, help='The number of holdings of a synthetic fund.')
+    parser.add_argument(
+        '--collision-rate',
+        type=float,
+        default=0.5,
+        help='The part of the holdings of a fund that are shared with the other funds.'
+    )
+    parser.add_argument('--no-vanguard', action='store_true', help='Do not use the bundled Vanguard files.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='The number of runs. The median is reported.')
+    parser.add_argument('--output', help='The results file. Defaults to benchmarks/results/{timestamp}.json.')
+    parser.add_argument('--compare', help='The results file of a previous run.')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--trace', help='The path of the Chrome trace of a traced run.')
+    args = parser.parse_args()
+
+    results = run({
+        'funds': args.funds,
+        'holdings': args.holdings,
+        'collision_rate': args.collision_rate,
+        'vanguard': not args.no_vanguard,
+        'seed': args.seed,
+        'repeat': args.repeat
+    })
+
+    output_path = args.output
+    if output_path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output_path = os.path.join(RESULTS_DIR, f'{datetime.datetime.now():%Y%m%d_%H%M%S}.json')
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    for stage, timings in results['stages'].items():
+        print(f'{stage:<20}{timings["median"]:>10.4f} s')
+    print(f'Results: {output_path}')
+
+    if args.trace:
+        tracing.enable()
+        run_once(results['config'])
+        tracing.export_chrome_trace(args.trace)
+        tracing.print_summary(tracing.disable())
+        print(f'Trace: {args.trace}')
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            previous_results = json.load(f)
+
+        if not compare(results, previous_results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
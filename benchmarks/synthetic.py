@@ -0,0 +1,142 @@
+"""
+    Generates synthetic funds & a stub market, so the benchmarks run offline & are reproducible.
+
+    The funds are CSV files in the custom format, generated in memory. Every fund has `num_holdings` holdings:
+        - `collision_rate` of them are drawn from a pool of companies shared by all the funds, so they are merged
+            when the funds are aggregated
+        - the rest are companies held only by that fund
+    Some holdings have no ticker or a variation of the company name ( ex. an extra 'Class A'), so they are matched
+    by name. `market_coverage` of the companies are in the stub market.
+"""
+import io
+import random
+from typing import Dict, List, NamedTuple
+
+from src.instruments import Holding
+from src.markets import CustomMarket
+
+FIRST_WORDS = [
+    'Atlas', 'Boreal', 'Cobalt', 'Delta', 'Ember', 'Falcon', 'Granite', 'Harbor', 'Iris', 'Juniper', 'Kestrel',
+    'Lumen', 'Meridian', 'Nimbus', 'Orion', 'Pioneer', 'Quartz', 'Redwood', 'Summit', 'Titan', 'Unity', 'Vertex',
+    'Willow', 'Xenon', 'Yarrow', 'Zenith'
+]
+SECOND_WORDS = [
+    'Energy', 'Financial', 'Systems', 'Pharma', 'Motors', 'Foods', 'Networks', 'Mining', 'Capital', 'Retail',
+    'Logistics', 'Materials', 'Media', 'Health', 'Semiconductor', 'Insurance', 'Realty', 'Chemicals', 'Airlines',
+    'Software'
+]
+SUFFIXES = ['Inc', 'Corp', 'Holdings', 'Group', 'Plc', 'Ltd', 'SA', 'AG']
+NAME_VARIATIONS = ['Class A', 'Class B', 'Registered Shs', 'ADR']
+
+COUNTRIES = ['United States', 'Japan', 'United Kingdom', 'China', 'France', 'Canada', 'Germany', 'Switzerland']
+SECTORS = ['Technology', 'Financials', 'Health Care', 'Industrials', 'Consumer Goods', 'Basic Materials']
+
+CSV_COLUMNS = ['Company', 'Ticker', 'Region', 'Domain', 'Actual Percentage (%)']
+
+
+class Company(NamedTuple):
+    name: str
+    ticker: str
+    country: str
+    sector: str
+
+
+class SyntheticUniverse:
+    def __init__(
+            self,
+            num_funds: int,
+            num_holdings: int,
+            collision_rate: float = 0.5,
+            market_coverage: float = 0.5,
+            ticker_rate: float = 0.8,
+            name_variation_rate: float = 0.1,
+            seed: int = 0
+    ):
+        assert 0 <= collision_rate <= 1
+
+        self.num_funds = num_funds
+        self.num_holdings = num_holdings
+        self.collision_rate = collision_rate
+        self.market_coverage = market_coverage
+        self.ticker_rate = ticker_rate
+        self.name_variation_rate = name_variation_rate
+        self.random = random.Random(seed)
+
+        num_shared_holdings = round(num_holdings * collision_rate)
+        num_own_holdings = num_holdings - num_shared_holdings
+
+        self._num_companies = 0
+        self.shared_companies = self.generate_companies(num_holdings if num_shared_holdings > 0 else 0)
+        self.funds: Dict[str, List[Company]] = dict()
+        for fund_id in range(num_funds):
+            companies = self.random.sample(self.shared_companies, num_shared_holdings)
+            companies.extend(self.generate_companies(num_own_holdings))
+            self.funds[self.get_fund_ticker(fund_id)] = companies
+
+    @classmethod
+    def get_fund_ticker(cls, fund_id: int) -> str:
+        return f'SYN{fund_id}'
+
+    def generate_companies(self, count: int) -> List[Company]:
+        companies = []
+        for _ in range(count):
+            company_id = self._num_companies
+            self._num_companies += 1
+
+            first_word = FIRST_WORDS[company_id % len(FIRST_WORDS)]
+            second_word = SECOND_WORDS[(company_id // len(FIRST_WORDS)) % len(SECOND_WORDS)]
+            suffix = SUFFIXES[self.random.randrange(len(SUFFIXES))]
+            # Names repeat after all the combinations of words are used, so a number makes them unique.
+            generation = company_id // (len(FIRST_WORDS) * len(SECOND_WORDS))
+            name = f'{first_word} {second_word} {suffix}' if generation == 0 else \
+                f'{first_word} {second_word} N{generation} {suffix}'
+
+            companies.append(Company(
+                name=name,
+                ticker=f'C{company_id}',
+                country=COUNTRIES[self.random.randrange(len(COUNTRIES))],
+                sector=SECTORS[self.random.randrange(len(SECTORS))]
+            ))
+
+        return companies
+
+    def get_fund_csv(self, ticker: str) -> io.StringIO:
+        companies = self.funds[ticker]
+        weights = [self.random.random() for _ in companies]
+        total_weight = sum(weights)
+
+        lines = [','.join(CSV_COLUMNS)]
+        for company, weight in zip(companies, weights):
+            name = company.name
+            if self.random.random() < self.name_variation_rate:
+                name = f'{name} {NAME_VARIATIONS[self.random.randrange(len(NAME_VARIATIONS))]}'
+            company_ticker = company.ticker if self.random.random() < self.ticker_rate else ''
+
+            lines.append(f'{name},{company_ticker},{company.country},{company.sector},{weight / total_weight * 100}')
+
+        return io.StringIO('\n'.join(lines) + '\n')
+
+    def get_market(self) -> CustomMarket:
+        """
+            Stub market with `market_coverage` of all the companies, with their ticker, country & sector.
+        """
+        market = CustomMarket('SyntheticMarket')
+
+        companies = dict()
+        for fund_companies in self.funds.values():
+            for company in fund_companies:
+                companies[company.ticker] = company
+
+        for company in companies.values():
+            if self.random.random() < self.market_coverage:
+                market.add_holding(Holding(
+                    name=company.name,
+                    ticker=company.ticker,
+                    country=company.country,
+                    sector=company.sector,
+                    currency='USD',
+                    exchange='Synthetic Exchange',
+                    holding_type='Stock'
+                ))
+
+        return market
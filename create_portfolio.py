@@ -1,4 +1,6 @@
+from src import settings, tracing
 from src.network.ops import get_google_sheets
+from src.markets import MarketHub
 
 # TODO: Change Yahoo source for better region & sector information.
 # TODO: Download VANGUARD, HSBC etfs files dinamically.
@@ -6,9 +8,22 @@ from src.network.ops import get_google_sheets
 
 
 if __name__ == '__main__':
+    if settings.TRACE_PATH:
+        tracing.enable(trace_memory=settings.TRACE_MEMORY)
+
+    # Load the markets while the portfolio is read & the funds are downloaded.
+    warm_up = MarketHub.warm_up()
+
     portfolio = get_google_sheets('Portfolio')
+    # Raise the errors of the warm up, if the portfolio didn't need the markets yet.
+    warm_up.result()
     portfolio = portfolio.to_leaves()
 
     portfolio.export_to_google_sheets(workspace_name='Aggregated')
-    portfolio.statistics_country()
-    portfolio.statistics_sector()
+    exposure_cube = portfolio.get_exposure_cube()
+    portfolio.statistics_country(exposure_cube=exposure_cube)
+    portfolio.statistics_sector(exposure_cube=exposure_cube)
+
+    if tracing.is_enabled():
+        tracing.print_summary()
+        tracing.export_chrome_trace(settings.TRACE_PATH)
@@ -0,0 +1,279 @@
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import tqdm
+
+from src import settings, tracing
+from src.exceptions import DecompositionError, DownloadError, ManifestError
+from src.instruments import LeavesResolver, MultipleItemsFinancialInstrument
+from src.markets import MarketHub
+
+"""
+    Aggregates a batch of portfolios in one run. The portfolios are listed in a JSON manifest:
+        {
+            "portfolios": [
+                {"name": "Alice", "sheet_range": "Alice", "output_workspace": "Alice Aggregated"},
+                {"name": "Bob", "csv": "portfolios/bob.csv", "output_csv": "outputs/bob.csv"}
+            ]
+        }
+    A portfolio is read either from a google sheets range or from a CSV file in the custom format ( see
+    `create_etf_from_custom_csv`). The paths of the CSV files are relative to the manifest. Its leaves are written to
+    the CSV file `output_csv` and / or to the google sheets workspace `output_workspace`. Without any of them, they are
+    written to `{output_dir}/{name}.csv`.
+
+    The markets are loaded & all the funds held by the portfolios are reduced only once, in the main process. Then the
+    portfolios are resolved & exported by a pool of processes. The processes are forked, where it is possible, so
+    they share the loaded markets & the reduced funds. Otherwise, every process loads them from the disk caches.
+    A portfolio that fails doesn't stop the others.
+
+    Run: python -m src.batch manifest.json [--workers 4] [--output-dir outputs]
+"""
+
+# Set in the main process before the pool is created, so the forked processes inherit them.
+_jobs: Optional[List['PortfolioJob']] = None
+_portfolios: Optional[List[Optional[MultipleItemsFinancialInstrument]]] = None
+_resolver: Optional[LeavesResolver] = None
+
+
+class PortfolioJob:
+    def __init__(
+            self,
+            name: str,
+            sheet_range: Optional[str] = None,
+            csv: Optional[str] = None,
+            output_csv: Optional[str] = None,
+            output_workspace: Optional[str] = None
+    ):
+        assert (sheet_range is None) != (csv is None), 'A portfolio is read either from a sheet range or a CSV file.'
+
+        self.name = name
+        self.sheet_range = sheet_range
+        self.csv = csv
+        self.output_csv = output_csv
+        self.output_workspace = output_workspace
+
+    def load(self) -> MultipleItemsFinancialInstrument:
+        if self.sheet_range is not None:
+            from src.network.ops import get_google_sheets
+
+            return get_google_sheets(self.sheet_range)
+
+        from src.factories import create_etf_from_custom_csv
+
+        return create_etf_from_custom_csv(self.name, self.csv)
+
+    def run(self, resolver: LeavesResolver, portfolio: Optional[MultipleItemsFinancialInstrument] = None) -> dict:
+        """
+            Resolves the portfolio to leaves & exports them. The output of the run is discarded, unless it fails.
+            Returns a summary of the run.
+        """
+        start_time = time.perf_counter()
+        output = io.StringIO()
+        summary = {'name': self.name, 'holdings': None, 'error': None}
+        try:
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                portfolio = portfolio if portfolio is not None else self.load()
+                leaves = resolver.resolve(portfolio)
+                self.export(leaves)
+
+            summary['holdings'] = len(leaves.get_holdings())
+        except Exception as e:
+            summary['error'] = f'{type(e).__name__}: {e}'
+            summary['output'] = output.getvalue()
+        summary['seconds'] = time.perf_counter() - start_time
+
+        return summary
+
+    def export(self, leaves: MultipleItemsFinancialInstrument):
+        if self.output_csv is not None:
+            Path(self.output_csv).parent.mkdir(parents=True, exist_ok=True)
+            leaves.export_to_csv(self.output_csv)
+
+        if self.output_workspace is not None:
+            leaves.export_to_google_sheets(workspace_name=self.output_workspace)
+
+
+def load_manifest(path: str, output_dir: str) -> List[PortfolioJob]:
+    with open(path, 'r') as f:
+        try:
+            manifest = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ManifestError(path, str(e)) from e
+
+    manifest_dir = Path(path).parent
+    portfolios = manifest.get('portfolios') if isinstance(manifest, dict) else None
+    if not isinstance(portfolios, list) or len(portfolios) == 0:
+        raise ManifestError(path, 'it has no portfolios.')
+
+    jobs = []
+    names = set()
+    for index, portfolio in enumerate(portfolios):
+        if not isinstance(portfolio, dict):
+            raise ManifestError(path, f'the portfolio {index} is not an object.')
+
+        name = portfolio.get('name')
+        if not name:
+            raise ManifestError(path, f'the portfolio {index} has no name.')
+        if name in names:
+            raise ManifestError(path, f'the portfolio {name} is listed multiple times.')
+        if ('sheet_range' in portfolio) == ('csv' in portfolio):
+            raise ManifestError(path, f'the portfolio {name} needs either a sheet_range or a csv.')
+        names.add(name)
+
+        output_csv = portfolio.get('output_csv')
+        output_workspace = portfolio.get('output_workspace')
+        if output_csv is None and output_workspace is None:
+            file_name = re.sub(r'[^\w\-. ]', '_', name)
+            output_csv = os.path.join(output_dir, f'{file_name}.csv')
+
+        jobs.append(PortfolioJob(
+            name=name,
+            sheet_range=portfolio.get('sheet_range'),
+            csv=str(manifest_dir / portfolio['csv']) if 'csv' in portfolio else None,
+            output_csv=output_csv,
+            output_workspace=output_workspace
+        ))
+
+    return jobs
+
+
+class BatchRunner:
+    # The portfolios are read concurrently, because reading them is mostly waiting for the network.
+    READ_MAX_WORKERS = 8
+
+    def __init__(self, jobs: List[PortfolioJob], max_workers: Optional[int] = None):
+        """
+            max_workers: the number of processes. Defaults to `BATCH_MAX_WORKERS`. With 1, the portfolios are resolved
+                in the main process.
+        """
+        self.jobs = jobs
+        self.max_workers = max_workers or settings.BATCH_MAX_WORKERS or os.cpu_count() or 1
+
+    @tracing.traced('batch')
+    def run(self) -> List[dict]:
+        """
+            Returns the summaries of the portfolios, in the order of the jobs.
+        """
+        global _jobs, _portfolios, _resolver
+
+        # Load the markets while the portfolios are read.
+        warm_up = MarketHub.warm_up()
+        portfolios = self.load_portfolios()
+        warm_up.result()
+
+        resolver = LeavesResolver(cache=LeavesResolver.get_default_cache())
+        print('Reducing the funds of all the portfolios...')
+        try:
+            resolver.prepare([portfolio for portfolio in portfolios if portfolio is not None])
+        except (DownloadError, DecompositionError) as e:
+            # The funds that were reduced are kept. The others are reduced by every portfolio that holds them.
+            print(f'Could not reduce all the funds: {e}')
+
+        _jobs, _portfolios, _resolver = self.jobs, portfolios, resolver
+        try:
+            if self.max_workers == 1 or len(self.jobs) == 1:
+                return [_run_job(index) for index in tqdm.tqdm(range(len(self.jobs)))]
+
+            return self._run_in_processes()
+        finally:
+            _jobs, _portfolios, _resolver = None, None, None
+
+    def load_portfolios(self) -> List[Optional[MultipleItemsFinancialInstrument]]:
+        """
+            The portfolios that can't be read are None. They are read again, & fail, in their own run.
+            Their output is not redirected, because `sys.stdout` is shared by the threads.
+        """
+        def load(job: PortfolioJob) -> Optional[MultipleItemsFinancialInstrument]:
+            try:
+                return job.load()
+            except Exception:
+                return None
+
+        print(f'Reading {len(self.jobs)} portfolios...')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.READ_MAX_WORKERS) as executor:
+            return list(executor.map(load, self.jobs))
+
+    def _run_in_processes(self) -> List[dict]:
+        can_fork = 'fork' in multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if can_fork else None)
+        max_workers = min(self.max_workers, len(self.jobs))
+
+        summaries: List[Optional[dict]] = [None] * len(self.jobs)
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(self.jobs, can_fork)
+        ) as executor:
+            futures = {executor.submit(_run_job, index): index for index in range(len(self.jobs))}
+            for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+                summaries[futures[future]] = future.result()
+
+        return summaries
+
+
+def _init_worker(jobs: List[PortfolioJob], is_forked: bool):
+    global _jobs, _portfolios, _resolver
+
+    if is_forked:
+        from src.network.managers import DownloadManager, GoogleAPIClient
+
+        # The connections of the main process can't be shared.
+        DownloadManager.session = None
+        GoogleAPIClient.reset_connections()
+    else:
+        _jobs, _portfolios = jobs, None
+        _resolver = LeavesResolver(cache=LeavesResolver.get_default_cache())
+
+
+def _run_job(index: int) -> dict:
+    portfolio = _portfolios[index] if _portfolios is not None else None
+
+    return _jobs[index].run(_resolver, portfolio)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Aggregate all the portfolios of a manifest.')
+    parser.add_argument('manifest', help='The JSON manifest of the portfolios.')
+    parser.add_argument('--workers', type=int, help='The number of processes. Defaults to BATCH_MAX_WORKERS.')
+    parser.add_argument(
+        '--output-dir',
+        default='outputs',
+        help='The directory of the CSV outputs of the portfolios without an output.'
+    )
+    args = parser.parse_args()
+
+    if settings.TRACE_PATH:
+        tracing.enable(trace_memory=settings.TRACE_MEMORY)
+
+    jobs = load_manifest(args.manifest, args.output_dir)
+    summaries = BatchRunner(jobs, max_workers=args.workers).run()
+
+    for summary in summaries:
+        if summary['error'] is None:
+            print(f'{summary["name"]}: {summary["holdings"]} holdings in {summary["seconds"]:.2f}s')
+        else:
+            print(f'{summary["name"]}: failed with {summary["error"]}')
+    num_failed = sum(summary['error'] is not None for summary in summaries)
+    print(f'Aggregated {len(summaries) - num_failed} / {len(summaries)} portfolios.')
+
+    if tracing.is_enabled():
+        tracing.print_summary()
+        tracing.export_chrome_trace(settings.TRACE_PATH)
+
+    if num_failed > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
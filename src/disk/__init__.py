@@ -3,7 +3,6 @@ import os
 from typing import Optional
 
 import src.utils as utils
-from src.settings import FILES_DIR
 from .ops import *
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -0,0 +1,278 @@
+import argparse
+import hashlib
+import io
+import os
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from src import settings, tracing
+from src.disk.snapshots import HoldingsSnapshot
+from src.exceptions import SnapshotError
+from src.exposures import ExposureMatrix
+from src.instruments import ETF
+from src.normalizers.file import FileSource
+
+# Bump it when the parsing of the fund files changes, so the old entries are not used anymore.
+CACHE_VERSION = 1
+
+
+class SnapshotCache:
+    """
+        Directory of snapshot entries. When it grows over `max_size_bytes`, the least recently used entries are evicted.
+    """
+
+    ENTRY_SUFFIX = '.snapshot'
+
+    def __init__(self, path: Path, max_size_bytes: int):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+
+    def load_entry(self, entry_path: Path) -> Optional[HoldingsSnapshot]:
+        if not entry_path.exists():
+            return None
+
+        try:
+            snapshot = HoldingsSnapshot.load(str(entry_path))
+        except SnapshotError:
+            os.remove(str(entry_path))
+
+            return None
+
+        # Mark the entry as recently used.
+        os.utime(str(entry_path))
+
+        return snapshot
+
+    def save_entry(self, entry_path: Path, snapshot: HoldingsSnapshot):
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        snapshot.save(str(entry_path))
+
+        self.evict()
+
+    def get_entries(self) -> List[Path]:
+        return list(self.path.glob(f'**/*{self.ENTRY_SUFFIX}'))
+
+    def evict(self) -> int:
+        """
+            Removes the least recently used entries until the cache fits in `max_size_bytes`.
+            Returns the number of removed entries.
+        """
+        entries = sorted(
+            ((entry.stat().st_mtime, entry.stat().st_size, entry) for entry in self.get_entries()),
+            key=lambda item: item[0]
+        )
+        size = sum(entry_size for _, entry_size, _ in entries)
+
+        num_evicted_entries = 0
+        for _, entry_size, entry in entries:
+            if size <= self.max_size_bytes:
+                break
+
+            os.remove(str(entry))
+            size -= entry_size
+            num_evicted_entries += 1
+
+        return num_evicted_entries
+
+    def size(self) -> int:
+        return sum(entry.stat().st_size for entry in self.get_entries())
+
+
+class FundCache(SnapshotCache):
+    """
+        Persistent cache of the parsed funds. An entry is a holdings snapshot, with the weights, stored at
+        `{source}/{ticker}-{content hash}.snapshot`, where the content hash is the sha256 of the raw fund file & of the
+        version of the markets, because the holdings are merged with the market data when they are parsed.
+        So a fund file is parsed only when its content changes or the markets are refreshed.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_size_bytes: Optional[int] = None):
+        super().__init__(
+            path=Path(path or Path(settings.STORAGE_PATH) / 'funds_cache'),
+            max_size_bytes=max_size_bytes or settings.FUND_CACHE_MAX_SIZE_MB * 2 ** 20
+        )
+
+    @classmethod
+    def get_content_hash(cls, content: bytes, market_version: str) -> str:
+        content_hash = hashlib.sha256(f'v{CACHE_VERSION}:{market_version}:'.encode('utf-8'))
+        content_hash.update(content)
+
+        return content_hash.hexdigest()
+
+    def get_entry_path(self, ticker: str, source: str, content_hash: str) -> Path:
+        return self.path / source / f'{ticker.upper()}-{content_hash}{self.ENTRY_SUFFIX}'
+
+    def get_or_create(
+            self,
+            ticker: str,
+            source: str,
+            file_path: str,
+            factory: Callable[[str, FileSource], ETF]
+    ) -> ETF:
+        """
+            The fund file is read only once: its content is hashed & parsed from memory, if it is not cached.
+        """
+        from src.markets import MarketHub
+
+        with open(file_path, 'rb') as f:
+            content = f.read()
+
+        # The markets are loaded first, so the version is the one of the market data the fund is parsed with.
+        market_hub = MarketHub.get()
+        market_hub.load()
+        content_hash = self.get_content_hash(content, market_hub.get_version())
+
+        etf = self.get(ticker, source, content_hash)
+        if etf is None:
+            tracing.count('fund_cache.misses')
+            etf = factory(ticker, io.BytesIO(content))
+            self.put(ticker, source, content_hash, etf)
+        else:
+            tracing.count('fund_cache.hits')
+
+        return etf
+
+    def get(self, ticker: str, source: str, content_hash: str) -> Optional[ETF]:
+        snapshot = self.load_entry(self.get_entry_path(ticker, source, content_hash))
+        if snapshot is None:
+            return None
+
+        print(f'Getting {ticker} from the funds cache')
+
+        return ETF.from_holdings_weights(snapshot.metadata['name'], snapshot, snapshot.get_weights())
+
+    def put(self, ticker: str, source: str, content_hash: str, etf: ETF):
+        """
+            If the cache can't be written ( ex. a read-only storage), the fund is not cached.
+        """
+        try:
+            self._put(ticker, source, content_hash, etf)
+        except OSError as e:
+            print(f'Could not cache {ticker}: {e}')
+
+    def _put(self, ticker: str, source: str, content_hash: str, etf: ETF):
+        # The older versions of the fund file are not needed anymore.
+        self.invalidate(ticker=ticker, source=source)
+
+        snapshot = HoldingsSnapshot.from_holdings(
+            etf.get_holdings(),
+            metadata={
+                'name': etf.name,
+                'ticker': ticker.upper(),
+                'source': source,
+                'content_hash': content_hash
+            },
+            weights=etf.get_weights()
+        )
+        self.save_entry(self.get_entry_path(ticker, source, content_hash), snapshot)
+
+    def get_entries(self, ticker: Optional[str] = None, source: Optional[str] = None) -> List[Path]:
+        ticker_pattern = f'{ticker.upper()}-*' if ticker else '*'
+        source_pattern = source or '*'
+
+        return list(self.path.glob(f'{source_pattern}/{ticker_pattern}{self.ENTRY_SUFFIX}'))
+
+    def invalidate(self, ticker: Optional[str] = None, source: Optional[str] = None) -> int:
+        """
+            Removes the entries of a ticker and / or source, or all the entries if none is given.
+            Returns the number of removed entries.
+        """
+        entries = self.get_entries(ticker, source)
+        for entry in entries:
+            os.remove(str(entry))
+
+        return len(entries)
+
+
+class LeavesCache(SnapshotCache):
+    """
+        Persistent cache of the look-through matrices of the financial instruments ( see `LeavesResolver`), stored at
+        `{fingerprint}.snapshot`. The fingerprint identifies the holdings of the instrument, without their weights,
+        so an instrument whose weights changed is recombined from its entry.
+        An entry is a holdings snapshot of the leaves, with the CSR arrays of the matrix as extra arrays.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_size_bytes: Optional[int] = None):
+        super().__init__(
+            path=Path(path or Path(settings.STORAGE_PATH) / 'leaves_cache'),
+            max_size_bytes=max_size_bytes or settings.LEAVES_CACHE_MAX_SIZE_MB * 2 ** 20
+        )
+
+    def get_entry_path(self, fingerprint: str) -> Path:
+        return self.path / f'{fingerprint}{self.ENTRY_SUFFIX}'
+
+    def get(self, fingerprint: str) -> Optional[ExposureMatrix]:
+        snapshot = self.load_entry(self.get_entry_path(fingerprint))
+        if snapshot is None:
+            tracing.count('leaves_cache.misses')
+
+            return None
+
+        tracing.count('leaves_cache.hits')
+        print(f'Getting the leaves of {snapshot.metadata["name"]} from the leaves cache')
+
+        return ExposureMatrix(
+            snapshot,
+            indptr=snapshot.arrays['matrix.indptr'],
+            indices=snapshot.arrays['matrix.indices'],
+            data=snapshot.arrays['matrix.data'],
+            names=snapshot.metadata['names']
+        )
+
+    def put(self, fingerprint: str, name: str, exposure_matrix: ExposureMatrix):
+        """
+            If the cache can't be written ( ex. a read-only storage), the matrix is not cached.
+        """
+        snapshot = HoldingsSnapshot.from_holdings(
+            list(exposure_matrix.holdings),
+            metadata={
+                'name': name,
+                'fingerprint': fingerprint,
+                'names': exposure_matrix.names
+            }
+        )
+        snapshot.arrays['matrix.indptr'] = exposure_matrix.indptr
+        snapshot.arrays['matrix.indices'] = exposure_matrix.indices
+        snapshot.arrays['matrix.data'] = exposure_matrix.data
+
+        try:
+            self.save_entry(self.get_entry_path(fingerprint), snapshot)
+        except OSError as e:
+            print(f'Could not cache the leaves of {name}: {e}')
+
+    def invalidate(self) -> int:
+        entries = self.get_entries()
+        for entry in entries:
+            os.remove(str(entry))
+
+        return len(entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the caches of the parsed funds & of the leaves.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    invalidate_parser = subparsers.add_parser('invalidate', help='Remove cached funds.')
+    invalidate_parser.add_argument('--ticker', help='Remove only the entries of this ticker.')
+    invalidate_parser.add_argument('--source', help='Remove only the entries of this source ( ex. vanguard).')
+    invalidate_parser.add_argument('--leaves', action='store_true', help='Remove the cached leaves instead.')
+
+    subparsers.add_parser('info', help='Show the number of entries & the size of the caches.')
+
+    args = parser.parse_args()
+
+    if args.command == 'invalidate':
+        if args.leaves:
+            cache = LeavesCache()
+            num_entries = cache.invalidate()
+        else:
+            cache = FundCache()
+            num_entries = cache.invalidate(ticker=args.ticker, source=args.source)
+        print(f'Removed {num_entries} entries from {cache.path}')
+    elif args.command == 'info':
+        for cache in (FundCache(), LeavesCache()):
+            print(f'{cache.path}: {len(cache.get_entries())} entries, {cache.size() / 2 ** 20:.2f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,10 @@
 import os
 from typing import Optional
 
+from src import settings
+from src.disk.caches import FundCache
 from src.factories import create_etf_from_vanguard
 from src.instruments import ETF
-from src.settings import FILES_DIR
 
 
 def get_from_disk(source: str):
@@ -21,7 +22,7 @@ def get_etf_vanguard(ticker: str) -> Optional[ETF]:
 
     ticker = ticker.upper()
     file_path = get_paths()['funds']['vanguard'][ticker]
-    file_path = os.path.abspath(os.path.join(FILES_DIR, file_path))
+    file_path = os.path.abspath(os.path.join(settings.FILES_DIR, file_path))
 
-    return create_etf_from_vanguard(ticker, file_path)
+    return FundCache().get_or_create(ticker, 'vanguard', file_path, create_etf_from_vanguard)
 
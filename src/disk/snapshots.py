@@ -0,0 +1,293 @@
+import json
+import os
+import struct
+import threading
+import zlib
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from src.exceptions import SnapshotError
+from src.instruments import Holding
+from src.utils import intern_string
+
+"""
+    A holdings snapshot is a binary, columnar & memory-mappable file:
+        - magic bytes, format version & the length of the JSON header
+        - the JSON header: number of rows, metadata & the position of every array
+        - the arrays, each one aligned to `ALIGNMENT` bytes
+
+    Every string column is dictionary encoded: an array of codes ( -1 for None), as narrow as the vocabulary allows,
+    & a vocabulary. The names, normalized names & tickers share the same vocabulary, because they overlap a lot.
+    A vocabulary is stored as one UTF-8 blob & the offsets of its strings. The rows are stored already normalized.
+
+    The vocabularies are zlib compressed, because they are decoded to python strings at load anyway. The codes are
+    stored raw, so they are memory-mapped.
+"""
+
+MAGIC = b'FPASNAP\x00'
+VERSION = 2
+ALIGNMENT = 64
+PREAMBLE = struct.Struct('<8sII')
+COMPRESSION_LEVEL = 6
+
+
+class HoldingsSnapshot(Sequence):
+    """
+        Read-only sequence of holdings backed by the snapshot arrays. The Holding objects are created only when
+        they are accessed.
+    """
+
+    STRING_COLUMNS = ('name', 'normalized_name', 'ticker', 'country', 'sector', 'currency', 'exchange', 'holding_type')
+    VOCABULARIES = {
+        'name': 'strings',
+        'normalized_name': 'strings',
+        'ticker': 'strings'
+    }
+
+    def __init__(self, arrays: Dict[str, np.ndarray], num_rows: int, metadata: Optional[dict] = None):
+        self.arrays = arrays
+        self.num_rows = num_rows
+        self.metadata = metadata or dict()
+
+        self._vocabularies: Dict[str, List[Optional[str]]] = dict()
+        self._holdings: List[Optional[Holding]] = [None] * num_rows
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def __getitem__(self, row: int) -> Holding:
+        if isinstance(row, slice):
+            return [self[i] for i in range(*row.indices(self.num_rows))]
+
+        holding = self._holdings[row]
+        if holding is None:
+            attributes = {column: self.get_value(column, row) for column in self.STRING_COLUMNS}
+            holding_type = attributes.pop('holding_type')
+            holding = Holding.from_normalized(
+                **attributes,
+                holding_type=Holding.normalizer.normalize_type(holding_type)
+            )
+            self._holdings[row] = holding
+
+        return holding
+
+    def __iter__(self):
+        """
+            Creates all the missing Holding objects at once, decoding the columns instead of every value.
+        """
+        if any(holding is None for holding in self._holdings):
+            columns = {column: self.get_column(column).tolist() for column in self.STRING_COLUMNS}
+            type_column = columns.pop('holding_type')
+            holding_types = {
+                holding_type: Holding.normalizer.normalize_type(holding_type) for holding_type in set(type_column)
+            }
+
+            for row in range(self.num_rows):
+                if self._holdings[row] is None:
+                    self._holdings[row] = Holding.from_normalized(
+                        **{column: values[row] for column, values in columns.items()},
+                        holding_type=holding_types[type_column[row]]
+                    )
+
+        return iter(self._holdings)
+
+    def get_value(self, column: str, row: int) -> Optional[str]:
+        code = self.arrays[f'{column}.codes'][row]
+
+        return self.get_vocabulary(self.VOCABULARIES.get(column, column))[code]
+
+    def get_column(self, column: str) -> np.ndarray:
+        vocabulary = np.array(self.get_vocabulary(self.VOCABULARIES.get(column, column)), dtype=object)
+
+        return vocabulary[self.arrays[f'{column}.codes']]
+
+    def get_vocabulary(self, name: str) -> List[Optional[str]]:
+        """
+            Returns the decoded vocabulary. The last item is None, so the code -1 is decoded to None.
+        """
+        vocabulary = self._vocabularies.get(name)
+        if vocabulary is None:
+            vocabulary = _decode_strings(
+                self.arrays[f'{name}.vocabulary.offsets'],
+                self.arrays[f'{name}.vocabulary.data']
+            )
+            vocabulary.append(None)
+            self._vocabularies[name] = vocabulary
+
+        return vocabulary
+
+    def get_expirations(self) -> Optional[np.ndarray]:
+        return self.arrays.get('expires_at')
+
+    def get_weights(self) -> Optional[np.ndarray]:
+        return self.arrays.get('weights')
+
+    @classmethod
+    def from_holdings(
+            cls,
+            holdings: List[Holding],
+            metadata: Optional[dict] = None,
+            expirations: Optional[List[float]] = None,
+            weights: Optional[List[float]] = None
+    ) -> 'HoldingsSnapshot':
+        """
+            expirations: the timestamp when each holding expires. It's optional.
+            weights: the weight of each holding in its financial instrument. It's optional.
+        """
+        arrays = dict()
+
+        columns_by_vocabulary = dict()
+        for column in cls.STRING_COLUMNS:
+            columns_by_vocabulary.setdefault(cls.VOCABULARIES.get(column, column), []).append(column)
+
+        for vocabulary_name, columns in columns_by_vocabulary.items():
+            codes_by_value = dict()
+            for column in columns:
+                values = [getattr(holding, column) for holding in holdings]
+                if column == 'holding_type':
+                    values = [value.value if value is not None else None for value in values]
+
+                arrays[f'{column}.codes'] = _encode_dictionary(values, codes_by_value)
+
+            for column in columns:
+                arrays[f'{column}.codes'] = _narrow_codes(arrays[f'{column}.codes'], len(codes_by_value))
+            arrays.update(_encode_strings(f'{vocabulary_name}.vocabulary', list(codes_by_value.keys())))
+
+        if expirations is not None:
+            assert len(expirations) == len(holdings)
+            arrays['expires_at'] = np.array(expirations, dtype=np.float64)
+
+        if weights is not None:
+            assert len(weights) == len(holdings)
+            arrays['weights'] = np.array(weights, dtype=np.float64)
+
+        return cls(arrays, num_rows=len(holdings), metadata=metadata)
+
+    def save(self, path: str):
+        """
+            Writes the snapshot atomically: to a temporary file, which replaces the old snapshot at the end.
+        """
+        arrays_header = dict()
+        buffers = []
+        offset = 0
+        for name, array in self.arrays.items():
+            array = np.ascontiguousarray(array)
+            buffer = array.tobytes()
+            compression = 'zlib' if '.vocabulary.' in name else None
+            if compression == 'zlib':
+                buffer = zlib.compress(buffer, COMPRESSION_LEVEL)
+
+            arrays_header[name] = {
+                'dtype': array.dtype.str,
+                'offset': offset,
+                'nbytes': len(buffer),
+                'compression': compression
+            }
+            buffers.append(buffer)
+            offset = _align(offset + len(buffer))
+
+        header = json.dumps({
+            'num_rows': self.num_rows,
+            'metadata': self.metadata,
+            'arrays': arrays_header
+        }).encode('utf-8')
+        data_start = _align(PREAMBLE.size + len(header))
+
+        # Unique per writer, so concurrent writers don't write the same temporary file.
+        temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'wb') as f:
+            f.write(PREAMBLE.pack(MAGIC, VERSION, len(header)))
+            f.write(header)
+            for array_header, buffer in zip(arrays_header.values(), buffers):
+                f.seek(data_start + array_header['offset'])
+                f.write(buffer)
+
+            f.truncate(data_start + offset)
+
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'HoldingsSnapshot':
+        """
+            Memory-maps the snapshot. The raw arrays are views over the mapped file, so they are read only when used.
+        """
+        if not Path(path).exists():
+            raise SnapshotError(path, 'the file does not exist')
+
+        with open(path, 'rb') as f:
+            preamble = f.read(PREAMBLE.size)
+            if len(preamble) < PREAMBLE.size:
+                raise SnapshotError(path, 'the file is truncated')
+
+            magic, version, header_length = PREAMBLE.unpack(preamble)
+            if magic != MAGIC:
+                raise SnapshotError(path, 'the file is not a holdings snapshot')
+            if version != VERSION:
+                raise SnapshotError(path, f'unsupported version {version}, expected {VERSION}')
+
+            header = json.loads(f.read(header_length).decode('utf-8'))
+
+        data_start = _align(PREAMBLE.size + header_length)
+        memory_map = np.memmap(path, dtype=np.uint8, mode='r')
+
+        arrays = dict()
+        for name, array_header in header['arrays'].items():
+            start = data_start + array_header['offset']
+            buffer = memory_map[start:start + array_header['nbytes']]
+            if array_header['compression'] == 'zlib':
+                buffer = np.frombuffer(zlib.decompress(buffer.tobytes()), dtype=np.uint8)
+
+            arrays[name] = buffer.view(np.dtype(array_header['dtype']))
+
+        return cls(arrays, num_rows=header['num_rows'], metadata=header['metadata'])
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _encode_dictionary(values: List[Optional[str]], codes_by_value: Dict[str, int]) -> np.ndarray:
+    """
+        Returns the codes of the values & adds the new values to `codes_by_value`.
+    """
+    codes = np.empty(len(values), dtype=np.int32)
+    for row, value in enumerate(values):
+        if value is None:
+            codes[row] = -1
+        else:
+            codes[row] = codes_by_value.setdefault(str(value), len(codes_by_value))
+
+    return codes
+
+
+def _narrow_codes(codes: np.ndarray, vocabulary_size: int) -> np.ndarray:
+    for dtype in (np.int8, np.int16, np.int32):
+        if vocabulary_size <= np.iinfo(dtype).max:
+            return codes.astype(dtype)
+
+    return codes
+
+
+def _encode_strings(name: str, values: List[str]) -> Dict[str, np.ndarray]:
+    encoded_values = [value.encode('utf-8') for value in values]
+
+    offsets = np.zeros(len(encoded_values) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(value) for value in encoded_values])
+
+    return {
+        f'{name}.offsets': offsets,
+        f'{name}.data': np.frombuffer(b''.join(encoded_values), dtype=np.uint8)
+    }
+
+
+def _decode_strings(offsets: np.ndarray, data: np.ndarray) -> List[str]:
+    data = data.tobytes()
+    offsets = offsets.tolist()
+
+    return [
+        intern_string(data[start:end].decode('utf-8'))
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
@@ -0,0 +1,328 @@
+import contextlib
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from src import settings, tracing
+from src.indexes import HoldingIndex, NAME_WORDS_IOU_THRESHOLD
+from src.instruments import Holding
+
+"""
+    The market data is stored in an embedded SQLite database, so a query reads only the rows it needs instead of
+    loading the whole market.
+
+    The database is in WAL mode: a refresh writes all the rows of a market & its timestamp in one transaction, while
+    the other processes keep reading the previous data until it is committed.
+"""
+
+
+class MarketStore:
+    """
+        The holdings of the markets, with the indexes used by `find`:
+            - the normalized tickers ( the only identifiers of the holdings)
+            - the first name word & the number of name words
+            - the other name words, by first name word
+
+        `find` returns the same holding as a `HoldingIndex` with the holdings of the market, in one query:
+            - the first holding with the same ticker
+            - the first holding with the same first name word & a name words IoU over the threshold, which is:
+                - any holding with few enough name words that the first word alone reaches the threshold
+                - or a holding that has enough of the other name words in common
+    """
+
+    # Bump it when the schema changes. The old data is dropped & fetched again.
+    SCHEMA_VERSION = 1
+    TIMEOUT = 30
+
+    COLUMNS = ('name', 'normalized_name', 'ticker', 'country', 'sector', 'currency', 'exchange', 'holding_type')
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS markets (
+            market TEXT PRIMARY KEY,
+            updated_at REAL
+        );
+        CREATE TABLE IF NOT EXISTS holdings (
+            market TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            name TEXT,
+            normalized_name TEXT NOT NULL,
+            ticker TEXT,
+            country TEXT,
+            sector TEXT,
+            currency TEXT,
+            exchange TEXT,
+            holding_type TEXT,
+            expires_at REAL NOT NULL,
+            ticker_key TEXT,
+            first_word TEXT NOT NULL,
+            num_words INTEGER NOT NULL,
+            PRIMARY KEY (market, position)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS holdings_by_ticker ON holdings (market, ticker_key, position);
+        CREATE INDEX IF NOT EXISTS holdings_by_first_word ON holdings (market, first_word, num_words, position);
+        CREATE TABLE IF NOT EXISTS name_words (
+            market TEXT NOT NULL,
+            first_word TEXT NOT NULL,
+            word TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (market, first_word, word, position)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS missing_tickers (
+            market TEXT NOT NULL,
+            ticker TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (market, ticker)
+        ) WITHOUT ROWID;
+    '''
+
+    def __init__(self, path: Optional[str] = None, name_words_iou_threshold: float = NAME_WORDS_IOU_THRESHOLD):
+        assert name_words_iou_threshold > 0
+
+        self.path = Path(path or Path(settings.STORAGE_PATH) / 'markets.sqlite3')
+        self.name_words_iou_threshold = name_words_iou_threshold
+
+        # The connections can't be shared between threads or with a forked process.
+        self.local = threading.local()
+
+    def get_connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = self._connect()
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+
+        return connection
+
+    def _connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        # The transactions are explicit.
+        connection = sqlite3.connect(str(self.path), timeout=self.TIMEOUT, isolation_level=None)
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = NORMAL')
+
+        # The schema is checked without the write lock, so a new reader doesn't wait for a refresh.
+        if self._get_schema_version(connection) != self.SCHEMA_VERSION:
+            with self._transaction(connection):
+                if self._get_schema_version(connection) != self.SCHEMA_VERSION:
+                    for table in ('markets', 'holdings', 'name_words', 'missing_tickers'):
+                        connection.execute(f'DROP TABLE IF EXISTS {table}')
+                    for statement in self.SCHEMA.split(';'):
+                        connection.execute(statement)
+                    connection.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+
+        return connection
+
+    @classmethod
+    def _get_schema_version(cls, connection: sqlite3.Connection) -> int:
+        return connection.execute('PRAGMA user_version').fetchone()[0]
+
+    @contextlib.contextmanager
+    def transaction(self, write: bool = False) -> Iterator[sqlite3.Connection]:
+        """
+            write: take the write lock right away. Otherwise, the transaction only reads a consistent view of the data.
+        """
+        with self._transaction(self.get_connection(), write=write) as connection:
+            yield connection
+
+    @classmethod
+    @contextlib.contextmanager
+    def _transaction(cls, connection: sqlite3.Connection, write: bool = True) -> Iterator[sqlite3.Connection]:
+        connection.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def has_market(self, market: str) -> bool:
+        row = self.get_connection().execute('SELECT 1 FROM markets WHERE market = ?', (market, )).fetchone()
+
+        return row is not None
+
+    def get_updated_at(self, market: str) -> Optional[float]:
+        row = self.get_connection().execute('SELECT updated_at FROM markets WHERE market = ?', (market, )).fetchone()
+
+        return row[0] if row is not None else None
+
+    def get_expiration_counts(self, market: str, now: float) -> Tuple[int, int]:
+        """
+            Returns the number of holdings & missing tickers of the market that expired by `now` & their total number.
+        """
+        row = self.get_connection().execute(
+            '''
+                SELECT COALESCE(SUM(expires_at <= :now), 0), COUNT(*) FROM (
+                    SELECT expires_at FROM holdings WHERE market = :market
+                    UNION ALL
+                    SELECT expires_at FROM missing_tickers WHERE market = :market
+                )
+            ''',
+            {'market': market, 'now': now}
+        ).fetchone()
+
+        return row[0], row[1]
+
+    def get_rows(self, market: str) -> List[tuple]:
+        """
+            Returns the rows of the market in order, with the `COLUMNS` & the expiration timestamp.
+        """
+        return self.get_connection().execute(
+            f'SELECT {", ".join(self.COLUMNS)}, expires_at FROM holdings WHERE market = ? ORDER BY position',
+            (market, )
+        ).fetchall()
+
+    def get_missing_tickers(self, market: str) -> Dict[str, float]:
+        rows = self.get_connection().execute(
+            'SELECT ticker, expires_at FROM missing_tickers WHERE market = ?',
+            (market, )
+        ).fetchall()
+
+        return dict(rows)
+
+    def count(self, market: str) -> int:
+        return self.get_connection().execute('SELECT COUNT(*) FROM holdings WHERE market = ?', (market, )).fetchone()[0]
+
+    @tracing.traced('market_store.replace')
+    def replace(
+            self,
+            market: str,
+            rows: Iterable[tuple],
+            missing_tickers: Dict[str, float],
+            updated_at: Optional[float]
+    ):
+        """
+            Replaces all the data of the market in one transaction.
+            rows: the `COLUMNS` & the expiration timestamp of every holding, in order.
+        """
+        holdings_rows = []
+        name_words_rows = []
+        for position, row in enumerate(rows):
+            normalized_name = row[1]
+            name_words, first_word = Holding.get_name_words(normalized_name)
+
+            holdings_rows.append((
+                market,
+                position,
+                *row,
+                HoldingIndex.normalize_ticker(row[2]),
+                first_word,
+                len(name_words)
+            ))
+            name_words_rows.extend((market, first_word, word, position) for word in name_words if word != first_word)
+
+        with self.transaction(write=True) as connection:
+            for table in ('holdings', 'name_words', 'missing_tickers'):
+                connection.execute(f'DELETE FROM {table} WHERE market = ?', (market, ))
+
+            connection.executemany(
+                f'''
+                    INSERT INTO holdings (market, position, {", ".join(self.COLUMNS)}, expires_at, ticker_key,
+                        first_word, num_words)
+                    VALUES ({", ".join(["?"] * (len(self.COLUMNS) + 6))})
+                ''',
+                holdings_rows
+            )
+            connection.executemany('INSERT INTO name_words VALUES (?, ?, ?, ?)', name_words_rows)
+            connection.executemany(
+                'INSERT INTO missing_tickers VALUES (?, ?, ?)',
+                [(market, ticker, expires_at) for ticker, expires_at in missing_tickers.items()]
+            )
+            connection.execute(
+                'INSERT OR REPLACE INTO markets (market, updated_at) VALUES (?, ?)',
+                (market, updated_at)
+            )
+
+    def find(self, market: str, holding: Holding) -> Optional[Holding]:
+        return self.find_many(market, [holding])[0]
+
+    def find_many(self, market: str, holdings: List[Holding]) -> List[Optional[Holding]]:
+        """
+            The holdings are found in one read transaction, so all of them are found in the same data.
+        """
+        found_holdings = []
+        with self.transaction() as connection:
+            for holding in holdings:
+                statement, parameters = self._get_find_statement(market, holding)
+                row = connection.execute(statement, parameters).fetchone()
+                found_holdings.append(self.to_holding(row) if row is not None else None)
+
+        tracing.count('market_store.lookups', len(holdings))
+
+        return found_holdings
+
+    def _get_find_statement(self, market: str, holding: Holding) -> Tuple[str, dict]:
+        words = holding.name_words
+        first_word = holding.first_name_word
+        other_words = sorted(word for word in words if word != first_word)
+
+        parameters = {
+            'market': market,
+            'ticker_key': HoldingIndex.normalize_ticker(holding.ticker),
+            'first_word': first_word,
+            'num_words': len(words),
+            'max_num_words': self._get_max_num_words(len(words)),
+            'threshold': self.name_words_iou_threshold
+        }
+        queries = ['SELECT MIN(position) AS position FROM holdings WHERE market = :market AND ticker_key = :ticker_key']
+        if parameters['max_num_words'] > 0:
+            # Without the index, the first holding is searched by position, through all the holdings of the market.
+            queries.append('''
+                SELECT MIN(position) FROM holdings INDEXED BY holdings_by_first_word
+                WHERE market = :market AND first_word = :first_word AND num_words <= :max_num_words
+                    AND (:ticker_key IS NULL OR ticker_key IS NULL)
+            ''')
+        if len(other_words) > 0:
+            parameters.update({f'word_{i}': word for i, word in enumerate(other_words)})
+            # The first word is common, so it is added to the count of the common words.
+            queries.append(f'''
+                SELECT name_words.position FROM name_words
+                JOIN holdings ON holdings.market = name_words.market AND holdings.position = name_words.position
+                WHERE name_words.market = :market AND name_words.first_word = :first_word
+                    AND name_words.word IN ({", ".join(f":word_{i}" for i in range(len(other_words)))})
+                    AND (:ticker_key IS NULL OR holdings.ticker_key IS NULL)
+                GROUP BY name_words.position
+                HAVING CAST(COUNT(*) + 1 AS REAL) / (:num_words + MAX(holdings.num_words) - COUNT(*) - 1) >= :threshold
+            ''')
+
+        statement = f'''
+            SELECT {", ".join(self.COLUMNS)} FROM holdings
+            WHERE market = :market AND position = (SELECT MIN(position) FROM ({" UNION ALL ".join(queries)}))
+        '''
+
+        return statement, parameters
+
+    def _get_max_num_words(self, num_words: int) -> int:
+        """
+            Returns the max number of name words of a holding for which only the first word in common reaches the
+            threshold ( 0 if there is none).
+        """
+        max_num_words = 0
+        while 1 / (num_words + max_num_words) >= self.name_words_iou_threshold:
+            max_num_words += 1
+
+        return max_num_words
+
+    @classmethod
+    def to_row(cls, holding: Holding, expires_at: float) -> tuple:
+        holding_type = holding.holding_type.value if holding.holding_type is not None else None
+
+        return (
+            holding.name,
+            holding.normalized_name,
+            holding.ticker,
+            holding.country,
+            holding.sector,
+            holding.currency,
+            holding.exchange,
+            holding_type,
+            expires_at
+        )
+
+    @classmethod
+    def to_holding(cls, row: tuple) -> Holding:
+        attributes = dict(zip(cls.COLUMNS, row))
+        holding_type = attributes.pop('holding_type')
+
+        return Holding.from_normalized(**attributes, holding_type=Holding.normalizer.normalize_type(holding_type))
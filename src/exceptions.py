@@ -1,3 +1,23 @@
 class DownloadError(RuntimeError):
     def __init__(self, resource):
         super().__init__(f'Could not download resource: {resource}')
+
+
+class SnapshotError(RuntimeError):
+    def __init__(self, path, reason: str):
+        super().__init__(f'Could not load snapshot {path}: {reason}')
+
+
+class DecompositionError(RuntimeError):
+    def __init__(self, path, reason: str):
+        super().__init__(f'Could not decompose {" -> ".join(path)}: {reason}')
+
+
+class ManifestError(RuntimeError):
+    def __init__(self, path, reason: str):
+        super().__init__(f'Invalid manifest {path}: {reason}')
+
+
+class QuoteError(RuntimeError):
+    def __init__(self, ticker, reason: str):
+        super().__init__(f'Could not get the quote of {ticker}: {reason}')
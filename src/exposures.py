@@ -0,0 +1,267 @@
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src import tracing
+from src.tables import HoldingsTable
+
+if TYPE_CHECKING:
+    # Imported at runtime only by the methods that use them, to avoid a circular import.
+    from src.instruments import FinancialInstrument, MultipleItemsFinancialInstrument
+
+
+class ExposureCube:
+    """
+        The weights of the holdings grouped by any combination of their attributes ( ex. the exposure by country, or a
+        country x sector pivot).
+
+        Every dimension is factorized once, when the cube is created: the values of a column are replaced by integer
+        codes. A query combines the codes of its dimensions into one group code per holding & sums the weights of every
+        group with `np.bincount`, so it is one vectorized pass over the holdings.
+        The groups are sorted by weight, descending. The groups with the same weight keep the order in which they first
+        appear in the holdings. A missing value ( ex. an unknown country) is a group of its own, with the value None.
+    """
+
+    DIMENSIONS = ('country', 'sector', 'currency', 'exchange', 'holding_type')
+
+    def __init__(self, table: HoldingsTable, dimensions: Sequence[str] = DIMENSIONS):
+        self.dimensions = tuple(dimensions)
+        self.weights = np.array(table.weights, dtype=float)
+
+        self.codes: Dict[str, np.ndarray] = dict()
+        self.values: Dict[str, np.ndarray] = dict()
+        with tracing.span('exposures.factorize', holdings=len(table)):
+            for dimension in self.dimensions:
+                self.codes[dimension], self.values[dimension] = self.factorize(table.column(dimension))
+
+    def __len__(self) -> int:
+        return len(self.weights)
+
+    @classmethod
+    def factorize(cls, column: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+            The missing values are coded as one more value, None.
+        """
+        codes, values = pd.factorize(column)
+        codes = codes.astype(np.int64)
+        values = np.asarray(values, dtype=object)
+
+        # pd.factorize codes the missing values as -1.
+        is_missing = codes == -1
+        if is_missing.any():
+            codes[is_missing] = len(values)
+            values = np.append(values, None)
+
+        return codes, values
+
+    def get(self, *dimensions: str) -> pd.DataFrame:
+        """
+            Returns the exposure of every combination of values of the dimensions, as a data frame with a column for
+            every dimension & a 'weight' column.
+        """
+        group_codes, first_rows = self._group(dimensions)
+        weights = np.bincount(group_codes, weights=self.weights, minlength=len(first_rows))
+
+        # The columns are kept as objects, so the missing values stay None.
+        data = {
+            dimension: pd.Series(self.values[dimension][self.codes[dimension][first_rows]], dtype=object)
+            for dimension in dimensions
+        }
+        data['weight'] = weights
+        exposures = pd.DataFrame(data)
+
+        order = np.argsort(-weights, kind='stable')
+
+        return exposures.iloc[order].reset_index(drop=True)
+
+    def pivot(self, index: str, columns: str) -> pd.DataFrame:
+        """
+            Returns the exposure of every pair of values of the two dimensions ( ex. country x sector), as a data frame.
+            The rows & the columns are sorted by their total weight, descending. The missing pairs have a weight of 0.
+        """
+        self._check_dimensions((index, columns))
+
+        index_codes = self.codes[index]
+        columns_codes = self.codes[columns]
+        num_index = len(self.values[index])
+        num_columns = len(self.values[columns])
+
+        weights = np.bincount(
+            index_codes * num_columns + columns_codes,
+            weights=self.weights,
+            minlength=num_index * num_columns
+        ).reshape(num_index, num_columns)
+
+        index_order = np.argsort(-weights.sum(axis=1), kind='stable')
+        columns_order = np.argsort(-weights.sum(axis=0), kind='stable')
+
+        return pd.DataFrame(
+            weights[np.ix_(index_order, columns_order)],
+            index=pd.Index(self.values[index][index_order], dtype=object, name=index),
+            columns=pd.Index(self.values[columns][columns_order], dtype=object, name=columns)
+        )
+
+    def to_series(self, dimensions: Optional[Sequence[str]] = None) -> pd.Series:
+        """
+            Returns the exposures indexed by the values of the dimensions. Defaults to all the dimensions of the cube.
+        """
+        dimensions = tuple(dimensions or self.dimensions)
+        exposures = self.get(*dimensions)
+
+        return exposures.set_index(list(dimensions))['weight']
+
+    def _group(self, dimensions: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+            Returns the group of every holding & the first holding of every group.
+        """
+        self._check_dimensions(dimensions)
+
+        combined_codes = np.zeros(len(self), dtype=np.int64)
+        for dimension in dimensions:
+            # The codes are renumbered after every dimension, so the combined codes stay smaller than the holdings.
+            combined_codes = combined_codes * len(self.values[dimension]) + self.codes[dimension]
+            combined_codes, _ = pd.factorize(combined_codes)
+
+        _, first_rows = np.unique(combined_codes, return_index=True)
+
+        return combined_codes, first_rows
+
+    def _check_dimensions(self, dimensions: Sequence[str]):
+        assert len(dimensions) > 0, 'At least one dimension is required.'
+
+        for dimension in dimensions:
+            assert dimension in self.codes, f'The cube has no dimension {dimension}: {self.dimensions}'
+
+
+class ExposureMatrix:
+    """
+        Sparse matrix of the exposures of financial instruments ( the rows, ex. funds) to holdings ( the columns).
+        The columns are a vocabulary of canonical holdings: the holdings of all the rows, merged like in
+        `MultipleItemsFinancialInstrument`, so the same company held by multiple funds is one column.
+        The matrix is stored in CSR format: the columns of the row `i` are `indices[indptr[i]:indptr[i + 1]]`, with
+        the weights `data[indptr[i]:indptr[i + 1]]`.
+
+        The holdings are matched only once, when the matrix is built. Combining the rows with some weights ( ex. the
+        weights of the funds in a portfolio) is a sparse matrix-vector product. The products are added in the order of
+        the rows, like when the holdings are merged one by one, so the weights are the same as the merged ones.
+    """
+
+    def __init__(
+            self,
+            holdings: Sequence,
+            indptr: np.ndarray,
+            indices: np.ndarray,
+            data: np.ndarray,
+            names: Optional[List[str]] = None
+    ):
+        assert len(indptr) > 0 and indptr[-1] == len(indices) == len(data)
+        assert names is None or len(names) == len(indptr) - 1
+
+        self.holdings = holdings
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.data = np.asarray(data, dtype=float)
+        self.names = names
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self.indptr) - 1, len(self.holdings)
+
+    @classmethod
+    def from_vectors(
+            cls,
+            holdings: Sequence,
+            vectors: List[Tuple[Sequence[int], Sequence[float]]],
+            names: Optional[List[str]] = None
+    ) -> 'ExposureMatrix':
+        """
+            vectors: the columns & the weights of every row.
+        """
+        indptr = np.zeros(len(vectors) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(columns) for columns, _ in vectors])
+
+        indices = np.zeros(indptr[-1], dtype=np.int64)
+        data = np.zeros(indptr[-1], dtype=float)
+        for (columns, weights), start, end in zip(vectors, indptr[:-1], indptr[1:]):
+            indices[start:end] = columns
+            data[start:end] = weights
+
+        return cls(holdings, indptr, indices, data, names=names)
+
+    @classmethod
+    @tracing.traced('exposure_matrix.build')
+    def from_instruments(cls, instruments: Iterable[Tuple[str, 'FinancialInstrument']]) -> 'ExposureMatrix':
+        """
+            Builds the matrix of the instruments, one row per instrument, over the merged holdings of all of them.
+        """
+        from src.instruments import MultipleItemsFinancialInstrument
+
+        vocabulary = MultipleItemsFinancialInstrument('Holdings')
+
+        names = []
+        vectors = []
+        for name, instrument in instruments:
+            names.append(name)
+            vectors.append((vocabulary.merge_holdings(instrument.get_holdings()), instrument.get_weights()))
+
+        return cls.from_vectors(vocabulary.get_holdings(), vectors, names=names)
+
+    def matvec(self, weights: Sequence[float]) -> np.ndarray:
+        """
+            Returns the weights of the holdings, for the given weights of the rows.
+        """
+        weights = np.asarray(weights, dtype=float)
+        assert len(weights) == self.shape[0], 'There has to be a weight for every row.'
+
+        row_weights = np.repeat(weights, np.diff(self.indptr))
+
+        return np.bincount(self.indices, weights=row_weights * self.data, minlength=self.shape[1])
+
+    def to_instrument(self, name: str, weights: Sequence[float]) -> 'MultipleItemsFinancialInstrument':
+        """
+            Combines the rows with the weights into a financial instrument with all the holdings of the matrix.
+        """
+        from src.instruments import MultipleItemsFinancialInstrument
+
+        return MultipleItemsFinancialInstrument.from_holdings_weights(name, self.holdings, self.matvec(weights))
+
+    def select(self, rows: Sequence[int]) -> 'ExposureMatrix':
+        """
+            Returns the matrix of the given rows, with only the holdings they are exposed to.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.indptr[rows]
+        ends = self.indptr[rows + 1]
+
+        entries = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)]) if len(rows) > 0 else \
+            np.zeros(0, dtype=np.int64)
+        columns, indices = np.unique(self.indices[entries], return_inverse=True)
+
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(ends - starts)
+
+        return ExposureMatrix(
+            [self.holdings[column] for column in columns.tolist()],
+            indptr,
+            indices.reshape(-1),
+            self.data[entries],
+            names=[self.names[row] for row in rows.tolist()] if self.names is not None else None
+        )
+
+    def to_dense(self) -> np.ndarray:
+        dense = np.zeros(self.shape, dtype=float)
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        np.add.at(dense, (rows, self.indices), self.data)
+
+        return dense
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+            Returns the dense matrix, with the names of the rows as the index & the holdings as the columns.
+        """
+        return pd.DataFrame(
+            self.to_dense(),
+            index=pd.Index(self.names if self.names is not None else range(self.shape[0]), dtype=object),
+            columns=pd.Index([str(holding) for holding in self.holdings], dtype=object)
+        )
@@ -1,12 +1,12 @@
-import os
-from pathlib import Path
-from typing import List
+from typing import Dict, List
 
-from src.instruments import Holding, ETF, MultipleItemsFinancialInstrument
-from src.normalizers.file import normalize_ishares_csv_file, normalize_spdr_excel_file, normalize_vanguard_csv_file
 import pandas as pd
 
-from src.normalizers.structures import normalize_google_sheets_list
+from src import tracing
+from src.instruments import Holding, ETF, MultipleItemsFinancialInstrument
+from src.normalizers.file import FileSource, normalize_ishares_csv_file, normalize_spdr_excel_file, \
+    normalize_vanguard_csv_file
+from src.normalizers.structures import normalize_google_sheets_list, normalize_holdings_data_frame
 
 
 def get_factory(source: str):
@@ -19,152 +19,139 @@ def get_factory(source: str):
     }[source]
 
 
-def create_etf_from_vanguard(etf_name: str, path_to_file: str) -> ETF:
-    def extract_from_field(field: str):
-        if '=' in field:
-            return field[2:-2]
-        else:
-            return field
+def parse_weights(column: pd.Series) -> pd.Series:
+    """
+        Parses a percentage column in one vectorized pass. Values that can't be parsed get a weight of 0.
+    """
+    return pd.to_numeric(column, errors='coerce').fillna(0.) / 100
 
-    path_to_file = normalize_vanguard_csv_file(path_to_file)
 
-    etf = ETF(etf_name)
-    data_frame = pd.read_csv(path_to_file)
-    for index, pandas_holding in data_frame.iterrows():
-        try:
-            weight = float(extract_from_field(pandas_holding['% of funds']))
-        except TypeError:
-            weight = -1
+def load_holdings(
+        instrument: MultipleItemsFinancialInstrument,
+        data_frame: pd.DataFrame,
+        weights: pd.Series,
+        columns: Dict[str, str]
+) -> MultipleItemsFinancialInstrument:
+    """
+        columns: mapping between the Holding attributes & the data frame columns.
 
-        if weight > 0:
-            holding = Holding(
-                name=extract_from_field(pandas_holding['Holding name']),
-            )
+        Only the rows with a positive weight are kept. Their attributes are normalized in batch & the Holding objects
+        are built only for them, at the end.
+    """
+    is_valid = weights > 0
+    weights = weights[is_valid].to_numpy(dtype=float)
 
-            etf.add_holding_weight(
-                holding, weight / 100
-            )
+    attributes = data_frame.loc[is_valid, list(columns.values())]
+    attributes.columns = list(columns.keys())
+    attributes = normalize_holdings_data_frame(attributes)
 
-    etf.assert_holdings_summed_value()
-    if Path(path_to_file).exists():
-        os.remove(path_to_file)
+    holdings = [
+        Holding.from_normalized(**dict(zip(attributes.columns, values)))
+        for values in attributes.itertuples(index=False, name=None)
+    ]
+    instrument.add_holdings_weights(holdings, weights)
 
-    return etf
+    return instrument
 
 
-def create_etf_from_ishares_csv(etf_name: str, path_to_file: str) -> ETF:
-    path_to_file = normalize_ishares_csv_file(path_to_file)
+@tracing.traced('parse.vanguard')
+def create_etf_from_vanguard(etf_name: str, path_to_file: FileSource) -> ETF:
+    def extract_from_field(column: pd.Series) -> pd.Series:
+        column = column.astype(str)
+
+        return column.where(~column.str.contains('=', regex=False), column.str[2:-2])
+
+    data_frame = pd.read_csv(normalize_vanguard_csv_file(path_to_file), dtype=str)
+    data_frame['Holding name'] = extract_from_field(data_frame['Holding name'])
+    weights = parse_weights(extract_from_field(data_frame['% of funds']))
 
     etf = ETF(etf_name)
-    data_frame = pd.read_csv(path_to_file)
-    for index, pandas_holding in data_frame.iterrows():
-        try:
-            valid_holding = float(pandas_holding['Weight (%)']) > 0.
-        except ValueError:
-            valid_holding = False
-
-        if valid_holding:
-            holding = Holding(
-                name=pandas_holding['Name'],
-                ticker=pandas_holding.get('Issuer Ticker') or pandas_holding.get('Ticker'),
-                country=pandas_holding['Location'],
-                exchange=pandas_holding['Exchange'],
-                sector=pandas_holding['Sector'],
-                currency=pandas_holding['Market Currency']
-            )
-
-            etf.add_holding_weight(
-                holding, float(pandas_holding['Weight (%)']) / 100
-            )
+    load_holdings(etf, data_frame, weights, columns={'name': 'Holding name'})
 
     etf.assert_holdings_summed_value()
-    if Path(path_to_file).exists():
-        os.remove(path_to_file)
 
     return etf
 
 
-def create_etf_from_spdr_excel(etf_name: str, path_to_file: str) -> ETF:
-    path_to_file = normalize_spdr_excel_file(path_to_file)
+@tracing.traced('parse.ishares')
+def create_etf_from_ishares_csv(etf_name: str, path_to_file: FileSource) -> ETF:
+    data_frame = pd.read_csv(normalize_ishares_csv_file(path_to_file))
+    if 'Issuer Ticker' in data_frame.columns:
+        issuer_tickers = data_frame['Issuer Ticker']
+        if 'Ticker' in data_frame.columns:
+            issuer_tickers = issuer_tickers.fillna(data_frame['Ticker'])
+        data_frame['Ticker'] = issuer_tickers
+    elif 'Ticker' not in data_frame.columns:
+        data_frame['Ticker'] = None
+    weights = parse_weights(data_frame['Weight (%)'])
 
     etf = ETF(etf_name)
-    data_frame = pd.read_csv(path_to_file)
-    for index, pandas_holding in data_frame.iterrows():
-        try:
-            valid_holding = float(pandas_holding['Percent Of Fund']) > 0.
-        except ValueError:
-            valid_holding = False
-
-        if valid_holding:
-            holding = Holding(
-                name=pandas_holding['Security Name'],
-                country=pandas_holding['Trade Country Name'],
-                sector=pandas_holding['Sector Classification'],
-                currency=pandas_holding['Currency']
-            )
-
-            etf.add_holding_weight(
-                holding, float(pandas_holding['Percent Of Fund']) / 100
-            )
+    load_holdings(etf, data_frame, weights, columns={
+        'name': 'Name',
+        'ticker': 'Ticker',
+        'country': 'Location',
+        'exchange': 'Exchange',
+        'sector': 'Sector',
+        'currency': 'Market Currency'
+    })
 
     etf.assert_holdings_summed_value()
-    if Path(path_to_file).exists():
-        os.remove(path_to_file)
 
     return etf
 
 
-def create_etf_from_custom_csv(etf_name: str, path_to_file: str) -> ETF:
+@tracing.traced('parse.spdr')
+def create_etf_from_spdr_excel(etf_name: str, path_to_file: FileSource) -> ETF:
+    data_frame = pd.read_csv(normalize_spdr_excel_file(path_to_file))
+    weights = parse_weights(data_frame['Percent Of Fund'])
+
     etf = ETF(etf_name)
+    load_holdings(etf, data_frame, weights, columns={
+        'name': 'Security Name',
+        'country': 'Trade Country Name',
+        'sector': 'Sector Classification',
+        'currency': 'Currency'
+    })
 
+    etf.assert_holdings_summed_value()
+
+    return etf
+
+
+@tracing.traced('parse.custom')
+def create_etf_from_custom_csv(etf_name: str, path_to_file: FileSource) -> ETF:
     data_frame = pd.read_csv(path_to_file)
-    for index, pandas_holding in data_frame.iterrows():
-        try:
-            valid_holding = float(pandas_holding['Actual Percentage (%)']) > 0.
-        except ValueError:
-            valid_holding = False
-
-        if valid_holding:
-            holding = Holding(
-                name=pandas_holding['Company'],
-                ticker=pandas_holding['Ticker'],
-                country=pandas_holding['Region'],
-                sector=pandas_holding['Domain'],
-            )
-
-            etf.add_holding_weight(
-                holding, float(pandas_holding['Actual Percentage (%)']) / 100
-            )
+    weights = parse_weights(data_frame['Actual Percentage (%)'])
+
+    etf = ETF(etf_name)
+    load_holdings(etf, data_frame, weights, columns={
+        'name': 'Company',
+        'ticker': 'Ticker',
+        'country': 'Region',
+        'sector': 'Domain'
+    })
 
     etf.assert_holdings_summed_value()
 
     return etf
 
 
+@tracing.traced('parse.google_sheets')
 def create_portfolio_google_sheets(name: str, data: List[list]) -> MultipleItemsFinancialInstrument:
     data = normalize_google_sheets_list(data)
 
-    financial_instrument = MultipleItemsFinancialInstrument(name)
     data_frame = pd.DataFrame(data[1:], columns=data[0])
-    for _, pandas_holding in data_frame.iterrows():
-        try:
-            weight = float(pandas_holding['Ideal Percentage']) / 100
-        except ValueError:
-            try:
-                # Try to remove '%'.
-                weight = float(pandas_holding['Ideal Percentage'][:-1]) / 100
-            except ValueError:
-                weight = 0
-
-        is_valid = weight > 0
-
-        if is_valid:
-            holding = Holding(
-                name=pandas_holding['Name'],
-                ticker=pandas_holding['Ticker'],
-                holding_type=pandas_holding['Type']
-            )
-
-            financial_instrument.add_holding_weight(holding, weight)
+    percentages = data_frame['Ideal Percentage'].astype(str)
+    # Try to remove '%' from the values that are not plain numbers.
+    weights = parse_weights(
+        pd.to_numeric(percentages, errors='coerce').fillna(pd.to_numeric(percentages.str[:-1], errors='coerce'))
+    )
+
+    financial_instrument = MultipleItemsFinancialInstrument(name)
+    load_holdings(financial_instrument, data_frame, weights, columns={
+        'name': 'Name',
+        'ticker': 'Ticker',
+        'holding_type': 'Type'
+    })
 
     return financial_instrument
@@ -0,0 +1,171 @@
+import math
+from collections import defaultdict
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from src import tracing
+
+NAME_WORDS_IOU_THRESHOLD = 0.6
+
+
+class HoldingIndex:
+    """
+        Index that finds the first added holding that is equal to a given one, with the same rules as `Holding.__eq__`:
+            - if both holdings have a ticker, the tickers have to match
+            - otherwise, the first name words have to match & the IoU of the name words has to be over the threshold
+
+        Instead of probing every holding that starts with the same word, the lookup goes through:
+            - an exact ticker map
+            - an inverted index from (first name word, name word) to holdings, used to shortlist the holdings that can
+                reach the IoU threshold: a holding with `n` name words needs at least `ceil(threshold * n)` common words,
+                so it has to contain at least one of the rarest `n - ceil(threshold * n) + 1` words of the probe
+            - blocks of (first name word, number of name words), used for the names that are too short to be shortlisted
+        Small groups of holdings with the same first name word are scanned directly, because it is cheaper.
+    """
+
+    MAX_SCANNED_GROUP_SIZE = 16
+
+    def __init__(self, name_words_iou_threshold: float = NAME_WORDS_IOU_THRESHOLD):
+        self.name_words_iou_threshold = name_words_iou_threshold
+
+        self._tickers: Dict[str, List[int]] = defaultdict(list)
+        self._first_words: Dict[str, List[int]] = defaultdict(list)
+        self._words: Dict[Tuple[str, str], Set[int]] = defaultdict(set)
+        self._blocks: Dict[Tuple[str, int], List[int]] = defaultdict(list)
+
+        self._entries_words: List[Tuple[str, ...]] = []
+        self._entries_first_word: List[str] = []
+        self._entries_ticker: List[Optional[str]] = []
+
+    def __len__(self) -> int:
+        return len(self._entries_words)
+
+    def add(self, holding) -> int:
+        """
+            Returns the id of the added holding. The ids are consecutive, starting from 0.
+        """
+        return self.add_entry(
+            self.get_name_words(holding),
+            self.get_first_name_word(holding),
+            holding.ticker
+        )
+
+    def add_entry(self, name_words: Tuple[str, ...], first_name_word: str, ticker: Optional[str]) -> int:
+        """
+            Adds a holding from its already tokenized name.
+            name_words: the distinct name words.
+        """
+        entry_id = len(self._entries_words)
+
+        self._entries_words.append(name_words)
+        self._entries_first_word.append(first_name_word)
+        self._entries_ticker.append(None)
+
+        self._first_words[first_name_word].append(entry_id)
+        for word in name_words:
+            if word != first_name_word:
+                self._words[(first_name_word, word)].add(entry_id)
+        self._blocks[(first_name_word, len(name_words))].append(entry_id)
+        self.update_ticker(entry_id, ticker)
+
+        return entry_id
+
+    def update(self, entry_id: int, holding):
+        """
+            Refreshes the ticker of an entry. The name of a holding never changes, so the name indexes are kept.
+        """
+        self.update_ticker(entry_id, holding.ticker)
+
+    def update_ticker(self, entry_id: int, ticker: Optional[str]):
+        old_ticker = self._entries_ticker[entry_id]
+        new_ticker = self.normalize_ticker(ticker)
+        if old_ticker == new_ticker:
+            return
+
+        if old_ticker is not None:
+            self._tickers[old_ticker].remove(entry_id)
+        if new_ticker is not None:
+            self._tickers[new_ticker].append(entry_id)
+            self._tickers[new_ticker].sort()
+
+        self._entries_ticker[entry_id] = new_ticker
+
+    def find(self, holding) -> Optional[int]:
+        """
+            Returns the id of the first added holding that is equal to the given one or None.
+        """
+        ticker = self.normalize_ticker(holding.ticker)
+        words = frozenset(self.get_name_words(holding))
+        first_word = self.get_first_name_word(holding)
+
+        matches = []
+        if ticker is not None:
+            matches.extend(self._tickers.get(ticker, [])[:1])
+
+        num_comparisons = 0
+        for entry_id in self._get_name_candidates(words, first_word):
+            if ticker is not None and self._entries_ticker[entry_id] is not None:
+                continue
+
+            entry_words = self._entries_words[entry_id]
+            num_common_words = len(words.intersection(entry_words))
+            iou = num_common_words / (len(words) + len(entry_words) - num_common_words)
+            num_comparisons += 1
+            if iou >= self.name_words_iou_threshold:
+                matches.append(entry_id)
+
+        tracing.count('index.lookups')
+        tracing.count('index.comparisons', num_comparisons)
+
+        if len(matches) == 0:
+            return None
+
+        return min(matches)
+
+    def _get_name_candidates(self, words: FrozenSet[str], first_word: str) -> Iterable[int]:
+        group = self._first_words.get(first_word, [])
+        if len(group) <= self.MAX_SCANNED_GROUP_SIZE:
+            return group
+
+        num_words = len(words)
+        min_num_words = math.ceil(self.name_words_iou_threshold * num_words - 1e-9)
+        max_num_words = math.floor(num_words / self.name_words_iou_threshold + 1e-9)
+
+        # The first word is always common, so only the other ones have to be looked up.
+        other_words = words - {first_word}
+        min_common_other_words = min_num_words - 1
+        if min_common_other_words <= 0 or len(other_words) == 0:
+            candidates = set()
+            for num_words in range(min_num_words, max_num_words + 1):
+                candidates.update(self._blocks.get((first_word, num_words), []))
+
+            return candidates
+
+        prefix_length = len(other_words) - min_common_other_words + 1
+        postings = sorted(
+            (self._words.get((first_word, word), ()) for word in other_words),
+            key=len
+        )
+
+        candidates = set()
+        for posting in postings[:prefix_length]:
+            candidates.update(posting)
+
+        return {
+            entry_id for entry_id in candidates
+            if min_num_words <= len(self._entries_words[entry_id]) <= max_num_words
+        }
+
+    @classmethod
+    def get_name_words(cls, holding) -> Tuple[str, ...]:
+        return holding.name_words
+
+    @classmethod
+    def get_first_name_word(cls, holding) -> str:
+        return holding.first_name_word
+
+    @classmethod
+    def normalize_ticker(cls, ticker) -> Optional[str]:
+        if not ticker:
+            return None
+
+        return str(ticker).upper()
@@ -1,15 +1,59 @@
-from collections import OrderedDict
-from typing import List, Tuple, Union, Optional
+import concurrent.futures
+import functools
+import hashlib
+from typing import TYPE_CHECKING, List, Tuple, Union, Optional, Iterable, Dict, Sequence
 
+import numpy as np
+import pandas as pd
 import tqdm
 
+from src import settings, tracing
 from src.choices import HoldingTypeChoices
-from src.network.managers import GoogleSheetsManager
+from src.exceptions import DecompositionError
+from src.indexes import HoldingIndex, NAME_WORDS_IOU_THRESHOLD
 from src.normalizers.attribute import HoldingAttributesNormalizer
-from src.settings import SPREAD_SHEET_ID
+from src.tables import HoldingsTable
+from src.utils import intern_string
+
+if TYPE_CHECKING:
+    # Imported at runtime only by the methods that use them, to avoid a circular import.
+    from src.disk.caches import LeavesCache
+    from src.exposures import ExposureCube, ExposureMatrix
+
+NAME_WORDS_CACHE_SIZE = 2 ** 16
+
+# Marks that the market hub was not queried yet for a holding, because None is a valid result.
+NOT_QUERIED = object()
 
 
 class Holding:
+    """
+        A holding is compact: it has no `__dict__` & all its strings are interned, so the strings repeated across
+        holdings ( countries, sectors, currencies, name words etc.) are stored only once.
+        The name words are stored as a tuple of distinct words, starting with the first word, because it takes a
+        fraction of the memory of a frozenset. The last `NAME_WORDS_CACHE_SIZE` distinct normalized names are cached,
+        so the same company held by multiple funds is split once & shares the tuple.
+
+        Memory budget: a holding takes at most `MEMORY_BUDGET_BYTES` bytes, including its strings & name words.
+        On the bundled Vanguard names it takes ~750 bytes.
+        Check it with: `python -m benchmarks.holding_memory`.
+    """
+
+    __slots__ = (
+        'name',
+        'normalized_name',
+        'name_words',
+        'first_name_word',
+        'ticker',
+        'country',
+        'sector',
+        'currency',
+        'exchange',
+        'holding_type'
+    )
+
+    MEMORY_BUDGET_BYTES = 1024
+
     normalizer = HoldingAttributesNormalizer()
 
     def __init__(
@@ -22,14 +66,75 @@ class Holding:
             exchange=None,
             holding_type: str = None
     ):
-        self.name = name
-        self.normalized_name = self.normalizer.normalize_name(name)
-        self.ticker = ticker
-        self.country = self.normalizer.normalize_country(country)
-        self.sector = self.normalizer.normalize_sector(sector)
-        self.currency = currency
-        self.exchange = exchange
-        self.holding_type = self.normalizer.normalize_type(holding_type)
+        self._set_normalized_attributes(
+            name=name,
+            normalized_name=self.normalizer.normalize_name(name),
+            ticker=ticker,
+            country=self.normalizer.normalize_country(country),
+            sector=self.normalizer.normalize_sector(sector),
+            currency=currency,
+            exchange=exchange,
+            holding_type=self.normalizer.normalize_type(holding_type)
+        )
+
+    @classmethod
+    def from_normalized(
+            cls,
+            name,
+            normalized_name: str,
+            ticker=None,
+            country=None,
+            sector=None,
+            currency=None,
+            exchange=None,
+            holding_type: Optional[HoldingTypeChoices] = None
+    ) -> 'Holding':
+        """
+            Creates a holding from attributes that are already normalized ( ex. by the batch normalization methods).
+        """
+        holding = cls.__new__(cls)
+        holding._set_normalized_attributes(
+            name=name,
+            normalized_name=normalized_name,
+            ticker=ticker,
+            country=country,
+            sector=sector,
+            currency=currency,
+            exchange=exchange,
+            holding_type=holding_type
+        )
+
+        return holding
+
+    def _set_normalized_attributes(
+            self,
+            name,
+            normalized_name: str,
+            ticker,
+            country,
+            sector,
+            currency,
+            exchange,
+            holding_type: Optional[HoldingTypeChoices]
+    ):
+        self.name = intern_string(name)
+        self.normalized_name = intern_string(normalized_name)
+
+        self.name_words, self.first_name_word = self.get_name_words(self.normalized_name)
+
+        self.ticker = intern_string(ticker)
+        self.country = intern_string(country)
+        self.sector = intern_string(sector)
+        self.currency = intern_string(currency)
+        self.exchange = intern_string(exchange)
+        self.holding_type = holding_type
+
+    @classmethod
+    @functools.lru_cache(maxsize=NAME_WORDS_CACHE_SIZE)
+    def get_name_words(cls, normalized_name: str) -> Tuple[Tuple[str, ...], str]:
+        words = tuple(dict.fromkeys(intern_string(word) for word in normalized_name.split(' ')))
+
+        return words, words[0]
 
     @property
     def is_leaf(self) -> bool:
@@ -42,32 +147,28 @@ class Holding:
 
         return f'{self.normalized_name}'
 
-    def __eq__(self, other, name_words_iou_threshold=0.6):
+    def __eq__(self, other, name_words_iou_threshold=NAME_WORDS_IOU_THRESHOLD):
         if not isinstance(other, Holding):
             return False
 
         if other.ticker and self.ticker:
             return other.ticker.upper() == self.ticker.upper()
 
-        if other.first_normalized_name_word() != self.first_normalized_name_word():
+        if other.first_name_word != self.first_name_word:
             return False
 
-        other_name_set = set(other.normalized_name.split(' '))
-        self_name_set = set(self.normalized_name.split(' '))
-
-        intersections_name_words = other_name_set.intersection(self_name_set)
-        reunion_name_words = other_name_set.union(self_name_set)
-        iou = len(intersections_name_words) / len(reunion_name_words)
+        num_common_words = len(frozenset(other.name_words).intersection(self.name_words))
+        iou = num_common_words / (len(other.name_words) + len(self.name_words) - num_common_words)
 
         assert iou <= 1.
 
         return iou >= name_words_iou_threshold
 
     def __hash__(self):
-        return self.normalized_name.split(' ')[0].__hash__()
+        return hash(self.first_name_word)
 
     def first_normalized_name_word(self):
-        return self.normalized_name.split(' ')[0]
+        return self.first_name_word
 
     @classmethod
     def aggregate(cls, holding_1, holding_2):
@@ -102,6 +203,18 @@ class Holding:
         return holding
 
     def to_leaves(self) -> Optional['MultipleItemsFinancialInstrument']:
+        assert not self.is_leaf
+
+        return LeavesResolver(cache=LeavesResolver.get_default_cache()).resolve_holding(self)
+
+    def get_instrument(self) -> Optional['MultipleItemsFinancialInstrument']:
+        """
+            Returns the financial instrument behind the holding ( ex. the ETF), as it is found in its source.
+        """
+        with tracing.span('fund.load', ticker=self.ticker):
+            return self._get_instrument()
+
+    def _get_instrument(self) -> Optional['MultipleItemsFinancialInstrument']:
         from src import network
         from src import disk
 
@@ -118,16 +231,13 @@ class Holding:
         if instrument_factory:
             instrument = instrument_factory(self.ticker)
 
-        if instrument is None:
-            return None
-
-        return instrument.to_leaves()
+        return instrument
 
 
 class FinancialInstrument:
     def __init__(self, name):
         self.name = name
-        self.holdings = OrderedDict()
+        self.holdings = HoldingsTable()
 
     def get_holding_weight(self, holding: Holding) -> float:
         raise NotImplementedError()
@@ -135,15 +245,18 @@ class FinancialInstrument:
     def get_holding(self, name, ticker=None) -> Holding:
         raise NotImplementedError()
 
-    def get_weights(self) -> List:
-        return [value['weight'] for value in self.holdings.values()]
+    def get_weights(self) -> np.ndarray:
+        return self.holdings.weights
 
-    def get_holdings(self) -> List:
-        return [value['holding'] for value in self.holdings.values()]
+    def get_holdings(self) -> np.ndarray:
+        return self.holdings.holdings
 
     def get_values(self):
         return zip(self.get_holdings(), self.get_weights())
 
+    def to_dataframe(self) -> pd.DataFrame:
+        return self.holdings.to_dataframe()
+
 
 class OneItemFinancialInstrument(FinancialInstrument):
     def __init__(self, name, **kwargs):
@@ -152,10 +265,7 @@ class OneItemFinancialInstrument(FinancialInstrument):
         holding = Holding(name, **kwargs)
         self.holding = holding
 
-        self.holdings[holding] = {
-            'holding': holding,
-            'weight': 1.
-        }
+        self.holdings.append(holding, 1.)
 
     def get_holding_weight(self, holding: Holding) -> float:
         return 1.
@@ -169,88 +279,166 @@ class MultipleItemsFinancialInstrument(FinancialInstrument):
 
     def __init__(self, name):
         super().__init__(name)
-        self.holdings = dict()
+        self.index = HoldingIndex()
+
+    @classmethod
+    def from_holdings_weights(cls, name: str, holdings: Sequence[Holding], weights: Iterable[float]):
+        """
+            Creates the instrument from already merged holdings ( ex. the holdings of another instrument), so they are
+            added as they are, without being merged or queried in the markets.
+        """
+        instrument = cls(name)
 
-    def add_holding_weight(self, holding: Holding, weight: float):
+        holdings = list(holdings)
+        instrument.holdings.extend(holdings, weights)
+        for holding in holdings:
+            instrument.index.add(holding)
+
+        return instrument
+
+    def add_holding_weight(self, holding: Holding, weight: float) -> int:
+        """
+            Returns the row of the holding.
+        """
         assert weight <= 1
 
-        old_weight = self.get_holding_weight(holding)
+        row = self._merge_holding(holding)
+        self.holdings.add_weight(row, weight)
 
-        old_holding = self.get_holding(holding.name, holding.ticker)
-        holding = Holding.aggregate_with_hub(old_holding, holding)
+        return row
+
+    def add_holdings_weights(self, holdings: Iterable[Holding], weights: Iterable[float]) -> List[int]:
+        """
+            Returns the rows of the holdings.
+        """
+        weights = np.asarray(weights, dtype=float)
+        assert (weights <= 1).all()
+
+        rows = self.merge_holdings(holdings)
+        self.holdings.add_weights(rows, weights)
+
+        return rows
+
+    def merge_holdings(self, holdings: Iterable[Holding]) -> List[int]:
+        """
+            Merges the holdings, without their weights. The new holdings are added with a weight of 0.
+            Returns the rows of the holdings.
+        """
+        from src.markets import MarketHub
 
-        self.holdings[holding] = {
-            'weight': old_weight + weight,
-            'holding': holding
-        }
+        # Resolve all the holdings against the markets in one pass. The new holdings are aggregated with these results.
+        holdings = list(holdings)
+        holdings_from_hub = MarketHub.get().query_many(holdings)
+
+        with tracing.span('match', instrument=self.name, holdings=len(holdings)):
+            return [
+                self._merge_holding(holding, holding_from_hub)
+                for holding, holding_from_hub in zip(holdings, holdings_from_hub)
+            ]
+
+    def _merge_holding(self, holding: Holding, holding_from_hub: Optional[Holding] = NOT_QUERIED) -> int:
+        """
+            Returns the row of the holding, after it was aggregated with the already existing one.
+            If the holding is new, it is added with a weight of 0.
+            holding_from_hub: the result of querying the market hub for the holding, if it was already queried.
+        """
+        row = self.index.find(holding)
+        if row is None:
+            if holding_from_hub is NOT_QUERIED:
+                holding = Holding.aggregate_with_hub(None, holding)
+            else:
+                holding = Holding.aggregate(holding, holding_from_hub)
+            row = self.holdings.append(holding, 0.)
+            assert self.index.add(holding) == row
+        else:
+            holding = Holding.aggregate_with_hub(self.holdings.get_holding(row), holding)
+            self.holdings.set_holding(row, holding)
+            self.index.update(row, holding)
+
+        return row
 
     def get_holding_weight(self, holding: Union[Holding, str]) -> float:
         if isinstance(holding, str):
             holding = Holding(name=holding)
 
-        return self.holdings.get(holding, {'weight': 0.})['weight']
+        row = self.index.find(holding)
+        if row is None:
+            return 0.
+
+        return self.holdings.get_weight(row)
 
     def get_holding(self, name, ticker=None) -> Holding:
         holding = Holding(name, ticker=ticker)
 
-        return self.holdings.get(holding, {'holding': None})['holding']
-
-    def to_leaves(self) -> 'MultipleItemsFinancialInstrument':
-        new_instrument = MultipleItemsFinancialInstrument(self.name)
-
-        print(f'Normalizing financial instrument: {self.name}')
-        for holding, weight in self.get_values():
-            if holding.is_leaf:
-                new_instrument.add_holding_weight(holding, weight)
-            else:
-                reduced_instrument = holding.to_leaves()
-
-                assert reduced_instrument is not None, 'Cannot reduce instrument'
+        row = self.index.find(holding)
+        if row is None:
+            return None
 
-                for reduced_holding, reduced_weight in reduced_instrument.get_values():
-                    new_instrument.add_holding_weight(reduced_holding, weight*reduced_weight)
+        return self.holdings.get_holding(row)
 
-        new_instrument.assert_holdings_summed_value()
+    def to_exposure_matrix(self, max_workers: Optional[int] = None) -> 'ExposureMatrix':
+        """
+            Returns the look-through matrix of the instrument: a row for every holding of the instrument, with the
+            weights of its leaves ( a leaf is a row with itself, with the weight 1), over all the leaves.
+        """
+        return LeavesResolver(max_workers=max_workers, cache=LeavesResolver.get_default_cache()).get_exposure_matrix(
+            self
+        )
 
-        return new_instrument
+    def to_leaves(self, max_workers: Optional[int] = None) -> 'MultipleItemsFinancialInstrument':
+        """
+            max_workers: the number of funds that are loaded concurrently. Defaults to `LEAVES_MAX_WORKERS`.
+            The leaves are cached if `LEAVES_CACHE` is set, so reducing the instrument with other weights is cheap.
+        """
+        return LeavesResolver(max_workers=max_workers, cache=LeavesResolver.get_default_cache()).resolve(self)
 
     @classmethod
+    @tracing.traced('aggregate')
     def aggregate(cls, financial_instruments: List[Tuple[float, FinancialInstrument]]):
-        aggregated_etfs = MultipleItemsFinancialInstrument('Aggregated ETF')
+        from src.exposures import ExposureMatrix
 
         assert sum([etf[0] for etf in financial_instruments]) > cls.SUMMED_WEIGHTS_THRESHOLD, \
             'Your etf holdings should sum up to 1.'
 
         print('Aggregating financial instruments...')
-        for financial_instrument_weight, financial_instrument in tqdm.tqdm(financial_instruments):
-            for holding, weight in financial_instrument.get_values():
-                new_weight = financial_instrument_weight * weight
-                aggregated_etfs.add_holding_weight(holding, new_weight)
+        exposure_matrix = ExposureMatrix.from_instruments(
+            (financial_instrument.name, financial_instrument)
+            for _, financial_instrument in tqdm.tqdm(financial_instruments)
+        )
+        aggregated_etfs = exposure_matrix.to_instrument(
+            'Aggregated ETF',
+            [financial_instrument_weight for financial_instrument_weight, _ in financial_instruments]
+        )
 
         aggregated_etfs.assert_holdings_summed_value()
 
         return aggregated_etfs
 
     def assert_holdings_summed_value(self):
-        assert sum(self.get_weights()) > self.SUMMED_WEIGHTS_THRESHOLD, 'Your holdings should sum up to around ~1.'
+        assert self.holdings.summed_weight() > self.SUMMED_WEIGHTS_THRESHOLD, \
+            'Your holdings should sum up to around ~1.'
 
+    @tracing.traced('export.csv')
     def export_to_csv(self, file_path='portfolio.csv') -> str:
         print('Exporting CSV file...')
 
         sorted_values = self.sort_holdings()
 
         with open(file_path, 'w') as f:
-            f.write(f'Name,Ticker,Weight,Country,Sector\n')
+            f.write('Name,Ticker,Weight,Country,Sector\n')
             for holding, weight in tqdm.tqdm(sorted_values):
                 f.write(
                     f'{holding.normalized_name},{holding.ticker},{weight * 100},{holding.country},{holding.sector}\n')
 
         return file_path
 
+    @tracing.traced('export.google_sheets')
     def export_to_google_sheets(self, workspace_name='Aggregated'):
         """
             sheet_name: the name of your google sheets sheet
         """
+        from src.network.managers import GoogleSheetsManager
+
         print(f'Exporting {self.name} to google sheets...')
 
         sorted_values = self.sort_holdings()
@@ -265,38 +453,300 @@ class MultipleItemsFinancialInstrument(FinancialInstrument):
                 holding.sector
             ])
 
-        google_sheets_manager = GoogleSheetsManager(SPREAD_SHEET_ID)
+        google_sheets_manager = GoogleSheetsManager(settings.SPREAD_SHEET_ID)
         google_sheets_manager.write(data=data, workspace_name=workspace_name)
 
     def sort_holdings(self) -> List[tuple]:
-        return sorted(self.get_values(), key=lambda item: -item[1])
+        rows = self.holdings.sorted_rows()
 
-    def statistics_country(self):
-        self.statistics('country')
+        return list(zip(self.get_holdings()[rows], self.get_weights()[rows]))
 
-    def statistics_sector(self):
-        self.statistics('sector')
+    def get_exposure_cube(self, dimensions: Sequence[str] = None) -> 'ExposureCube':
+        """
+            dimensions: the attributes the exposures can be grouped by. Defaults to all of them.
+        """
+        from src.exposures import ExposureCube
 
-    def statistics(self, attribute_key: str):
-        counter = OrderedDict()
+        return ExposureCube(self.holdings, dimensions or ExposureCube.DIMENSIONS)
 
-        for holding_data in self.holdings.values():
-            holding: Holding = holding_data['holding']
-            weight: float = holding_data['weight']
+    def get_exposures(self, *dimensions: str) -> pd.DataFrame:
+        return self.get_exposure_cube(dimensions).get(*dimensions)
 
-            attribute_value = getattr(holding, attribute_key)
+    def statistics_country(self, exposure_cube: Optional['ExposureCube'] = None) -> pd.DataFrame:
+        return self.statistics('country', exposure_cube=exposure_cube)
 
-            counter[attribute_value] = counter.get(attribute_value, 0) + weight
+    def statistics_sector(self, exposure_cube: Optional['ExposureCube'] = None) -> pd.DataFrame:
+        return self.statistics('sector', exposure_cube=exposure_cube)
 
-        counter = {k: v for k, v in sorted(counter.items(), key=lambda item: -item[1])}
+    @tracing.traced('statistics')
+    def statistics(self, attribute_key: str, exposure_cube: Optional['ExposureCube'] = None) -> pd.DataFrame:
+        """
+            Prints & returns the exposure by the attribute.
+            exposure_cube: pass the cube of the instrument to reuse it between multiple statistics.
+        """
+        if exposure_cube is None:
+            exposure_cube = self.get_exposure_cube([attribute_key])
+        exposures = exposure_cube.get(attribute_key)
 
-        total = sum(counter.values())
+        total = exposures['weight'].sum()
         assert total > self.SUMMED_WEIGHTS_THRESHOLD
 
         print(f'Statistics {attribute_key}')
-        for item, value in counter.items():
+        for item, value in zip(exposures[attribute_key].tolist(), exposures['weight'].tolist()):
             print(f'\t{item}: {value * 100}%')
 
+        return exposures
+
+
+class LeavesResolver:
+    """
+        Reduces financial instruments to leaves. The funds form a DAG ( a fund can hold other funds), so they are
+        resolved in two steps:
+            - the funds are loaded level by level, concurrently, so their downloads & parsing overlap
+            - the funds are reduced depth first. The leaves of every fund are memoized by ticker, so a fund that is held
+                multiple times is loaded & reduced only once per resolver
+
+        The reduced funds are merged in the order of the holdings, so the output is the same as reducing them one by
+        one. A fund that holds itself, directly or not, & funds nested deeper than `max_depth` raise an error.
+
+        The leaves of an instrument are merged into its look-through matrix ( see `src.exposures.ExposureMatrix`), a row
+        for every holding over the leaves, which is combined with the weights of the holdings.
+        With a cache ( see `src.disk.caches.LeavesCache`), the matrix of every reduced instrument is persisted,
+        keyed by a fingerprint of its holdings & of the market data, but not of its weights. A fund holding is part of
+        the fingerprint through the fingerprint of its leaves, which covers the weights of the fund. So when only the
+        weights of an instrument change ( ex. the percentages of the portfolio), it is recombined from the cached
+        matrix & only the funds that were added or changed are merged again.
+    """
+
+    MAX_DEPTH = 8
+    # Bump it when the merging of the holdings changes, so the old cached leaves are not used anymore.
+    FINGERPRINT_VERSION = 2
+
+    def __init__(
+            self,
+            max_workers: Optional[int] = None,
+            max_depth: int = MAX_DEPTH,
+            cache: Optional['LeavesCache'] = None
+    ):
+        self.max_workers = max_workers or settings.LEAVES_MAX_WORKERS
+        self.max_depth = max_depth
+        self.cache = cache
+
+        self.instruments: Dict[str, Optional[MultipleItemsFinancialInstrument]] = dict()
+        self.leaves: Dict[str, Optional[MultipleItemsFinancialInstrument]] = dict()
+        self.fingerprints: Dict[str, Optional[str]] = dict()
+        self._market_version: Optional[str] = None
+
+    @classmethod
+    def get_default_cache(cls) -> Optional['LeavesCache']:
+        from src.disk.caches import LeavesCache
+
+        return LeavesCache() if settings.LEAVES_CACHE else None
+
+    @tracing.traced('to_leaves')
+    def resolve(self, instrument: 'MultipleItemsFinancialInstrument') -> 'MultipleItemsFinancialInstrument':
+        self._load_instruments(instrument.get_holdings())
+
+        return self._reduce(instrument, path=())
+
+    @tracing.traced('to_leaves')
+    def get_exposure_matrix(self, instrument: 'MultipleItemsFinancialInstrument') -> 'ExposureMatrix':
+        self._load_instruments(instrument.get_holdings())
+
+        return self._get_exposure_matrix(instrument, path=())
+
+    def resolve_holding(self, holding: Holding) -> Optional['MultipleItemsFinancialInstrument']:
+        self._load_instruments([holding])
+
+        return self._get_leaves(holding, path=())
+
+    @tracing.traced('to_leaves.prepare')
+    def prepare(self, instruments: Iterable['MultipleItemsFinancialInstrument']):
+        """
+            Loads & reduces all the funds held by the instruments, so resolving any of them merges only its own
+            holdings ( ex. the funds shared by multiple portfolios are reduced once).
+        """
+        holdings = [holding for instrument in instruments for holding in instrument.get_holdings()]
+        self._load_instruments(holdings)
+
+        for holding in holdings:
+            if not holding.is_leaf:
+                self._get_leaves(holding, path=())
+
+    @classmethod
+    def get_key(cls, holding: Holding) -> str:
+        return (holding.ticker or holding.name).upper()
+
+    def get_fingerprint(self, instrument: 'MultipleItemsFinancialInstrument', path: Tuple[str, ...] = ()) -> str:
+        """
+            Identifies the holdings of the instrument & the market data they are merged with, without the weights.
+            The funds are identified by the fingerprints of their leaves, which are computed without reducing them.
+        """
+        if self._market_version is None:
+            from src.markets import MarketHub
+
+            self._market_version = MarketHub.get().get_version()
+
+        fingerprint = hashlib.sha256(f'v{self.FINGERPRINT_VERSION}:{self._market_version}'.encode('utf-8'))
+        for column in HoldingsTable.STRING_COLUMNS + ('holding_type', ):
+            values = ['\x00' if value is None else str(value) for value in instrument.holdings.column(column)]
+            fingerprint.update('\x1f'.join(values).encode('utf-8'))
+            fingerprint.update(b'\x1e')
+
+        for holding in instrument.get_holdings():
+            if not holding.is_leaf:
+                fingerprint.update(f'{self._get_leaves_fingerprint(holding, path)}\x1f'.encode('utf-8'))
+
+        return fingerprint.hexdigest()
+
+    @classmethod
+    def get_leaves_fingerprint(cls, fingerprint: str, weights: np.ndarray) -> str:
+        leaves_fingerprint = hashlib.sha256(fingerprint.encode('utf-8'))
+        leaves_fingerprint.update(np.ascontiguousarray(weights, dtype=np.float64).tobytes())
+
+        return leaves_fingerprint.hexdigest()
+
+    def _load_instruments(self, holdings: Iterable[Holding]):
+        """
+            Loads the funds breadth first, starting from the given holdings. Every level is loaded concurrently.
+        """
+        level_holdings = list(holdings)
+        depth = 0
+        while len(level_holdings) > 0 and depth < self.max_depth:
+            holdings = dict()
+            for holding in level_holdings:
+                key = self.get_key(holding)
+                if not holding.is_leaf and key not in self.instruments and key not in holdings:
+                    holdings[key] = holding
+
+            with tracing.span('to_leaves.load', depth=depth, funds=len(holdings)):
+                if len(holdings) > 1 and self.max_workers > 1:
+                    max_workers = min(self.max_workers, len(holdings))
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                        loaded_instruments = list(executor.map(Holding.get_instrument, holdings.values()))
+                else:
+                    loaded_instruments = [holding.get_instrument() for holding in holdings.values()]
+
+            self.instruments.update(zip(holdings.keys(), loaded_instruments))
+            level_holdings = [
+                holding
+                for instrument in loaded_instruments if instrument is not None
+                for holding in instrument.get_holdings()
+            ]
+            depth += 1
+
+    def _reduce(
+            self,
+            instrument: 'MultipleItemsFinancialInstrument',
+            path: Tuple[str, ...]
+    ) -> 'MultipleItemsFinancialInstrument':
+        exposure_matrix = self._get_exposure_matrix(instrument, path)
+
+        new_instrument = exposure_matrix.to_instrument(instrument.name, instrument.get_weights())
+        new_instrument.assert_holdings_summed_value()
+
+        return new_instrument
+
+    def _get_exposure_matrix(
+            self,
+            instrument: 'MultipleItemsFinancialInstrument',
+            path: Tuple[str, ...]
+    ) -> 'ExposureMatrix':
+        print(f'Normalizing financial instrument: {instrument.name}')
+        tracing.count('to_leaves.reduced_instruments')
+
+        fingerprint = None
+        if self.cache is not None:
+            fingerprint = self.get_fingerprint(instrument, path)
+            exposure_matrix = self.cache.get(fingerprint)
+            if exposure_matrix is not None:
+                # The funds held by the instrument are not reduced at all.
+                return exposure_matrix
+
+        reduced_instruments = []
+        for holding in instrument.get_holdings():
+            reduced_instrument = None
+            if not holding.is_leaf:
+                reduced_instrument = self._get_leaves(holding, path)
+
+                assert reduced_instrument is not None, 'Cannot reduce instrument'
+            reduced_instruments.append(reduced_instrument)
+
+        exposure_matrix = self._merge(instrument, reduced_instruments)
+        if self.cache is not None:
+            self.cache.put(fingerprint, instrument.name, exposure_matrix)
+
+        return exposure_matrix
+
+    @classmethod
+    def _merge(
+            cls,
+            instrument: 'MultipleItemsFinancialInstrument',
+            reduced_instruments: List[Optional['MultipleItemsFinancialInstrument']]
+    ) -> 'ExposureMatrix':
+        """
+            Merges the leaves of the holdings into the look-through matrix of the instrument.
+        """
+        from src.exposures import ExposureMatrix
+
+        leaves = MultipleItemsFinancialInstrument(instrument.name)
+
+        vectors = []
+        for holding, reduced_instrument in zip(instrument.get_holdings(), reduced_instruments):
+            if reduced_instrument is None:
+                vectors.append((leaves.merge_holdings([holding]), [1.]))
+            else:
+                vectors.append((
+                    leaves.merge_holdings(reduced_instrument.get_holdings()),
+                    reduced_instrument.get_weights()
+                ))
+
+        return ExposureMatrix.from_vectors(
+            leaves.get_holdings(),
+            vectors,
+            names=[str(holding) for holding in instrument.get_holdings()]
+        )
+
+    def _get_leaves(self, holding: Holding, path: Tuple[str, ...]) -> Optional['MultipleItemsFinancialInstrument']:
+        key, path = self._visit(holding, path, self.leaves)
+        if key not in self.leaves:
+            instrument = self._get_instrument(holding, key)
+            self.leaves[key] = self._reduce(instrument, path) if instrument is not None else None
+
+        return self.leaves[key]
+
+    def _get_leaves_fingerprint(self, holding: Holding, path: Tuple[str, ...]) -> Optional[str]:
+        key, path = self._visit(holding, path, self.fingerprints)
+        if key not in self.fingerprints:
+            instrument = self._get_instrument(holding, key)
+            self.fingerprints[key] = self.get_leaves_fingerprint(
+                self.get_fingerprint(instrument, path),
+                instrument.get_weights()
+            ) if instrument is not None else None
+
+        return self.fingerprints[key]
+
+    def _visit(self, holding: Holding, path: Tuple[str, ...], memo: dict) -> Tuple[str, Tuple[str, ...]]:
+        """
+            Returns the key of the fund & its path. Raises an error if the fund holds itself or if it has to be
+            computed & it is too deep.
+        """
+        key = self.get_key(holding)
+        path = path + (key, )
+        if key in path[:-1]:
+            raise DecompositionError(path, 'the fund holds itself')
+
+        if key not in memo and len(path) > self.max_depth:
+            raise DecompositionError(path, f'the funds are nested deeper than {self.max_depth} levels')
+
+        return key, path
+
+    def _get_instrument(self, holding: Holding, key: str) -> Optional['MultipleItemsFinancialInstrument']:
+        if key not in self.instruments:
+            self.instruments[key] = holding.get_instrument()
+
+        return self.instruments[key]
+
 
 class ETF(MultipleItemsFinancialInstrument):
     pass
@@ -3,198 +3,307 @@ import json
 import concurrent.futures
 import os
 import re
+import threading
+import time
+import zlib
 
 from collections import OrderedDict
 from pathlib import Path
-from typing import Optional, List, Union, Dict
+from typing import Optional, List, Union, Tuple, Dict
 
+import numpy as np
 import pandas
-import tqdm
-import yfinance
 
-from pandas_datareader.nasdaq_trader import get_nasdaq_symbols
 
-from src import settings, disk
+from src import settings, disk, tracing
+from src.disk.snapshots import HoldingsSnapshot
+from src.disk.stores import MarketStore
+from src.indexes import HoldingIndex
 from src.instruments import Holding
-from src.settings import MARKET_CACHE_EXPIRATION_DAYS, FILES_DIR
+from src.network.fetchers import FetchPipeline, FetchCheckpoint
+from src.network.quotes import get_quote_manager
+from src.normalizers.structures import normalize_holdings_data_frame
 
 
 class Market:
     def __init__(self, market_name: str):
         self.market_name = market_name
 
+        self.is_loaded = False
+        self._load_lock = threading.Lock()
+
+    def load(self):
+        """
+            Loads the data of the market. It is safe to call it multiple times & from multiple threads:
+            the data is loaded only once.
+        """
+        if self.is_loaded:
+            return
+
+        with self._load_lock:
+            if not self.is_loaded:
+                with tracing.span('market.load', market=self.market_name):
+                    self._load()
+                self.is_loaded = True
+
+    def _load(self):
+        pass
+
+    def get_version(self) -> str:
+        """
+            Identifies the data of the market, without loading it. It changes when the data changes.
+        """
+        return self.market_name
+
     def query(self, holding: Union[Holding, str]) -> Holding:
         raise NotImplementedError()
 
+    def query_many(self, holdings: List[Holding]) -> List[Optional[Holding]]:
+        return [self.query(holding) for holding in holdings]
+
 
 class TickerMarket(Market):
-    MARKET_META_FILE = Path(settings.STORAGE_PATH) / 'market_metadata.json'
+    """
+        The holdings are kept in the market store ( see `src.disk.stores.MarketStore`), which is queried directly, so
+        the market is never loaded in memory. Loading the market only refreshes its data in the store, if it expired.
+    """
 
     def __init__(self, market_name: str, expire_after_days: datetime.timedelta):
         super().__init__(market_name)
 
         self.expire_after_days = expire_after_days
 
-        self.holdings_file = Path(settings.STORAGE_PATH) / f'{self.market_name}_holdings.csv'
+        self.store = MarketStore()
+        # The data stored before the market store. It is read only to migrate it to the store.
+        self.legacy_market_meta_file = Path(settings.STORAGE_PATH) / 'market_metadata.json'
+        self.legacy_snapshot_file = Path(settings.STORAGE_PATH) / f'{self.market_name}_holdings.snapshot'
+        self.legacy_holdings_file = Path(settings.STORAGE_PATH) / f'{self.market_name}_holdings.csv'
+        # The fetched quotes of an unfinished refresh.
+        self.checkpoint_file = Path(settings.STORAGE_PATH) / f'{self.market_name}_checkpoint.jsonl'
         self.missed_holdings = -1  # Parameter to describe the number of faulty requests for a holding.
+        self.quote_manager = get_quote_manager()
+
+    def _load(self):
+        if not self.store.has_market(self.market_name) and self.has_legacy_data():
+            self.migrate_legacy_data()
 
         if self.should_refresh_data():
-            holdings: List[Holding] = self.get_data_from_cloud()
-            self.save_data_to_disk(holdings)
-            self.save_update_datetime()
-        else:
-            holdings: List[Holding] = self.get_data_from_disk()
+            self.refresh_data()
+
+    def refresh_data(self):
+        """
+            Delta refresh: the tickers are diffed against the listed tickers & only the new tickers & the tickers that
+            expired are fetched. The delisted tickers are dropped. If a ticker can't be fetched, its old data is kept.
+            The tickers without data are remembered, so they are fetched again only after they expire.
+            The data & the update timestamp of the market are replaced in one transaction.
+        """
+        now = time.time()
+        listed_tickers = list(dict.fromkeys(self.get_tickers_from_cloud()))
+        listed_tickers_set = set(listed_tickers)
+
+        # The ticker is the third column of the rows & the expiration timestamp the last one.
+        rows_by_ticker: Dict[str, tuple] = {
+            row[2]: row for row in self.store.get_rows(self.market_name) if row[2] in listed_tickers_set
+        }
+        missing_tickers: Dict[str, float] = {
+            ticker: expires_at
+            for ticker, expires_at in self.store.get_missing_tickers(self.market_name).items()
+            if ticker in listed_tickers_set
+        }
+
+        tickers_to_fetch = [
+            ticker for ticker in listed_tickers
+            if (rows_by_ticker[ticker][-1] if ticker in rows_by_ticker else missing_tickers.get(ticker, 0)) <= now
+        ]
+        print(f'Refreshing {len(tickers_to_fetch)} of {len(listed_tickers)} tickers for: {self.market_name}')
 
-        self.holdings: Dict[Holding, Holding] = self.to_dictionary(holdings)
+        for ticker, holding in self.get_data_from_cloud(tickers_to_fetch).items():
+            expires_at = now + self.get_ticker_time_to_live(ticker)
+            if holding is None:
+                rows_by_ticker.pop(ticker, None)
+                missing_tickers[ticker] = expires_at
+            else:
+                rows_by_ticker[ticker] = MarketStore.to_row(holding, expires_at)
+                missing_tickers.pop(ticker, None)
 
-    def get_data_from_cloud(self) -> List[Holding]:
-        tickers = self.get_tickers_from_cloud()
+        print(f'Saving data to disk for: {self.market_name}')
+        self.store.replace(
+            self.market_name,
+            [rows_by_ticker[ticker] for ticker in listed_tickers if ticker in rows_by_ticker],
+            missing_tickers=missing_tickers,
+            updated_at=datetime.datetime.utcnow().timestamp()
+        )
+        self.get_checkpoint().clear()
 
-        holdings = []
-        self.missed_holdings = 0
+    def get_ticker_time_to_live(self, ticker: str) -> float:
+        """
+            Returns the time to live of a ticker, in seconds. It is between half & the whole expiration period, spread
+            by ticker, so the tickers expire gradually & every refresh fetches only a part of them.
+        """
+        spread = zlib.crc32(ticker.encode('utf-8')) / 2 ** 32
 
-        print(f'Getting data from cloud for: {self.market_name}')
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = []
-            for ticker in tickers:
-                futures.append(
-                    executor.submit(
-                        self.get_holding_from_cloud, ticker=ticker
-                    )
-                )
+        return self.expire_after_days.total_seconds() * (0.5 + 0.5 * spread)
+
+    def get_data_from_cloud(self, tickers: List[str]) -> Dict[str, Optional[Holding]]:
+        """
+            Returns the fetched holdings by ticker. The value is None if there is no data for the ticker.
+            The tickers that couldn't be fetched are not returned.
 
-            for future in concurrent.futures.as_completed(futures):
+            The quotes are fetched with bounded concurrency, rate limited & retried. They are checkpointed on disk, so
+            an interrupted refresh fetches only the remaining tickers.
+        """
+        print(f'Getting data from cloud for: {self.market_name}')
 
-                try:
-                    holding = future.result()
+        pipeline = FetchPipeline(
+            self.get_quote_from_cloud,
+            max_workers=settings.QUOTE_MAX_WORKERS,
+            requests_per_second=settings.QUOTE_REQUESTS_PER_SECOND,
+            max_retries=settings.QUOTE_MAX_RETRIES,
+            checkpoint=self.get_checkpoint()
+        )
+        quotes = pipeline.run(tickers, description=self.market_name)
+        self.missed_holdings = len(pipeline.failed_keys)
 
-                    if holding is not None:
-                        holdings.append(holding)
-                except (ConnectionError, TimeoutError):
-                    self.missed_holdings += 1
+        return {ticker: self.to_holding(ticker, quote) for ticker, quote in quotes.items()}
 
-        return holdings
+    def get_checkpoint(self) -> FetchCheckpoint:
+        return FetchCheckpoint(
+            str(self.checkpoint_file),
+            max_age=self.expire_after_days.total_seconds() / 2
+        )
 
     def get_tickers_from_cloud(self) -> List[str]:
         raise NotImplementedError()
 
     def get_holding_from_cloud(self, ticker: str) -> Optional[Holding]:
-        # TODO: Extract this code to a YahooManager
-        print(f'Get holding from cloud: {ticker}')
+        return self.to_holding(ticker, self.get_quote_from_cloud(ticker))
 
-        company = yfinance.Ticker(ticker)
+    def get_quote_from_cloud(self, ticker: str) -> Optional[dict]:
+        """
+            Returns the attributes of the holding, as a JSON serializable dict, or None if there is no data.
+        """
+        info = self.quote_manager.get_info(ticker)
         name = \
-            company.info.get('shortName') or \
-            company.info.get('longName') or \
-            company.info.get('displayName') or \
-            company.info.get('fullExchangeName')
+            info.get('shortName') or \
+            info.get('longName') or \
+            info.get('displayName') or \
+            info.get('fullExchangeName')
 
         if name is None:
             return None
 
-        holding = Holding(
-            name=name,
-            ticker=ticker,
-            country=company.info.get('region'),
-            currency=company.info.get('financialCurrency'),
-            exchange=company.info.get('fullExchangeName')
-        )
+        return {
+            'name': name,
+            'country': info.get('region'),
+            'currency': info.get('financialCurrency'),
+            'exchange': info.get('fullExchangeName')
+        }
 
-        return holding
+    @classmethod
+    def to_holding(cls, ticker: str, quote: Optional[dict]) -> Optional[Holding]:
+        if quote is None:
+            return None
 
-    def save_data_to_disk(self, holdings: List[Holding]):
-        print(f'Saving data to disk for: {self.market_name}')
+        return Holding(ticker=ticker, **quote)
 
-        with open(str(self.holdings_file), 'w') as f:
-            f.write('Name,Ticker,Country,Currency,Exchange\n')
-            for holding in tqdm.tqdm(holdings):
-                f.write(
-                    f'{holding.normalized_name},'
-                    f'{holding.ticker},'
-                    f'{holding.country},'
-                    f'{holding.currency},'
-                    f'{holding.exchange}\n'
-                )
-
-    def get_data_from_disk(self) -> List[Holding]:
-        print(f'Getting data from disk for: {self.market_name}')
-
-        holdings = []
-        holdings_dataframe = pandas.read_csv(self.holdings_file)
-        for _, holding_dataframe in holdings_dataframe.iterrows():
-            holding = Holding(
-                name=holding_dataframe['Name'],
-                ticker=holding_dataframe['Ticker'],
-                country=holding_dataframe['Country'],
-                currency=holding_dataframe['Currency'],
-                exchange=holding_dataframe['Exchange']
-            )
+    def has_legacy_data(self) -> bool:
+        return self.legacy_snapshot_file.exists() or self.legacy_holdings_file.exists()
+
+    def migrate_legacy_data(self):
+        """
+            Imports the snapshot ( or the older CSV file) of the market & its update timestamp from
+            `market_metadata.json`. The holdings without expirations expire from the update timestamp.
+        """
+        print(f'Migrating the data from disk to the market store for: {self.market_name}')
+
+        if self.legacy_snapshot_file.exists():
+            holdings = HoldingsSnapshot.load(str(self.legacy_snapshot_file))
+        else:
+            holdings = HoldingsSnapshot.from_holdings(self.get_data_from_legacy_file())
+        updated_at = self.get_legacy_update_timestamp()
+
+        expirations = holdings.get_expirations()
+        if expirations is None:
+            expirations = [
+                (updated_at or 0.) + self.get_ticker_time_to_live(ticker) if ticker else 0.
+                for ticker in holdings.get_column('ticker')
+            ]
+
+        columns = [holdings.get_column(column).tolist() for column in MarketStore.COLUMNS]
+        self.store.replace(
+            self.market_name,
+            [(*values, expires_at) for *values, expires_at in zip(*columns, np.asarray(expirations).tolist())],
+            missing_tickers=holdings.metadata.get('missing_tickers', dict()),
+            updated_at=updated_at
+        )
 
-            holdings.append(holding)
+    def get_data_from_legacy_file(self) -> List[Holding]:
+        holdings_dataframe = pandas.read_csv(self.legacy_holdings_file)
+        holdings_dataframe = holdings_dataframe.rename(columns=str.lower)
+        holdings_dataframe = normalize_holdings_data_frame(holdings_dataframe)
+
+        holdings = [
+            Holding.from_normalized(**dict(zip(holdings_dataframe.columns, values)))
+            for values in holdings_dataframe.itertuples(index=False, name=None)
+        ]
 
         return holdings
 
-    @classmethod
-    def to_dictionary(cls, holdings: List[Holding]) -> OrderedDict:
-        return OrderedDict({
-            h: h for h in holdings
-        })
+    def get_legacy_update_timestamp(self) -> Optional[float]:
+        if not self.legacy_market_meta_file.exists():
+            return None
 
-    def should_refresh_data(self):
+        with open(str(self.legacy_market_meta_file), 'r') as f:
+            market_metadata = json.load(f)
+
+        return market_metadata.get(self.market_name, dict()).get('timestamp')
+
+    def should_refresh_data(self) -> bool:
+        """
+            The data is refreshed when the tickers list wasn't checked for the whole expiration period or when at least
+            `MARKET_REFRESH_EXPIRED_RATIO` of the tickers expired. Otherwise, the few expired tickers are served as they
+            are, so not every run waits for a refresh.
+        """
         last_update_date_time = self.get_last_update_datetime()
         if last_update_date_time is None:
             return True
 
         now = datetime.datetime.utcnow()
+        if now - self.expire_after_days > last_update_date_time:
+            return True
 
-        return now - self.expire_after_days > last_update_date_time
+        num_expired, num_tickers = self.store.get_expiration_counts(self.market_name, time.time())
 
-    def get_last_update_datetime(self) -> Optional[datetime.datetime]:
-        if not self.MARKET_META_FILE.exists():
-            return None
+        return num_expired > 0 and num_expired >= settings.MARKET_REFRESH_EXPIRED_RATIO * num_tickers
 
-        with open(str(self.MARKET_META_FILE), 'r') as f:
-            market_metadata = json.load(f)
+    def get_version(self) -> str:
+        last_update_datetime = self.get_last_update_datetime()
 
-        specific_market_metadata = market_metadata.get(self.market_name, dict())
-        timestamp = specific_market_metadata.get('timestamp')
+        return f'{self.market_name}:{last_update_datetime.timestamp() if last_update_datetime else None}'
+
+    def get_last_update_datetime(self) -> Optional[datetime.datetime]:
+        timestamp = self.store.get_updated_at(self.market_name)
         if timestamp is None:
             return None
 
         return datetime.datetime.utcfromtimestamp(timestamp)
 
-    def save_update_datetime(self):
-        update_datetime = datetime.datetime.utcnow()
-        update_timestamp = update_datetime.timestamp()
-
-        if self.MARKET_META_FILE.exists():
-            with open(str(self.MARKET_META_FILE), 'r') as f:
-                market_metadata = json.load(f)
-
-            specific_market_metadata = market_metadata.get(self.market_name, dict())
-            specific_market_metadata.update({
-                'timestamp': update_timestamp
-            })
-            market_metadata[self.market_name] = specific_market_metadata
-        else:
-            market_metadata = {
-                self.market_name: {
-                    'timestamp': update_timestamp
-                }
-            }
+    def query(self, holding: Holding) -> Optional[Holding]:
+        return self.query_many([holding])[0]
 
-        with open(str(self.MARKET_META_FILE), 'w') as f:
-            json.dump(market_metadata, f)
+    def query_many(self, holdings: List[Holding]) -> List[Optional[Holding]]:
+        self.load()
 
-    def query(self, holding: Holding) -> Optional[Holding]:
-        return self.holdings.get(holding)
+        return self.store.find_many(self.market_name, holdings)
 
 
 class NasdaqTickerMarket(TickerMarket):
     def __init__(self):
-        super().__init__('Nasdaq', MARKET_CACHE_EXPIRATION_DAYS)
+        super().__init__('Nasdaq', settings.MARKET_CACHE_EXPIRATION_DAYS)
 
     def get_tickers_from_cloud(self) -> List[str]:
+        from pandas_datareader.nasdaq_trader import get_nasdaq_symbols
+
         symbols = get_nasdaq_symbols()
         tickers = [ticker for ticker in symbols['NASDAQ Symbol']]
 
@@ -203,7 +312,7 @@ class NasdaqTickerMarket(TickerMarket):
 
 class NYSETickerMarket(TickerMarket):
     def __init__(self):
-        super().__init__('NYSE', MARKET_CACHE_EXPIRATION_DAYS)
+        super().__init__('NYSE', settings.MARKET_CACHE_EXPIRATION_DAYS)
 
     def get_tickers_from_cloud(self) -> List[str]:
         # TODO: Try to see why it cannot be downloaded like this.
@@ -216,7 +325,7 @@ class NYSETickerMarket(TickerMarket):
 
         paths = disk.get_paths()
         nyse_tickers_path = paths['markets']['NYSE']
-        nyse_tickers_path = os.path.abspath(os.path.join(FILES_DIR, nyse_tickers_path))
+        nyse_tickers_path = os.path.abspath(os.path.join(settings.FILES_DIR, nyse_tickers_path))
 
         return self._parse_tickers_file(nyse_tickers_path)
 
@@ -238,17 +347,21 @@ class CustomMarket(Market):
     def __init__(self, market_name):
         super().__init__(market_name)
 
+        # The holdings are added in memory, so there is nothing to load.
+        self.is_loaded = True
         self.holdings: List[Holding] = []
+        self.index = HoldingIndex()
 
     def add_holding(self, holding: Holding):
         self.holdings.append(holding)
+        self.index.add(holding)
 
     def query(self, holding: Holding) -> Optional[Holding]:
-        for h in self.holdings:
-            if h == holding:
-                return h
+        holding_id = self.index.find(holding)
+        if holding_id is None:
+            return None
 
-        return None
+        return self.holdings[holding_id]
 
 
 class CashMarket(CustomMarket):
@@ -327,11 +440,30 @@ class BondMarket(CustomMarket):
 
 
 class MarketHub:
+    """
+        The markets are loaded lazily: all the markets that are not loaded yet are loaded concurrently when a query
+        can't be answered from the cache. Call `MarketHub.warm_up()` to start loading them in the background, while
+        doing something else ( ex. reading the portfolio or downloading the funds). If the warm up fails, its error is
+        raised by the first query that needs the markets.
+
+        The results of the queries are kept in two bounded LRU caches: one for the found holdings and one for the
+        misses, so a holding that is in no market is looked up only once. The caches are keyed by the normalized name
+        & the ticker, which are the only attributes used to match holdings.
+    """
+
     market_hub: 'MarketHub' = None
+    market_hub_lock = threading.Lock()
+
+    QUERY_CACHE_SIZE = 2 ** 15
+    NEGATIVE_QUERY_CACHE_SIZE = 2 ** 15
 
     # TODO: Make this class truly singletone
-    def __init__(self):
-        self.markets = [
+    def __init__(self, markets: Optional[List[Market]] = None):
+        """
+            markets: the markets queried in order. Defaults to the real markets. Other markets ( ex. a stub market for
+                the benchmarks) are used by setting `MarketHub.market_hub = MarketHub(markets)`.
+        """
+        self.markets = markets if markets is not None else [
             NasdaqTickerMarket(),
             NYSETickerMarket(),
             CashMarket(),
@@ -340,20 +472,149 @@ class MarketHub:
             BondMarket()
         ]
 
+        # Guards the caches & their counters, so the hub can be queried from several threads.
+        self.lock = threading.RLock()
+        self.query_cache: OrderedDict = OrderedDict()
+        self.negative_query_cache: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+        self.warm_up_future: Optional[concurrent.futures.Future] = None
+
     @classmethod
     def get(cls):
         if cls.market_hub is None:
-            cls.market_hub = MarketHub()
+            with cls.market_hub_lock:
+                if cls.market_hub is None:
+                    cls.market_hub = MarketHub()
 
         return cls.market_hub
 
+    @classmethod
+    def warm_up(cls) -> concurrent.futures.Future:
+        """
+            Starts loading the markets in the background. The returned future is done when all of them are loaded.
+        """
+        market_hub = cls.get()
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='MarketHubWarmUp')
+        future = executor.submit(market_hub._load)
+        executor.shutdown(wait=False)
+        market_hub.warm_up_future = future
+
+        return future
+
+    def load(self):
+        """
+            Loads concurrently all the markets that are not loaded yet. If they are warming up, it waits for the warm up
+            & raises its error.
+        """
+        if self.warm_up_future is not None:
+            self.warm_up_future.result()
+
+        self._load()
+
+    def _load(self):
+        markets = [market for market in self.markets if not market.is_loaded]
+        if len(markets) <= 1:
+            for market in markets:
+                market.load()
+
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(markets)) as executor:
+            futures = [executor.submit(market.load) for market in markets]
+            for future in futures:
+                future.result()
+
+    def get_version(self) -> str:
+        return ','.join(market.get_version() for market in self.markets)
+
     def query(self, holding: Holding) -> Optional[Holding]:
-        for market in self.markets:
-            queried_holding = market.query(holding)
-            if queried_holding:
-                return queried_holding
+        return self.query_many([holding])[0]
+
+    def query_many(self, holdings: List[Holding]) -> List[Optional[Holding]]:
+        """
+            Resolves all the holdings in one pass: the holdings that are not cached are deduplicated & every market
+            is queried only for the holdings that were not found in the previous markets.
+            It is thread safe.
+        """
+        results = dict()
+        missed_holdings = dict()
+        with self.lock:
+            for holding in holdings:
+                key = self.get_cache_key(holding)
+                if key in results or key in missed_holdings:
+                    continue
+
+                if key in self.query_cache:
+                    self.query_cache.move_to_end(key)
+                    results[key] = self.query_cache[key]
+                    self.hits += 1
+                elif key in self.negative_query_cache:
+                    self.negative_query_cache.move_to_end(key)
+                    results[key] = None
+                    self.negative_hits += 1
+                else:
+                    missed_holdings[key] = holding
+                    self.misses += 1
+
+        tracing.count('market_hub.queries', len(holdings))
+        tracing.count('market_hub.misses', len(missed_holdings))
+
+        # The markets are read only after they are loaded, so they are queried without holding the lock.
+        found_holdings = dict()
+        if len(missed_holdings) > 0:
+            with tracing.span('market_hub.resolve', holdings=len(missed_holdings)):
+                self.load()
+
+                for market in self.markets:
+                    if len(missed_holdings) == 0:
+                        break
+
+                    keys = list(missed_holdings.keys())
+                    queried_holdings = market.query_many(list(missed_holdings.values()))
+                    for key, queried_holding in zip(keys, queried_holdings):
+                        if queried_holding:
+                            found_holdings[key] = queried_holding
+                            del missed_holdings[key]
+
+        with self.lock:
+            for key, found_holding in found_holdings.items():
+                results[key] = found_holding
+                self._cache(self.query_cache, key, found_holding, self.QUERY_CACHE_SIZE)
+
+            for key in missed_holdings.keys():
+                results[key] = None
+                self._cache(self.negative_query_cache, key, None, self.NEGATIVE_QUERY_CACHE_SIZE)
+
+        return [results[self.get_cache_key(holding)] for holding in holdings]
+
+    @classmethod
+    def get_cache_key(cls, holding: Holding) -> Tuple[str, Optional[str]]:
+        return holding.normalized_name, HoldingIndex.normalize_ticker(holding.ticker)
+
+    @classmethod
+    def _cache(cls, cache: OrderedDict, key, value, max_size: int):
+        cache[key] = value
+        if len(cache) > max_size:
+            cache.popitem(last=False)
+
+    def cache_info(self) -> dict:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'size': len(self.query_cache),
+                'negative_size': len(self.negative_query_cache)
+            }
 
-        return None
+    def clear_cache(self):
+        with self.lock:
+            self.query_cache.clear()
+            self.negative_query_cache.clear()
 
 
 if __name__ == '__main__':
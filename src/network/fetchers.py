@@ -0,0 +1,203 @@
+import concurrent.futures
+import json
+import os
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+
+import tqdm
+
+from src import tracing
+
+# ConnectionError, TimeoutError & the requests exceptions are all OSErrors.
+RETRYABLE_EXCEPTIONS: Tuple[Type[BaseException], ...] = (OSError, )
+
+
+class TokenBucket:
+    """
+        Thread-safe rate limiter: `rate` tokens are added every second, up to `capacity`. Every request takes a token
+        & waits if there is none.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        assert rate > 0
+
+        self.rate = rate
+        self.capacity = capacity or max(1., rate)
+
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait_time = (1 - self._tokens) / self.rate
+
+            time.sleep(wait_time)
+
+
+class FetchCheckpoint:
+    """
+        Append-only JSON lines file with the fetched results, so an interrupted fetch can be resumed.
+        Results older than `max_age` seconds are ignored.
+    """
+
+    def __init__(self, path: str, max_age: Optional[float] = None, flush_every: int = 100):
+        self.path = Path(path)
+        self.max_age = max_age
+        self.flush_every = flush_every
+
+        self._buffer: List[str] = []
+        self._lock = threading.Lock()
+
+    def load(self) -> Dict[str, Any]:
+        if not self.path.exists():
+            return dict()
+
+        results = dict()
+        now = time.time()
+        with open(str(self.path), 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line is incomplete if the process was killed while writing it.
+                    continue
+
+                if self.max_age is not None and now - entry['timestamp'] > self.max_age:
+                    continue
+
+                results[entry['key']] = entry['value']
+
+        return results
+
+    def add(self, key: str, value: Any):
+        with self._lock:
+            self._buffer.append(json.dumps({'key': key, 'value': value, 'timestamp': time.time()}))
+            should_flush = len(self._buffer) >= self.flush_every
+
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if len(self._buffer) == 0:
+                return
+
+            with open(str(self.path), 'a') as f:
+                f.write('\n'.join(self._buffer) + '\n')
+            self._buffer = []
+
+    def clear(self):
+        with self._lock:
+            self._buffer = []
+            if self.path.exists():
+                os.remove(str(self.path))
+
+
+class FetchPipeline:
+    """
+        Fetches keys concurrently with:
+            - at most `max_workers` requests in flight
+            - at most `requests_per_second` requests started per second ( token bucket)
+            - up to `max_retries` retries with exponential backoff & jitter, for the retryable exceptions
+            - periodic checkpoints: the keys found in the checkpoint are not fetched again
+
+        The keys that still fail after the retries are not returned & are listed in `failed_keys`.
+    """
+
+    def __init__(
+            self,
+            fetch: Callable[[str], Any],
+            max_workers: int = 8,
+            requests_per_second: float = 5.,
+            max_retries: int = 3,
+            backoff_base: float = 1.,
+            backoff_max: float = 30.,
+            checkpoint: Optional[FetchCheckpoint] = None,
+            retryable_exceptions: Tuple[Type[BaseException], ...] = RETRYABLE_EXCEPTIONS
+    ):
+        self.fetch = fetch
+        self.max_workers = max_workers
+        self.rate_limiter = TokenBucket(requests_per_second)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.checkpoint = checkpoint
+        self.retryable_exceptions = retryable_exceptions
+
+        self.failed_keys: List[str] = []
+
+    def run(self, keys: List[str], description: str = None) -> Dict[str, Any]:
+        with tracing.span('fetch', description=description, keys=len(keys)):
+            return self._run(keys, description)
+
+    def _run(self, keys: List[str], description: str = None) -> Dict[str, Any]:
+        self.failed_keys = []
+
+        results = dict()
+        if self.checkpoint is not None:
+            checkpointed_results = self.checkpoint.load()
+            results = {key: checkpointed_results[key] for key in keys if key in checkpointed_results}
+
+        pending_keys = [key for key in keys if key not in results]
+        tracing.count('fetch.checkpointed', len(results))
+        if len(pending_keys) == 0:
+            return results
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        futures = {executor.submit(self._fetch_with_retries, key): key for key in pending_keys}
+        try:
+            for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc=description):
+                key = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f'Could not fetch {key}: {e}')
+                    self.failed_keys.append(key)
+                    tracing.count('fetch.failed')
+                    continue
+
+                results[key] = result
+                tracing.count('fetch.fetched')
+                if self.checkpoint is not None:
+                    self.checkpoint.add(key, result)
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+            if self.checkpoint is not None:
+                self.checkpoint.flush()
+
+        return results
+
+    def _fetch_with_retries(self, key: str) -> Any:
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                return self.fetch(key)
+            except self.retryable_exceptions:
+                if attempt >= self.max_retries:
+                    raise
+
+                tracing.count('fetch.retries')
+                time.sleep(self.get_backoff(attempt))
+                attempt += 1
+
+    def get_backoff(self, attempt: int) -> float:
+        backoff = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+
+        return backoff * (0.5 + random.random() / 2)
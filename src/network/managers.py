@@ -1,59 +1,267 @@
+import json
 import os
 import pickle
+import threading
 from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Tuple
 
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow,Flow
-from google.auth.transport.requests import Request
-from googleapiclient.errors import HttpError
-from requests.api import get
-
+from src import settings, tracing
 from src.exceptions import DownloadError
-from src.settings import STORAGE_PATH, GOOGLE_SHEETS_CREDENTIALS_PATH
+
+if TYPE_CHECKING:
+    import requests
+
+"""
+    The HTTP & Google clients are imported only by the code that uses them, because they are slow to import.
+"""
 
 
 class DownloadManager:
-    def __init__(self, url: str, file_name: str):
+    """
+        Downloads a file to `STORAGE_PATH`:
+            - through a session shared by all the downloads, so the connections are pooled & reused
+            - with a timeout & bounded retries, with backoff, for the connection errors & the 429 / 5xx responses
+            - streamed to disk in chunks, through a temporary file, so a failed download doesn't leave a partial file
+
+        The ETag & Last-Modified headers of every download are kept in a metadata file. If the file was already
+        downloaded, the request is conditional & an unchanged file ( 304) is not downloaded again.
+    """
+
+    TIMEOUT = (10, 60)
+    CHUNK_SIZE = 2 ** 16
+    MAX_RETRIES = 3
+    BACKOFF_FACTOR = 0.5
+    POOL_SIZE = 16
+
+    session: 'requests.Session' = None
+    session_lock = threading.Lock()
+    metadata_lock = threading.Lock()
+
+    def __init__(self, url: str, file_name: str, keep_file: bool = True):
+        """
+            keep_file: if False, the file is removed when the context manager exits.
+        """
         self.url = url
         self.file_name = file_name
-        self.file_path = os.path.abspath(os.path.join(STORAGE_PATH, file_name))
+        self.file_path = os.path.abspath(os.path.join(settings.STORAGE_PATH, file_name))
+        self.keep_file = keep_file
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if Path(self.file_name).exists():
-            os.remove(self.file_name)
-
+        if not self.keep_file and Path(self.file_path).exists():
+            os.remove(self.file_path)
+
+    @classmethod
+    def get_metadata_file(cls) -> Path:
+        return Path(settings.STORAGE_PATH) / 'downloads_metadata.json'
+
+    @classmethod
+    def get_session(cls) -> 'requests.Session':
+        from requests import Session
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        if cls.session is None:
+            with cls.session_lock:
+                if cls.session is None:
+                    retry = Retry(
+                        total=cls.MAX_RETRIES,
+                        backoff_factor=cls.BACKOFF_FACTOR,
+                        status_forcelist=(429, 500, 502, 503, 504),
+                        raise_on_status=False
+                    )
+                    adapter = HTTPAdapter(pool_connections=cls.POOL_SIZE, pool_maxsize=cls.POOL_SIZE, max_retries=retry)
+
+                    session = Session()
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    cls.session = session
+
+        return cls.session
+
+    @tracing.traced('download')
     def download(self):
-        with open(self.file_path, "wb") as file:
-            response = get(self.url)
+        from requests.exceptions import RequestException
+
+        metadata = self.get_metadata()
+        headers = dict()
+        if Path(self.file_path).exists() and metadata.get('url') == self.url:
+            if metadata.get('etag'):
+                headers['If-None-Match'] = metadata['etag']
+            if metadata.get('last_modified'):
+                headers['If-Modified-Since'] = metadata['last_modified']
+
+        try:
+            response = self.get_session().get(self.url, headers=headers, stream=True, timeout=self.TIMEOUT)
+        except RequestException as e:
+            raise DownloadError(self.file_name) from e
+
+        with response:
+            if response.status_code == 304:
+                tracing.count('download.not_modified')
 
-            if response.status_code == 500:
+                return self.file_path
+
+            if response.status_code >= 400:
                 raise DownloadError(self.file_name)
 
-            file.write(response.content)
+            temporary_path = f'{self.file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            num_bytes = 0
+            try:
+                with open(temporary_path, 'wb') as file:
+                    for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                        file.write(chunk)
+                        num_bytes += len(chunk)
+            except RequestException as e:
+                os.remove(temporary_path)
+                raise DownloadError(self.file_name) from e
+
+            os.replace(temporary_path, self.file_path)
+            tracing.count('download.bytes', num_bytes)
+
+            self.save_metadata({
+                'url': self.url,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')
+            })
 
         return self.file_path
 
+    def get_metadata(self) -> dict:
+        return self._read_metadata_file().get(self.file_name, dict())
 
-class GoogleAPIManager:
-    SCOPES = []
-    API_SERVICE_NAME = None
-    API_VERSION = None
+    def save_metadata(self, metadata: dict):
+        with self.metadata_lock:
+            all_metadata = self._read_metadata_file()
+            all_metadata[self.file_name] = metadata
 
-    def __init__(self):
-        assert len(self.SCOPES) > 0
-        assert self.API_SERVICE_NAME is not None
-        assert self.API_VERSION is not None
+            metadata_file = self.get_metadata_file()
+            temporary_path = f'{metadata_file}.{os.getpid()}.tmp'
+            with open(temporary_path, 'w') as f:
+                json.dump(all_metadata, f)
+            os.replace(temporary_path, str(metadata_file))
+
+    @classmethod
+    def _read_metadata_file(cls) -> dict:
+        metadata_file = cls.get_metadata_file()
+        if not metadata_file.exists():
+            return dict()
 
-        self.token_name = f'token_{self.API_SERVICE_NAME}_{self.API_VERSION}.pickle'
-        self.token_path = os.path.abspath(os.path.join(STORAGE_PATH, self.token_name))
-        self.credentials = self._get_credentials()
+        try:
+            with open(str(metadata_file), 'r') as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            return dict()
+
+
+class GoogleAPIClient:
+    """
+        A Google API service, shared by all the managers of the process. It is built once, from the discovery document
+        bundled in `src/network/discovery`, so no discovery document is requested.
+
+        The credentials are loaded once & refreshed under a lock, by the first request that finds them expired.
+        The HTTP connections are not thread-safe, so every thread sends its requests through its own connection.
+
+        If `GOOGLE_API_URL` is set, the requests are sent to that server instead of Google ( ex. a local fake Sheets
+        server), without credentials.
+    """
+
+    DISCOVERY_DIR = Path(__file__).parent / 'discovery'
+    TIMEOUT = 60
+
+    clients: Dict[Tuple[str, str], 'GoogleAPIClient'] = dict()
+    clients_lock = threading.Lock()
+
+    def __init__(self, api_service_name: str, api_version: str, scopes: List[str]):
+        from googleapiclient.discovery import build_from_document
+
+        self.api_service_name = api_service_name
+        self.api_version = api_version
+        self.scopes = scopes
+        self.url = settings.GOOGLE_API_URL
+
+        self.token_name = f'token_{api_service_name}_{api_version}.pickle'
+        self.token_path = os.path.abspath(os.path.join(settings.STORAGE_PATH, self.token_name))
+        self.credentials = self._get_credentials() if self.url is None else None
+        self.credentials_lock = threading.Lock()
+        self.local = threading.local()
+
+        with open(self.DISCOVERY_DIR / f'{api_service_name}.{api_version}.json', 'r') as f:
+            discovery_document = f.read()
+
+        with tracing.span('google_api.build', service=api_service_name):
+            self.service = build_from_document(
+                discovery_document,
+                http=self.get_http(),
+                client_options={'api_endpoint': self.url} if self.url is not None else None
+            )
+
+    @classmethod
+    def get(cls, api_service_name: str, api_version: str, scopes: List[str]) -> 'GoogleAPIClient':
+        key = (api_service_name, api_version)
+        if key not in cls.clients:
+            with cls.clients_lock:
+                if key not in cls.clients:
+                    cls.clients[key] = cls(api_service_name, api_version, scopes)
+
+        return cls.clients[key]
+
+    @classmethod
+    def clear(cls):
+        with cls.clients_lock:
+            cls.clients.clear()
+
+    @classmethod
+    def reset_connections(cls):
+        """
+            Drops the connections of all the clients. Call it in a forked process, which can't share the connections
+            of its parent.
+        """
+        with cls.clients_lock:
+            for client in cls.clients.values():
+                client.local = threading.local()
+
+    def execute(self, request):
+        """
+            Sends the request through the connection of the current thread.
+        """
+        self._refresh_credentials()
+        tracing.count('google_api.requests')
+
+        return request.execute(http=self.get_http())
+
+    def get_http(self):
+        import httplib2
+
+        http = getattr(self.local, 'http', None)
+        if http is None:
+            http = httplib2.Http(timeout=self.TIMEOUT)
+            if self.credentials is not None:
+                from google_auth_httplib2 import AuthorizedHttp
+
+                http = AuthorizedHttp(self.credentials, http=http)
+            self.local.http = http
 
-        self.service = build(self.API_SERVICE_NAME, self.API_VERSION, credentials=self.credentials)
+        return http
+
+    def _refresh_credentials(self):
+        if self.credentials is None or self.credentials.valid:
+            return
+
+        with self.credentials_lock:
+            # Another thread could have refreshed them while this one waited for the lock.
+            if not self.credentials.valid:
+                from google.auth.transport.requests import Request
+
+                self.credentials.refresh(Request())
+                self._save_credentials(self.credentials)
 
     def _get_credentials(self):
+        from google.auth.transport.requests import Request
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
         credentials = None
 
         if os.path.exists(self.token_path):
@@ -65,16 +273,38 @@ class GoogleAPIManager:
                 credentials.refresh(Request())
             else:
                 flow = InstalledAppFlow.from_client_secrets_file(
-                    GOOGLE_SHEETS_CREDENTIALS_PATH,
-                    self.SCOPES
+                    settings.GOOGLE_SHEETS_CREDENTIALS_PATH,
+                    self.scopes
                 )
                 credentials = flow.run_local_server(port=0)
 
-            with open(self.token_path, 'wb') as token:
-                pickle.dump(credentials, token)
+            self._save_credentials(credentials)
 
         return credentials
 
+    def _save_credentials(self, credentials):
+        temporary_path = f'{self.token_path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as token:
+            pickle.dump(credentials, token)
+        os.replace(temporary_path, self.token_path)
+
+
+class GoogleAPIManager:
+    SCOPES = []
+    API_SERVICE_NAME = None
+    API_VERSION = None
+
+    def __init__(self):
+        assert len(self.SCOPES) > 0
+        assert self.API_SERVICE_NAME is not None
+        assert self.API_VERSION is not None
+
+        self.client = GoogleAPIClient.get(self.API_SERVICE_NAME, self.API_VERSION, self.SCOPES)
+        self.service = self.client.service
+
+    def execute(self, request):
+        return self.client.execute(request)
+
     def read(self, **kwargs):
         raise NotImplementedError()
 
@@ -87,48 +317,189 @@ class GoogleSheetsManager(GoogleAPIManager):
     API_SERVICE_NAME = 'sheets'
     API_VERSION = 'v4'
 
+    # The recommended max payload of a request is 2 MB. The estimate of a payload doesn't count all of its JSON.
+    MAX_REQUEST_BYTES = 2 ** 20
+
     def __init__(self, spreadsheet_id: str):
         super().__init__()
         self.spreadsheet_id = spreadsheet_id
         self.spreadsheets = self.service.spreadsheets()
 
+    @tracing.traced('sheets.read')
     def read(self, **kwargs) -> list:
         """
             sheet_range: This could be only the name of the Sheet ( ex: Stocks), files range ( A1:I15),
                 or both ( Stocks!A1:I15)
+            value_render_option: FORMATTED_VALUE ( the values as they are displayed), UNFORMATTED_VALUE or FORMULA
         """
 
         sheet_range = kwargs.get('sheet_range')
+        value_render_option = kwargs.get('value_render_option', 'FORMATTED_VALUE')
         assert isinstance(sheet_range, str)
 
-        result_input = self.spreadsheets.values().get(
+        result_input = self.execute(self.spreadsheets.values().get(
             spreadsheetId=self.spreadsheet_id,
-            range=sheet_range
-        ).execute()
+            range=sheet_range,
+            valueRenderOption=value_render_option
+        ))
 
         return result_input.get('values', [])
 
+    @tracing.traced('sheets.write')
     def write(self, **kwargs):
+        """
+            Writes the data to the workspace, which is created if it doesn't exist. Only the cells that changed are
+            written: the current values of the workspace are read & diffed with the data, & the changed ranges are
+            written in one batch update ( or more, if the payload is too big). The cells of the workspace that are
+            outside the data are cleared. If nothing changed, nothing is written.
+        """
+        from googleapiclient.errors import HttpError
+
         data = kwargs.get('data')
         workspace_name = kwargs.get('workspace_name')
 
-        try:
-            self.add_workspace(workspace_name)
-        except HttpError:
-            self.clear_workspace(workspace_name)
-
         assert isinstance(data, list) and isinstance(data[0], list)
         assert isinstance(workspace_name, str)
 
-        self.spreadsheets.values().update(
-            spreadsheetId=self.spreadsheet_id,
-            valueInputOption='RAW',
-            range=workspace_name,
-            body={
+        try:
+            current_data = self.read(sheet_range=self.quote(workspace_name), value_render_option='UNFORMATTED_VALUE')
+        except HttpError as e:
+            # A range of a missing workspace can't be parsed.
+            if e.resp.status != 400:
+                raise
+
+            self.add_workspace(workspace_name)
+            current_data = []
+
+        value_ranges = self.get_changed_ranges(workspace_name, current_data, data)
+        for value_ranges_chunk in self.chunk(value_ranges):
+            self.execute(self.spreadsheets.values().batchUpdate(
+                spreadsheetId=self.spreadsheet_id,
+                body={
+                    'valueInputOption': 'RAW',
+                    'data': value_ranges_chunk
+                }
+            ))
+            tracing.count('sheets.requests')
+
+    @classmethod
+    def get_changed_ranges(cls, workspace_name: str, current_data: List[list], data: List[list]) -> List[dict]:
+        """
+            Returns the ranges of the cells that are different in `data` than in `current_data`, with their new values.
+            The consecutive changed rows are merged into one range, which spans the changed columns of all of them
+            ( the unchanged cells inside it are written again, with the same values).
+        """
+        value_ranges = []
+        block = None
+        for row_index in range(max(len(current_data), len(data))):
+            current_row = current_data[row_index] if row_index < len(current_data) else []
+            row = data[row_index] if row_index < len(data) else []
+
+            changed_columns = [
+                column for column in range(max(len(current_row), len(row)))
+                if cls.get_cell(current_row, column) != cls.get_cell(row, column)
+            ]
+            if len(changed_columns) == 0:
+                block = None
+                continue
+            tracing.count('sheets.changed_cells', len(changed_columns))
+
+            first_column, last_column = changed_columns[0], changed_columns[-1]
+            if block is not None and block['size'] < cls.MAX_REQUEST_BYTES:
+                block['first_column'] = min(block['first_column'], first_column)
+                block['last_column'] = max(block['last_column'], last_column)
+                block['rows'].append(row)
+            else:
+                block = {
+                    'first_row': row_index,
+                    'first_column': first_column,
+                    'last_column': last_column,
+                    'rows': [row],
+                    'size': 0
+                }
+                value_ranges.append(block)
+            block['size'] += len(json.dumps([cls.get_cell(row, column) for column in range(len(row))]))
+
+        return [
+            {
+                'range': cls.to_a1_range(
+                    workspace_name,
+                    block['first_row'],
+                    block['first_column'],
+                    block['first_row'] + len(block['rows']) - 1,
+                    block['last_column']
+                ),
                 'majorDimension': 'ROWS',
-                'values': data
+                'values': [
+                    [cls.get_cell(row, column) for column in range(block['first_column'], block['last_column'] + 1)]
+                    for row in block['rows']
+                ]
             }
-        ).execute()
+            for block in value_ranges
+        ]
+
+    @classmethod
+    def chunk(cls, value_ranges: List[dict]) -> List[List[dict]]:
+        """
+            Splits the ranges into chunks with a payload of at most `MAX_REQUEST_BYTES` ( a range over it is a chunk
+            of its own).
+        """
+        chunks = []
+        chunk_size = 0
+        for value_range in value_ranges:
+            size = len(json.dumps(value_range))
+            if len(chunks) == 0 or chunk_size + size > cls.MAX_REQUEST_BYTES:
+                chunks.append([])
+                chunk_size = 0
+
+            chunks[-1].append(value_range)
+            chunk_size += size
+
+        return chunks
+
+    @classmethod
+    def get_cell(cls, row: list, column: int):
+        """
+            The missing cells & the None values are empty strings, as they are read from the sheet.
+        """
+        if column >= len(row) or row[column] is None:
+            return ''
+
+        return row[column]
+
+    @classmethod
+    def quote(cls, workspace_name: str) -> str:
+        return "'" + workspace_name.replace("'", "''") + "'"
+
+    @classmethod
+    def to_a1_range(
+            cls,
+            workspace_name: str,
+            first_row: int,
+            first_column: int,
+            last_row: int,
+            last_column: int
+    ) -> str:
+        """
+            The rows & the columns are 0-based & the last ones are included.
+        """
+        first_cell = f'{cls.to_column_name(first_column)}{first_row + 1}'
+        last_cell = f'{cls.to_column_name(last_column)}{last_row + 1}'
+
+        return f'{cls.quote(workspace_name)}!{first_cell}:{last_cell}'
+
+    @classmethod
+    def to_column_name(cls, column: int) -> str:
+        """
+            ( ex. 0 -> A, 25 -> Z, 26 -> AA)
+        """
+        name = ''
+        column += 1
+        while column > 0:
+            column, remainder = divmod(column - 1, 26)
+            name = chr(ord('A') + remainder) + name
+
+        return name
 
     def add_workspace(self, name: str):
         request_body = {
@@ -141,15 +512,15 @@ class GoogleSheetsManager(GoogleAPIManager):
             }]
         }
 
-        response = self.spreadsheets.batchUpdate(
+        response = self.execute(self.spreadsheets.batchUpdate(
             spreadsheetId=self.spreadsheet_id,
             body=request_body
-        ).execute()
+        ))
 
         return response
 
     def clear_workspace(self, name: str):
-        self.spreadsheets.values().clear(
+        self.execute(self.spreadsheets.values().clear(
             spreadsheetId=self.spreadsheet_id,
             range=name
-        ).execute()
+        ))
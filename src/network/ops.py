@@ -1,9 +1,9 @@
 from typing import Optional
 
-from src import network
+from src import network, settings
+from src.disk.caches import FundCache
 from src.factories import get_factory, create_portfolio_google_sheets
 from src.instruments import ETF, MultipleItemsFinancialInstrument
-from src.settings import SPREAD_SHEET_ID
 from src.network.managers import DownloadManager, GoogleSheetsManager
 
 
@@ -42,7 +42,7 @@ def _get_etf(ticker: str, source: str) -> Optional[ETF]:
     etf_file_name = f'{ticker}'
     with DownloadManager(etf_url, etf_file_name) as d:
         etf_file_path = d.download()
-        etf = factory(ticker, etf_file_path)
+        etf = FundCache().get_or_create(ticker, source, etf_file_path, factory)
 
         return etf
 
@@ -56,7 +56,7 @@ def get_google_sheets(sheet_range: str) -> Optional[MultipleItemsFinancialInstru
         The first line should contain ONLY the columns of the table.
         Mandatory columns: 'Name', 'Ticker', 'Percentage', 'Type'
     """
-    google_sheets_manager = GoogleSheetsManager(SPREAD_SHEET_ID)
+    google_sheets_manager = GoogleSheetsManager(settings.SPREAD_SHEET_ID)
     data = google_sheets_manager.read(sheet_range=sheet_range)
 
     is_only_data_range = '!' not in sheet_range and ':' in sheet_range
@@ -0,0 +1,59 @@
+from typing import Optional
+
+from src import settings
+from src.exceptions import QuoteError
+
+
+class QuoteManager:
+    """
+        Source of the company info for a ticker, with the Yahoo keys ( `shortName`, `region`, `financialCurrency` etc.).
+        It raises an OSError ( ex. ConnectionError) when the request can be retried & a QuoteError when it can't.
+    """
+
+    def get_info(self, ticker: str) -> dict:
+        raise NotImplementedError()
+
+
+class YahooQuoteManager(QuoteManager):
+    def get_info(self, ticker: str) -> dict:
+        import yfinance
+
+        return yfinance.Ticker(ticker).info or dict()
+
+
+class QuoteServerManager(QuoteManager):
+    """
+        Requests the info from `{base_url}/quote/{ticker}`. A missing ticker is answered with 404, a throttled or failed
+        request with 429 or 5xx & a request that can't be answered ( ex. a bad ticker) with another 4xx.
+        See `benchmarks.quote_server` for a local fake server.
+    """
+
+    TIMEOUT = 10
+
+    def __init__(self, base_url: str):
+        import requests
+
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+
+    def get_info(self, ticker: str) -> dict:
+        response = self.session.get(f'{self.base_url}/quote/{ticker}', timeout=self.TIMEOUT)
+        if response.status_code == 404:
+            return dict()
+
+        # HTTPError is a RequestException, so the throttled & failed requests are retried.
+        if response.status_code == 429 or response.status_code >= 500:
+            response.raise_for_status()
+        # The other client errors would fail the same way on every retry.
+        if response.status_code >= 400:
+            raise QuoteError(ticker, f'{response.status_code} {response.reason}')
+
+        return response.json()
+
+
+def get_quote_manager(base_url: Optional[str] = None) -> QuoteManager:
+    base_url = base_url or settings.QUOTE_SERVER_URL
+    if base_url:
+        return QuoteServerManager(base_url)
+
+    return YahooQuoteManager()
@@ -0,0 +1,9 @@
+import json
+import os
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_mappings():
+    with open(f'{CURRENT_DIR}/mappings.json', 'r') as f:
+        return json.load(f)
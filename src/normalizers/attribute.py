@@ -1,27 +1,71 @@
-from typing import Optional
+import functools
+from typing import Dict, Optional, Union, Iterable
+
+import numpy as np
+import pandas as pd
 
 from src.choices import HoldingTypeChoices
+from src.normalizers import get_mappings
+
+NAME_CACHE_SIZE = 2 ** 16
+NAME_TRANSLATION_TABLE = str.maketrans({
+    '.': ' ',
+    '-': ' ',
+    '&': ' ',
+    '(': None,
+    ')': None
+})
 
 
 class HoldingAttributesNormalizer:
+    """
+        The country & sector mappings are loaded from `mappings.json`, by Vanguard standards. A mapping table is
+        a dictionary with the standard value as key & its aliases as value. The aliases are matched case-insensitively.
+        Values that are not in the table are returned as they are.
+
+        The batch methods ( `normalize_names`, `normalize_countries` etc.) normalize every distinct value only once.
+    """
+
+    countries: Dict[str, str] = None
+    sectors: Dict[str, str] = None
+
+    @classmethod
+    def load_mappings(cls, mappings: Optional[dict] = None):
+        mappings = mappings or get_mappings()
+
+        cls.countries = cls._to_lookup_table(mappings['countries'])
+        cls.sectors = cls._to_lookup_table(mappings['sectors'])
+
+    @classmethod
+    def _to_lookup_table(cls, mapping: Dict[str, list]) -> Dict[str, str]:
+        lookup_table = dict()
+        for standard_value, aliases in mapping.items():
+            for value in [standard_value, *aliases]:
+                lookup_table[cls._to_lookup_key(value)] = standard_value
+
+        return lookup_table
 
     @classmethod
+    def _to_lookup_key(cls, value: str) -> str:
+        return value.strip().upper()
+
+    @classmethod
+    def _look_up(cls, lookup_table: Dict[str, str], value):
+        if not isinstance(value, str):
+            return value
+
+        return lookup_table.get(cls._to_lookup_key(value), value)
+
+    @classmethod
+    @functools.lru_cache(maxsize=NAME_CACHE_SIZE)
     def normalize_name(cls, name) -> str:
         assert name is not None
 
         name = name.split(',')[0].strip('\n ')
-        name = name.replace('.', ' ')
-        name = name.replace('-', ' ')
-        name = name.replace('&', ' ')
+        name = name.translate(NAME_TRANSLATION_TABLE)
 
-        name = name.replace('(', '')
-        name = name.replace(')', '')
-
-        name_items = name.upper().split(' ')
-
-        # Some names have more than one space --> strip & remove it.
-        name_items = [name.strip(' ') for name in name_items if len(name) > 0]
-        name_items = [item.capitalize() for item in name_items]
+        # Some names have more than one space --> remove the empty items.
+        name_items = [item.capitalize() for item in name.upper().split(' ') if len(item) > 0]
 
         return ' '.join(name_items)
 
@@ -31,34 +75,20 @@ class HoldingAttributesNormalizer:
             Normalize sector by Vanguard standards.
         """
         # TODO: Not 100% sure if the mappings are correct.
+        if cls.sectors is None:
+            cls.load_mappings()
 
-        if sector in ['Information Technology']:
-            return 'Technology'
-
-        if sector in ['Communication']:
-            return 'Telecommunications'
-
-        if sector in ['Consumer Discretionary']:
-            return 'Consumer Services'
-
-        if sector in ['Consumer Staples']:
-            return 'Consumer Goods'
-
-        if sector in ['Materials']:
-            return 'Basic Materials'
-
-        return sector
+        return cls._look_up(cls.sectors, sector)
 
     @classmethod
     def normalize_country(cls, country: str) -> str:
         """
             Normalize country by Vanguard standards.
         """
+        if cls.countries is None:
+            cls.load_mappings()
 
-        if country in ['US', 'U.S.']:
-            country = 'United States'
-
-        return country
+        return cls._look_up(cls.countries, country)
 
     @classmethod
     def normalize_type(cls, holding_type: str) -> Optional[HoldingTypeChoices]:
@@ -69,3 +99,41 @@ class HoldingAttributesNormalizer:
         assert holding_type in [holding_type.value for holding_type in HoldingTypeChoices]
 
         return HoldingTypeChoices(holding_type)
+
+    @classmethod
+    def normalize_names(cls, names: Union[pd.Series, np.ndarray, Iterable[str]]) -> Union[pd.Series, np.ndarray]:
+        return cls._normalize_batch(names, cls.normalize_name)
+
+    @classmethod
+    def normalize_sectors(cls, sectors: Union[pd.Series, np.ndarray, Iterable[str]]) -> Union[pd.Series, np.ndarray]:
+        return cls._normalize_batch(sectors, cls.normalize_sector)
+
+    @classmethod
+    def normalize_countries(
+            cls,
+            countries: Union[pd.Series, np.ndarray, Iterable[str]]
+    ) -> Union[pd.Series, np.ndarray]:
+        return cls._normalize_batch(countries, cls.normalize_country)
+
+    @classmethod
+    def normalize_types(cls, holding_types: Union[pd.Series, np.ndarray, Iterable[str]]) -> Union[pd.Series, np.ndarray]:
+        return cls._normalize_batch(holding_types, cls.normalize_type)
+
+    @classmethod
+    def _normalize_batch(cls, values, normalize) -> Union[pd.Series, np.ndarray]:
+        """
+            Normalizes every distinct value once & broadcasts the results back. Missing values become None.
+        """
+        series = values if isinstance(values, pd.Series) else pd.Series(np.asarray(values, dtype=object))
+
+        codes, distinct_values = pd.factorize(series)
+        normalized_values = np.empty(len(distinct_values) + 1, dtype=object)
+        normalized_values[:-1] = [normalize(value) for value in distinct_values]
+        normalized_values[-1] = None
+
+        # The missing values have the code -1, which points to the last item: None.
+        normalized = normalized_values[codes]
+        if isinstance(values, pd.Series):
+            return pd.Series(normalized, index=values.index, name=values.name, dtype=object)
+
+        return normalized
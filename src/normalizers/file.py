@@ -1,5 +1,10 @@
+import contextlib
+import io
+from typing import IO, Iterator, Union
+
 import pandas as pd
 
+from src import tracing
 from src.utils import has_digits
 
 """
@@ -7,41 +12,48 @@ from src.utils import has_digits
         - be a csv file
         - can be read by pandas read_csv(path_to_file)
         - the number of items in a row has to be the same as the number of columns
+
+    The files are normalized in memory: the source file is read once, line by line, & the valid lines are returned
+    in a buffer that pandas reads directly. Nothing is written to disk, so the source files can be read only.
+    The source is a path or a binary file-like object ( ex. the content of a downloaded file).
 """
 
+FileSource = Union[str, IO[bytes]]
 
-def normalize_vanguard_csv_file(path_to_file: str) -> str:
-    return normalize_csv_file(path_to_file)
 
+def normalize_vanguard_csv_file(source: FileSource) -> io.StringIO:
+    return normalize_csv_file(source)
 
-def normalize_ishares_csv_file(path_to_file: str) -> str:
-    return normalize_csv_file(path_to_file)
 
+def normalize_ishares_csv_file(source: FileSource) -> io.StringIO:
+    return normalize_csv_file(source)
 
-def normalize_spdr_excel_file(path_to_file: str) -> str:
-    data_frame = pd.read_excel(path_to_file)
-    data_frame.to_csv(path_to_file, encoding='utf-8', index=False)
 
-    return normalize_csv_file(path_to_file)
+def normalize_spdr_excel_file(source: FileSource) -> io.StringIO:
+    data_frame = pd.read_excel(source)
 
+    csv_buffer = io.StringIO()
+    data_frame.to_csv(csv_buffer, encoding='utf-8', index=False)
+    csv_buffer.seek(0)
 
-def normalize_file_by_cutting_lines(path_to_file: str, lines_to_cut: int) -> str:
-    with open(path_to_file, 'r') as f:
-        lines = f.readlines()
-        normalized_lines = lines[lines_to_cut:]
+    return normalize_csv_file(csv_buffer)
 
-    # TODO: Delete this line after downloading VANGUARD dinamically from site.
-    if '(' in path_to_file and ')' in path_to_file:
-        path_to_file = f'{path_to_file.split(".csv")[0]}_normalized.csv'
 
-    with open(path_to_file, 'w') as f:
-        f.writelines(normalized_lines)
+def normalize_file_by_cutting_lines(source: Union[FileSource, IO[str]], lines_to_cut: int) -> io.StringIO:
+    normalized_buffer = io.StringIO()
+    with open_text_file(source) as f:
+        for line_number, line in enumerate(f):
+            if line_number >= lines_to_cut:
+                normalized_buffer.write(line)
 
-    return path_to_file
+    normalized_buffer.seek(0)
+
+    return normalized_buffer
 
 
 # TODO: Try to improve this generic normalization function.
-def normalize_csv_file(path_to_file: str) -> str:
+@tracing.traced('normalize')
+def normalize_csv_file(source: Union[FileSource, IO[str]]) -> io.StringIO:
     def valid_line_rule(line, num_items):
         if 'Unnamed' in line:
             return False
@@ -57,21 +69,28 @@ def normalize_csv_file(path_to_file: str) -> str:
 
         return True
 
-    with open(path_to_file, 'r') as f:
-        lines = f.readlines()
-
-        items_per_line = [len(line.split(',')) for line in lines]
-
-        normalized_lines = [
-            line for line, num_items in zip(lines, items_per_line)
-            if valid_line_rule(line, num_items)
-        ]
-
-    # TODO: Delete this line after downloading VANGUARD dinamically from site.
-    if '(' in path_to_file and ')' in path_to_file:
-        path_to_file = f'{path_to_file.split(".csv")[0]}_normalized.csv'
-
-    with open(path_to_file, 'w') as f:
-        f.writelines(normalized_lines)
-
-    return path_to_file
+    normalized_buffer = io.StringIO()
+    with open_text_file(source) as f:
+        for line in f:
+            if valid_line_rule(line, line.count(',') + 1):
+                normalized_buffer.write(line)
+
+    normalized_buffer.seek(0)
+
+    return normalized_buffer
+
+
+@contextlib.contextmanager
+def open_text_file(source: Union[FileSource, IO[str]]) -> Iterator[IO[str]]:
+    if isinstance(source, str):
+        with open(source, 'r') as f:
+            yield f
+    elif isinstance(source, io.TextIOBase):
+        yield source
+    else:
+        # Detach the wrapper at the end, so the binary buffer stays open for the caller.
+        text_file = io.TextIOWrapper(source)
+        try:
+            yield text_file
+        finally:
+            text_file.detach()
@@ -1,5 +1,9 @@
 from typing import List
 
+import pandas as pd
+
+from src.normalizers.attribute import HoldingAttributesNormalizer
+
 
 def normalize_google_sheets_list(data: List[list]) -> List[list]:
     standard_len = len(data[0])
@@ -18,3 +22,22 @@ def normalize_google_sheets_list(data: List[list]) -> List[list]:
             new_data.append(line)
 
     return new_data
+
+
+def normalize_holdings_data_frame(data_frame: pd.DataFrame) -> pd.DataFrame:
+    """
+        data_frame: Holding attributes as columns. The `name` column is mandatory.
+
+        Returns a data frame with the attributes of `Holding.from_normalized`. Missing values become None.
+    """
+    data_frame = data_frame.astype(object).where(data_frame.notna(), None)
+
+    data_frame['normalized_name'] = HoldingAttributesNormalizer.normalize_names(data_frame['name'])
+    if 'country' in data_frame.columns:
+        data_frame['country'] = HoldingAttributesNormalizer.normalize_countries(data_frame['country'])
+    if 'sector' in data_frame.columns:
+        data_frame['sector'] = HoldingAttributesNormalizer.normalize_sectors(data_frame['sector'])
+    if 'holding_type' in data_frame.columns:
+        data_frame['holding_type'] = HoldingAttributesNormalizer.normalize_types(data_frame['holding_type'])
+
+    return data_frame
@@ -1,45 +1,100 @@
 import datetime
 import os
+import threading
 from pathlib import Path
 
 import typing
-from dotenv import load_dotenv
-from marshmallow import Schema, fields, validates_schema, types
+
+"""
+    The settings are resolved lazily, at the first access of a setting ( ex. `settings.STORAGE_PATH`): only then the
+    `.env` file is loaded, the env vars are validated & the storage directory is created. So importing this module
+    has no side effects & doesn't import the validation libraries.
+"""
 
 PROJECT_DIR = Path().absolute()
 ENV_PATH = PROJECT_DIR / '.env'
 
-load_dotenv(ENV_PATH)
+_settings: typing.Optional[typing.Dict[str, typing.Any]] = None
+_settings_lock = threading.Lock()
+
+
+def get_env_vars_validator():
+    from marshmallow import Schema, fields, validates_schema, types
+
+    class EnvVarsValidator(Schema):
+        FILES_DIR = fields.String(missing=str(PROJECT_DIR / 'files'))
+        STORAGE_PATH = fields.String(missing=str(Path.home() / '.financial-portfolio-aggregator'))
+
+        GOOGLE_SHEETS_CREDENTIALS_PATH = fields.String(missing='./credentials.json')
+        SPREAD_SHEET_ID = fields.String(missing=None)
+        # If it is set, the Google APIs are requested from this server, without credentials ( ex. a local fake Sheets
+        # server).
+        GOOGLE_API_URL = fields.String(missing=None)
+
+        MARKET_CACHE_EXPIRATION_DAYS = fields.Integer(missing=31)
+        # The share of the tickers of a market that have to expire before the market is refreshed.
+        MARKET_REFRESH_EXPIRED_RATIO = fields.Float(missing=0.1)
+
+        FUND_CACHE_MAX_SIZE_MB = fields.Integer(missing=256)
+        # Keep the leaves of every fund & portfolio, so a change of weights is only recombined.
+        LEAVES_CACHE = fields.Boolean(missing=True)
+        LEAVES_CACHE_MAX_SIZE_MB = fields.Integer(missing=256)
+        # The number of funds that are downloaded & parsed concurrently.
+        LEAVES_MAX_WORKERS = fields.Integer(missing=4)
+        # The number of portfolios of a batch that are aggregated concurrently, in processes. Defaults to the CPUs.
+        BATCH_MAX_WORKERS = fields.Integer(missing=None)
+
+        # If it is set, the quotes are requested from this server instead of Yahoo ( ex. a local fake quote server).
+        QUOTE_SERVER_URL = fields.String(missing=None)
+        QUOTE_MAX_WORKERS = fields.Integer(missing=8)
+        QUOTE_REQUESTS_PER_SECOND = fields.Float(missing=5.)
+        QUOTE_MAX_RETRIES = fields.Integer(missing=3)
+
+        # If it is set, the run is traced & the trace is exported to this path, as a Chrome trace.
+        TRACE_PATH = fields.String(missing=None)
+        # Measure the peak memory of the traced stages. It makes the allocations slower.
+        TRACE_MEMORY = fields.Boolean(missing=True)
+
+        @validates_schema
+        def validate(
+            self,
+            data: typing.Mapping,
+            *,
+            many: bool = None,
+            partial: typing.Union[bool, types.StrSequenceOrSet] = None
+        ) -> typing.Dict[str, typing.List[str]]:
+            pass
+
+    return EnvVarsValidator()
+
+
+def load_settings() -> typing.Dict[str, typing.Any]:
+    from dotenv import load_dotenv
+
+    load_dotenv(ENV_PATH)
 
+    settings = get_env_vars_validator().load(data=os.environ, many=None, partial=None, unknown='EXCLUDE')
+    settings['MARKET_CACHE_EXPIRATION_DAYS'] = datetime.timedelta(days=settings['MARKET_CACHE_EXPIRATION_DAYS'])
 
-class EnvVarsValidator(Schema):
-    FILES_DIR = fields.String(missing=str(PROJECT_DIR / 'files'))
-    STORAGE_PATH = fields.String(missing=str(Path.home() / '.financial-portfolio-aggregator'))
+    Path(settings['STORAGE_PATH']).mkdir(parents=True, exist_ok=True)
 
-    GOOGLE_SHEETS_CREDENTIALS_PATH = fields.String(missing='./credentials.json')
-    SPREAD_SHEET_ID = fields.String(missing=None)
+    return settings
 
-    MARKET_CACHE_EXPIRATION_DAYS = fields.Integer(missing=31)
 
-    @validates_schema
-    def validate(
-        self,
-        data: typing.Mapping,
-        *,
-        many: bool = None,
-        partial: typing.Union[bool, types.StrSequenceOrSet] = None
-    ) -> typing.Dict[str, typing.List[str]]:
-        pass
+def get_settings() -> typing.Dict[str, typing.Any]:
+    global _settings
 
+    if _settings is None:
+        with _settings_lock:
+            if _settings is None:
+                _settings = load_settings()
 
-ENV_VARS = EnvVarsValidator().load(data=os.environ, many=None, partial=None, unknown='EXCLUDE')
+    return _settings
 
-FILES_DIR = ENV_VARS['FILES_DIR']
-STORAGE_PATH = ENV_VARS['STORAGE_PATH']
-Path(STORAGE_PATH).mkdir(parents=True, exist_ok=True)
 
-GOOGLE_SHEETS_CREDENTIALS_PATH = ENV_VARS['GOOGLE_SHEETS_CREDENTIALS_PATH']
-SPREAD_SHEET_ID = ENV_VARS['SPREAD_SHEET_ID']
+def __getattr__(name: str):
+    settings = get_settings()
+    if name not in settings:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
-MARKET_CACHE_EXPIRATION_DAYS = ENV_VARS['MARKET_CACHE_EXPIRATION_DAYS']
-MARKET_CACHE_EXPIRATION_DAYS = datetime.timedelta(days=MARKET_CACHE_EXPIRATION_DAYS)
+    return settings[name]
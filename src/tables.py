@@ -0,0 +1,145 @@
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.utils import intern_string
+
+
+class HoldingsTable:
+    """
+        Struct-of-arrays storage for the holdings of a financial instrument.
+
+        Every attribute is kept in its own column: the weights in a float array & the string attributes in
+        object arrays of interned strings. The columns grow by doubling their capacity, so appending is amortized O(1).
+        The public accessors return read-only views over the used part of the columns, without copying.
+    """
+
+    STRING_COLUMNS = ('name', 'normalized_name', 'ticker', 'country', 'sector', 'currency', 'exchange')
+    COLUMNS = STRING_COLUMNS + ('holding_type', 'holding')
+    INITIAL_CAPACITY = 16
+
+    def __init__(self, capacity: int = INITIAL_CAPACITY):
+        capacity = max(capacity, 1)
+
+        self._size = 0
+        self._weights = np.zeros(capacity, dtype=float)
+        self._columns = {column: np.empty(capacity, dtype=object) for column in self.COLUMNS}
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def capacity(self) -> int:
+        return len(self._weights)
+
+    @property
+    def weights(self) -> np.ndarray:
+        return self._view(self._weights)
+
+    @property
+    def holdings(self) -> np.ndarray:
+        return self.column('holding')
+
+    def column(self, name: str) -> np.ndarray:
+        if name == 'weight':
+            return self.weights
+
+        return self._view(self._columns[name])
+
+    def _view(self, array: np.ndarray) -> np.ndarray:
+        view = array[:self._size]
+        view.flags.writeable = False
+
+        return view
+
+    def append(self, holding, weight: float) -> int:
+        if self._size == self.capacity:
+            self._grow(2 * self.capacity)
+
+        row = self._size
+        self._size += 1
+
+        self._weights[row] = weight
+        self.set_holding(row, holding)
+
+        return row
+
+    def extend(self, holdings: Iterable, weights: Iterable[float]) -> np.ndarray:
+        holdings = list(holdings)
+        weights = np.asarray(weights, dtype=float)
+        assert len(holdings) == len(weights)
+
+        required_capacity = self._size + len(holdings)
+        if required_capacity > self.capacity:
+            self._grow(max(required_capacity, 2 * self.capacity))
+
+        rows = np.arange(self._size, required_capacity)
+        self._weights[rows] = weights
+        self._size = required_capacity
+        for row, holding in zip(rows.tolist(), holdings):
+            self.set_holding(row, holding)
+
+        return rows
+
+    def set_holding(self, row: int, holding):
+        """
+            Refreshes the columns of a row from the attributes of the holding.
+        """
+        assert 0 <= row < self._size
+
+        for column in self.STRING_COLUMNS:
+            self._columns[column][row] = intern_string(getattr(holding, column))
+
+        holding_type = holding.holding_type
+        self._columns['holding_type'][row] = holding_type.value if holding_type is not None else None
+        self._columns['holding'][row] = holding
+
+    def add_weights(self, rows: np.ndarray, weights: np.ndarray):
+        """
+            Adds the weights to the given rows. A row can appear multiple times.
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        assert rows.size == 0 or (rows.min() >= 0 and rows.max() < self._size)
+
+        np.add.at(self._weights, rows, np.asarray(weights, dtype=float))
+
+    def add_weight(self, row: int, weight: float):
+        assert 0 <= row < self._size
+
+        self._weights[row] += weight
+
+    def get_weight(self, row: int) -> float:
+        return float(self._weights[row])
+
+    def get_holding(self, row: int):
+        return self._columns['holding'][row]
+
+    def summed_weight(self) -> float:
+        return float(self.weights.sum())
+
+    def sorted_rows(self, descending: bool = True) -> np.ndarray:
+        weights = self.weights
+        if descending:
+            weights = -weights
+
+        return np.argsort(weights, kind='stable')
+
+    def to_dataframe(self, columns: Optional[Tuple[str, ...]] = None) -> pd.DataFrame:
+        columns = columns or self.STRING_COLUMNS + ('holding_type', )
+
+        data = {column: self.column(column) for column in columns}
+        data['weight'] = self.weights
+
+        return pd.DataFrame(data, copy=False)
+
+    def _grow(self, capacity: int):
+        weights = np.zeros(capacity, dtype=float)
+        weights[:self._size] = self._weights[:self._size]
+        self._weights = weights
+
+        for name, column in self._columns.items():
+            new_column = np.empty(capacity, dtype=object)
+            new_column[:self._size] = column[:self._size]
+            self._columns[name] = new_column
+
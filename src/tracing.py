@@ -0,0 +1,253 @@
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional
+
+"""
+    Lightweight instrumentation: named spans, which measure the duration & the peak memory of a stage, & counters.
+
+    It is disabled by default: `span` returns a shared no-op context manager & `count` returns right away, so the
+    instrumented code pays only a function call. Enable it with `enable()`. The spans are exported as a Chrome trace
+    ( open it in chrome://tracing or https://ui.perfetto.dev) with `export_chrome_trace(path)`, with the counters &
+    a summary per span name in `otherData`.
+
+    The peak memory of a span is measured with tracemalloc, which is process-wide: the spans that run at the same time
+    in different threads see the allocations of each other.
+"""
+
+_tracer: Optional['Tracer'] = None
+
+
+class Tracer:
+    def __init__(self, trace_memory: bool = True):
+        self.trace_memory = trace_memory
+        self.start_time = time.perf_counter()
+
+        self.events: List[dict] = []
+        self.counters: Dict[str, float] = defaultdict(float)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def get_stack(self) -> List['Span']:
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+
+        return stack
+
+    def count(self, name: str, value: float):
+        with self.lock:
+            self.counters[name] += value
+
+    def add_event(self, event: dict):
+        with self.lock:
+            self.events.append(event)
+
+    def to_microseconds(self, timestamp: float) -> float:
+        return (timestamp - self.start_time) * 1e6
+
+    def get_summary(self) -> Dict[str, dict]:
+        """
+            Returns the number of calls, the total duration & the max peak memory of every span name.
+        """
+        summary = dict()
+        with self.lock:
+            for event in self.events:
+                if event['ph'] != 'X':
+                    continue
+
+                span_summary = summary.setdefault(event['name'], {'calls': 0, 'seconds': 0., 'peak_memory_bytes': 0})
+                span_summary['calls'] += 1
+                span_summary['seconds'] += event['dur'] / 1e6
+                span_summary['peak_memory_bytes'] = max(
+                    span_summary['peak_memory_bytes'],
+                    event['args'].get('peak_memory_bytes', 0)
+                )
+
+        return summary
+
+
+class Span:
+    def __init__(self, tracer: Tracer, name: str, args: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+        self.start_time = 0.
+        self.start_memory = 0
+        self.peak_memory = 0
+
+    def __enter__(self):
+        stack = self.tracer.get_stack()
+        if self.tracer.trace_memory and tracemalloc.is_tracing():
+            current_memory, peak_memory = tracemalloc.get_traced_memory()
+            # The peak is reset for this span, so the parent keeps the peak it had until now.
+            if len(stack) > 0:
+                stack[-1].peak_memory = max(stack[-1].peak_memory, peak_memory)
+            _reset_peak()
+            self.start_memory = current_memory
+
+        stack.append(self)
+        self.start_time = time.perf_counter()
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end_time = time.perf_counter()
+
+        stack = self.tracer.get_stack()
+        stack.pop()
+
+        args = dict(self.args)
+        if self.tracer.trace_memory and tracemalloc.is_tracing():
+            current_memory, peak_memory = tracemalloc.get_traced_memory()
+            self.peak_memory = max(self.peak_memory, peak_memory)
+            if len(stack) > 0:
+                stack[-1].peak_memory = max(stack[-1].peak_memory, self.peak_memory)
+
+            args['peak_memory_bytes'] = self.peak_memory
+            args['memory_delta_bytes'] = current_memory - self.start_memory
+
+        self.tracer.add_event({
+            'name': self.name,
+            'ph': 'X',
+            'ts': self.tracer.to_microseconds(self.start_time),
+            'dur': (end_time - self.start_time) * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args
+        })
+
+        return False
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def enable(trace_memory: bool = True) -> Tracer:
+    """
+        Starts a new trace. With `trace_memory`, tracemalloc is started, which makes the allocations slower.
+    """
+    global _tracer
+
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _tracer = Tracer(trace_memory=trace_memory)
+
+    return _tracer
+
+
+def disable() -> Optional[Tracer]:
+    """
+        Stops the trace & returns it.
+    """
+    global _tracer
+
+    tracer = _tracer
+    _tracer = None
+    if tracer is not None and tracer.trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+    return tracer
+
+
+def is_enabled() -> bool:
+    return _tracer is not None
+
+
+def get_tracer() -> Optional[Tracer]:
+    return _tracer
+
+
+def span(name: str, **args):
+    tracer = _tracer
+    if tracer is None:
+        return NULL_SPAN
+
+    return Span(tracer, name, args)
+
+
+def count(name: str, value: float = 1):
+    tracer = _tracer
+    if tracer is None:
+        return
+
+    tracer.count(name, value)
+
+
+def traced(name: str) -> Callable:
+    """
+        Decorator that runs the function in a span.
+    """
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return function(*args, **kwargs)
+
+            with Span(_tracer, name, dict()):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def export_chrome_trace(path: str, tracer: Optional[Tracer] = None) -> str:
+    tracer = tracer or _tracer
+    assert tracer is not None, 'The tracing is not enabled.'
+
+    with tracer.lock:
+        events = list(tracer.events)
+        counters = dict(tracer.counters)
+
+    end_timestamp = tracer.to_microseconds(time.perf_counter())
+    events.extend(
+        {'name': name, 'ph': 'C', 'ts': end_timestamp, 'pid': os.getpid(), 'args': {'value': value}}
+        for name, value in counters.items()
+    )
+
+    with open(path, 'w') as f:
+        json.dump({
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {
+                'counters': counters,
+                'summary': tracer.get_summary()
+            }
+        }, f)
+
+    return path
+
+
+def print_summary(tracer: Optional[Tracer] = None):
+    tracer = tracer or _tracer
+    assert tracer is not None, 'The tracing is not enabled.'
+
+    print('Trace summary')
+    for name, span_summary in sorted(tracer.get_summary().items(), key=lambda item: -item[1]['seconds']):
+        print(
+            f'\t{name}: {span_summary["seconds"]:.3f}s in {span_summary["calls"]} calls, '
+            f'peak memory {span_summary["peak_memory_bytes"] / 2 ** 20:.1f} MB'
+        )
+    for name, value in sorted(tracer.counters.items()):
+        print(f'\t{name}: {value:g}')
+
+
+def _reset_peak():
+    # tracemalloc.reset_peak is available from python 3.9. Before it, the peak of a span is the peak of the process.
+    reset_peak = getattr(tracemalloc, 'reset_peak', None)
+    if reset_peak is not None:
+        reset_peak()
@@ -1,3 +1,4 @@
+import sys
 from collections import Iterable
 from typing import Optional, Union
 
@@ -38,3 +39,10 @@ def get_ticker_source(ticker: str, info: dict) -> Optional[str]:
 
 def has_digits(value: str):
     return any(char.isdigit() for char in value)
+
+
+def intern_string(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+
+    return value